@@ -1,70 +1,441 @@
-from django.contrib import admin
-from django.db.models import Count
+import csv
+import heapq
+import io
+from datetime import date, timedelta
+from itertools import islice
+
+from django import forms
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.auth import get_user_model
+from django.contrib.admin.utils import unquote
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum
+from django.http import FileResponse, Http404, HttpRequest, JsonResponse, QueryDict
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.html import format_html
-from .models import Category, Book, Reader, Loan, Damage
+from .exports import FORMATS, XLSX_MAX_ROWS, export_response
+from .imports import IMPORTERS, guess_format, read_records
+from .jobs import enqueue, output_dir
+from .models import (Category, Book, Reader, Loan, Damage, ArchivedLoan, ArchivedDamage, DailyCategoryStat, Job,
+                     Hold, Reminder, EditConflict)
+from .reports import dashboard
+from .search import search_backend, words
+from .services import LoanService
+
+
+class IndexedSearchMixin:
+    # {search index kind: path from this admin's model to the indexed model's pk}
+    search_index = {}
+    
+    def get_search_results(self, request, queryset, search_term):
+        backend = search_backend()
+        if any(backend.matching(kind, search_term) is None for kind in self.search_index):
+            return super().get_search_results(request, queryset, search_term)
+        # As in the default admin search, every word has to match, in any of the indexes
+        matches = Q()
+        for word in words(search_term):
+            either = Q()
+            for kind, path in self.search_index.items():
+                either |= Q(**{f'{path}__in': backend.matching(kind, word)})
+            matches &= either
+        return queryset.filter(matches), False
+
+
+class ExportChangeList(ChangeList):
+    # Filters, search and ordering only: the export streams its own rows, so skip the count and page queries
+    def get_results(self, request):
+        self.result_count = self.full_result_count = None
+        self.result_list = []
+
+
+class ExportMixin:
+    export_kind = None
+    
+    def get_urls(self):
+        info = self.opts.app_label, self.opts.model_name
+        return [
+            path('export/', self.admin_site.admin_view(self.export_view), name='%s_%s_export' % info),
+        ] + super().get_urls()
+    
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        cl = getattr(response, 'context_data', {}).get('cl')
+        if cl:
+            url = reverse('admin:%s_%s_export' % (self.opts.app_label, self.opts.model_name))
+            response.context_data['export_links'] = [
+                (fmt.upper(), url + cl.get_query_string({'format': fmt})) for fmt in FORMATS
+            ]
+            response.context_data['export_job_url'] = url + cl.get_query_string({'format': 'csv'})
+        return response
+    
+    def get_changelist(self, request, **kwargs):
+        if getattr(request, 'export_format', None):
+            return ExportChangeList
+        return super().get_changelist(request, **kwargs)
+    
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        params = request.GET.copy()
+        fmt = params.pop('format', ['csv'])[-1]
+        if fmt not in FORMATS:
+            raise Http404
+        if request.method == 'POST':
+            return self.export_job(request, fmt, params)
+        request.GET, request.export_format = params, fmt
+        queryset = self.export_queryset(request)
+        if fmt == 'xlsx':
+            # Unlike CSV, a workbook cannot be streamed while it is written: only small ones are built here
+            total = queryset.count()
+            if total > XLSX_MAX_ROWS:
+                self.message_user(request, f'{total:,} dòng vượt quá giới hạn của XLSX, hãy xuất CSV.',
+                                  messages.ERROR)
+                changelist = reverse('admin:%s_%s_changelist' % (self.opts.app_label, self.opts.model_name))
+                return redirect(f'{changelist}?{params.urlencode()}')
+            if total > getattr(settings, 'LIBRARY_EXPORT_XLSX_SYNC_ROWS', 10000):
+                return self.export_job(request, fmt, params)
+        return export_response(self.export_kind, queryset, fmt)
+    
+    def export_job(self, request, fmt, params):
+        # Large exports run on the workers; the file is downloaded from the job list
+        job = enqueue('export', user=request.user, kind=self.export_kind, fmt=fmt, query=params.urlencode(),
+                      user_id=request.user.pk)
+        self.message_user(request, job_message('Đã xếp hàng xuất dữ liệu', job))
+        return redirect('admin:core_job_changelist')
+    
+    def export_queryset(self, request):
+        return self.get_changelist_instance(request).queryset
+
+
+def export_queryset(kind, query, user_id):
+    """The queryset an admin export of ``kind`` with this query string returns, rebuilt outside the request."""
+    request = HttpRequest()
+    request.method, request.GET = 'GET', QueryDict(query)
+    request.user = get_user_model().objects.get(pk=user_id)
+    request.export_format = 'csv'
+    model_admin = admin.site._registry[apps.get_model('core', kind)]
+    if not model_admin.has_view_permission(request):
+        raise PermissionDenied
+    return model_admin.export_queryset(request)
+
+
+def job_message(text, job):
+    url = reverse('admin:core_job_change', args=[job.pk])
+    return format_html('{} (<a href="{}">tác vụ #{}</a>).', text, url, job.pk)
+
+
+class LookaheadPage(Page):
+    def has_next(self):
+        return self.more
+
+
+class LookaheadPaginator(Paginator):
+    """Fetches one row past the page to learn whether another page exists, instead of COUNT(*)."""
+    
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('Số trang không hợp lệ')
+        if number < 1:
+            raise EmptyPage('Số trang không hợp lệ')
+        return number
+    
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        page = LookaheadPage(rows[:self.per_page], number, self)
+        page.more = len(rows) > self.per_page
+        return page
+
+
+class AutocompleteMixin:
+    # Autocomplete lookups return the newest matches first and never count the table,
+    # so the dropdown costs the same at any size
+    def is_autocomplete(self, request):
+        return bool(request.resolver_match and request.resolver_match.url_name == 'autocomplete')
+    
+    def autocomplete_queryset(self, request, queryset):
+        return queryset
+    
+    def get_search_results(self, request, queryset, search_term):
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if self.is_autocomplete(request):
+            queryset = self.autocomplete_queryset(request, queryset).order_by('-pk')
+        return queryset, may_have_duplicates
+    
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if self.is_autocomplete(request):
+            return LookaheadPaginator(queryset, per_page)
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(label='Tệp CSV / JSON / JSON Lines')
+    dry_run = forms.BooleanField(label='Chạy thử (không ghi dữ liệu)', required=False, initial=True)
+
+
+class ImportMixin:
+    import_kind = None
+    
+    def get_urls(self):
+        info = self.opts.app_label, self.opts.model_name
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='%s_%s_import' % info),
+        ] + super().get_urls()
+    
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        if self.has_add_permission(request) and self.has_change_permission(request):
+            extra_context['import_url'] = reverse('admin:%s_%s_import' % (self.opts.app_label, self.opts.model_name))
+        return super().changelist_view(request, extra_context)
+    
+    def import_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        result = None
+        form = ImportForm(request.POST, request.FILES) if request.method == 'POST' else ImportForm()
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            importer = IMPORTERS[self.import_kind](dry_run=form.cleaned_data['dry_run'])
+            try:
+                result = importer.run(read_records(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''),
+                                                   guess_format(upload.name)))
+            except (ValueError, csv.Error) as e:
+                form.add_error('file', str(e))
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': f'Nhập {self.opts.verbose_name}',
+            'form': form,
+            'result': result,
+        }
+        return TemplateResponse(request, 'admin/core/import.html', context)
+
+
+class VersionedForm(forms.ModelForm):
+    """Carries the version the page was rendered with, so saving over someone else's edit is refused."""
+    loaded_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial['loaded_version'] = self.instance.version
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        version = cleaned_data.get('loaded_version')
+        if self.instance.pk and version is not None and version != self.instance.version:
+            raise forms.ValidationError(EditConflict().message, code='conflict')
+        return cleaned_data
+
+
+class VersionedAdminMixin:
+    form = VersionedForm
+    
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except EditConflict as e:
+            # Changed after this request loaded the row: the transaction is rolled back, start again
+            self.message_user(request, e.message, messages.ERROR)
+            return redirect(request.get_full_path())
+    
+    def delete_queryset(self, request, queryset):
+        # Row by row through Model.delete(), which gives back what the row counted
+        with transaction.atomic():
+            for obj in queryset:
+                obj.delete()
 
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['name']
+    list_display = ['name', 'books', 'books_available', 'copies', 'copies_available', 'copies_on_loan',
+                    'copies_reserved', 'retired_books']
     search_fields = ['name']
 
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(VersionedAdminMixin, ImportMixin, ExportMixin, AutocompleteMixin, IndexedSearchMixin,
+                admin.ModelAdmin):
     list_display = ['code', 'title', 'category', 'author', 'publisher', 'price', 
-                    'total_quantity', 'available', 'is_active', 'loan_count']
+                    'total_quantity', 'available', 'is_active', 'active_loans', 'reserved', 'loan_count']
     list_filter = ['category', 'is_active']
     search_fields = ['code', 'title', 'author']
+    search_index = {'book': 'pk'}
+    export_kind = import_kind = 'book'
     
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
         # Use all_objects to show inactive books in admin
-        qs = Book.all_objects.annotate(loan_count=Count('loans'))
-        return qs
+        return Book.all_objects.all()
     
-    @admin.display(description='Số lần mượn', ordering='loan_count')
-    def loan_count(self, obj):
-        return obj.loan_count
+    def autocomplete_queryset(self, request, queryset):
+        return queryset.filter(is_active=True)
 
 
-class LoanInline(admin.TabularInline):
-    model = Loan
-    extra = 0
-    fields = ['book', 'borrow_date', 'due_date', 'return_date', 'status']
-    can_delete = False
+class DebtFilter(admin.SimpleListFilter):
+    title = 'Công nợ'
+    parameter_name = 'debt'
     
-    def has_add_permission(self, request, obj=None):
-        return False
+    def lookups(self, request, model_admin):
+        return [('damages', 'Nợ bồi thường'), ('overdue', 'Đang quá hạn'), ('none', 'Không nợ')]
+    
+    def queryset(self, request, queryset):
+        if self.value() == 'damages':
+            return queryset.filter(unpaid_damages__gt=0)
+        if self.value() == 'overdue':
+            return queryset.filter(overdue_fine__gt=0)
+        if self.value() == 'none':
+            return queryset.filter(unpaid_damages=0, overdue_fine=0)
+        return queryset
 
 
 @admin.register(Reader)
-class ReaderAdmin(admin.ModelAdmin):
-    list_display = ['card_id', 'full_name', 'phone', 'created_at', 'unpaid_damages_count']
+class ReaderAdmin(ImportMixin, ExportMixin, AutocompleteMixin, IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ['card_id', 'full_name', 'phone', 'created_at', 'active_loans', 'unpaid_damages_count',
+                    'display_unpaid_total', 'display_overdue_fine']
+    list_filter = [DebtFilter]
     search_fields = ['card_id', 'full_name', 'phone']
-    inlines = [LoanInline]
+    search_index = {'reader': 'pk'}
+    export_kind = import_kind = 'reader'
+    history_page_size = 20
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_debt()
+    
+    def get_urls(self):
+        return [
+            path('<path:object_id>/history/', self.admin_site.admin_view(self.history_view),
+                 name='core_reader_history'),
+        ] + super().get_urls()
+    
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = extra_context or {}
+        if object_id:
+            object_id = unquote(object_id)
+            loans = Loan.objects.filter(reader_id=object_id).select_related('book').with_fines()
+            extra_context['current_loans'] = loans.filter(status='borrowing').order_by('due_date', 'id')
+            extra_context['history_archived'] = archived = request.GET.get('archived') == '1'
+            extra_context.update(self.history_page(object_id, archived=archived))
+        return super().change_view(request, object_id, form_url, extra_context)
     
-    @admin.display(description='Nợ bồi thường')
+    def history_view(self, request, object_id):
+        reader = self.get_object(request, unquote(object_id))
+        if reader is None or not self.has_view_permission(request, reader):
+            raise Http404
+        try:
+            borrow_date, pk = request.GET['after'].split(',')
+            after = (date.fromisoformat(borrow_date), int(pk))
+        except (KeyError, ValueError):
+            after = None
+        return TemplateResponse(request, 'admin/core/reader/loan_history_rows.html',
+                                self.history_page(reader.pk, after, request.GET.get('archived') == '1'))
+    
+    def history_page(self, reader_id, after=None, archived=False):
+        # Keyset pagination on (borrow_date, id): every page costs the same however long the history is.
+        # Archived loans keep their ids, so both tables page on the same cursor and merge in order.
+        tables = [Loan.objects.history(after).with_fines()]
+        if archived:
+            tables.append(ArchivedLoan.objects.history(after).with_fines())
+        n = self.history_page_size + 1
+        rows = heapq.merge(*(list(loans.filter(reader_id=reader_id).select_related('book')[:n]) for loans in tables),
+                           key=lambda loan: (loan.borrow_date, loan.pk), reverse=True)
+        rows = list(islice(rows, n))
+        page, more = rows[:self.history_page_size], len(rows) > self.history_page_size
+        next_url = None
+        if more:
+            last = page[-1]
+            next_url = (reverse('admin:core_reader_history', args=[reader_id]) +
+                        f'?after={last.borrow_date.isoformat()},{last.pk}' + ('&archived=1' if archived else ''))
+        return {'history': page, 'history_next_url': next_url}
+    
+    @admin.display(description='Nợ bồi thường', ordering='unpaid_damages')
     def unpaid_damages_count(self, obj):
-        unpaid = Damage.objects.filter(loan__reader=obj, is_paid=False).count()
-        if unpaid > 0:
-            return format_html('<span style="color: red; font-weight: bold;">{} chưa trả</span>', unpaid)
+        if obj.unpaid_damages > 0:
+            return format_html('<span style="color: red; font-weight: bold;">{} chưa trả</span>', obj.unpaid_damages)
         return "0"
+    
+    @admin.display(description='Tiền bồi thường', ordering='unpaid_total')
+    def display_unpaid_total(self, obj):
+        return f'{obj.unpaid_total:,} VNĐ'
+    
+    @admin.display(description='Phạt quá hạn', ordering='overdue_fine')
+    def display_overdue_fine(self, obj):
+        if obj.overdue_fine > 0:
+            return format_html('<span style="color: red; font-weight: bold;">{} VNĐ</span>', f'{obj.overdue_fine:,}')
+        return '0 VNĐ'
+
+
+class FineFilter(admin.SimpleListFilter):
+    title = 'Tiền phạt'
+    parameter_name = 'fine'
+    
+    def lookups(self, request, model_admin):
+        return [('overdue', 'Đang quá hạn'), ('late', 'Trả muộn'), ('none', 'Không phạt')]
+    
+    def queryset(self, request, queryset):
+        if self.value() == 'overdue':
+            return queryset.overdue()
+        if self.value() == 'late':
+            return queryset.filter(status='returned', return_date__gt=F('due_date'))
+        if self.value() == 'none':
+            return queryset.filter(fine_amount=0)
+        return queryset
 
 
 @admin.register(Loan)
-class LoanAdmin(admin.ModelAdmin):
+class LoanAdmin(VersionedAdminMixin, ExportMixin, AutocompleteMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ['reader', 'book', 'borrow_date', 'due_date', 'return_date', 'status', 'display_fine']
-    list_filter = ['status', 'borrow_date', 'due_date']
+    list_filter = ['status', FineFilter, 'borrow_date', 'due_date']
     search_fields = ['reader__card_id', 'reader__full_name', 'book__code', 'book__title']
+    search_index = {'reader': 'reader', 'book': 'book'}
+    export_kind = 'loan'
+    autocomplete_fields = ['reader', 'book']
+    actions = ['mark_returned']
+    
+    def get_readonly_fields(self, request, obj=None):
+        # The counters were moved for this reader and book
+        return ['reader', 'book'] if obj else []
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('book', 'reader')
+        return qs.select_related('book', 'reader').with_fines()
+    
+    def autocomplete_queryset(self, request, queryset):
+        # A lost copy cannot be damaged again
+        return queryset.exclude(damage__damage_type='lost')
     
-    @admin.display(description='Tiền phạt', ordering='due_date')
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        cl = getattr(response, 'context_data', {}).get('cl')
+        # The totals scan every loan they cover: only for a list narrowed by a filter or a search
+        if cl and (cl.has_active_filters or cl.query):
+            totals = cl.queryset.aggregate(fine=Sum('fine_amount'), overdue=Count('pk', filter=Q(days_overdue__gt=0)))
+            response.context_data['fine_totals'] = {'fine': f'{totals["fine"] or 0:,}', 'overdue': totals['overdue']}
+        return response
+    
+    @admin.action(description='Trả sách cho các phiếu đã chọn', permissions=['change'])
+    def mark_returned(self, request, queryset):
+        loan_ids = list(queryset.filter(status='borrowing').values_list('pk', flat=True))
+        if len(loan_ids) > LoanService.batch_size:
+            # More than one batch: hand it to the workers instead of holding the request
+            job = enqueue('bulk_return', user=request.user, loan_ids=loan_ids)
+            self.message_user(request, job_message(f'Đã xếp hàng trả {len(loan_ids):,} phiếu mượn', job))
+            return
+        returned = LoanService.bulk_return(loan_ids)
+        self.message_user(request, f'Đã trả {returned} phiếu mượn.')
+    
+    @admin.display(description='Tiền phạt', ordering='fine_amount')
     def display_fine(self, obj):
-        fine_amount = obj.fine
+        fine_amount = obj.fine_amount
         if fine_amount > 0:
             formatted_amount = f'{fine_amount:,}'
             return format_html('<span style="color: red; font-weight: bold;">{} VNĐ</span>', formatted_amount)
@@ -72,14 +443,24 @@ class LoanAdmin(admin.ModelAdmin):
 
 
 @admin.register(Damage)
-class DamageAdmin(admin.ModelAdmin):
+class DamageAdmin(VersionedAdminMixin, ExportMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ['get_book', 'get_reader', 'damage_type', 'reported_date', 'display_compensation', 'is_paid', 'loan']
     list_filter = ['damage_type', 'is_paid', 'reported_date']
     search_fields = ['loan__reader__card_id', 'loan__reader__full_name', 'loan__book__code', 'loan__book__title']
+    search_index = {'reader': 'loan__reader', 'book': 'loan__book'}
+    export_kind = 'damage'
+    autocomplete_fields = ['loan']
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('loan__book', 'loan__reader')
     
+    def get_readonly_fields(self, request, obj=None):
+        return ['loan', 'damage_type'] if obj else []
+    
+    def has_delete_permission(self, request, obj=None):
+        # A lost copy was taken off the inventory for good
+        return super().has_delete_permission(request, obj) and not (obj and obj.damage_type == 'lost')
+    
     @admin.display(description='Sách', ordering='loan__book__title')
     def get_book(self, obj):
         return obj.book.title
@@ -94,3 +475,200 @@ class DamageAdmin(admin.ModelAdmin):
         color = 'red' if not obj.is_paid else 'green'
         status = 'Chưa thanh toán' if not obj.is_paid else 'Đã thanh toán'
         return format_html(f'<span style="color: {color}; font-weight: bold;">{amt} VNĐ ({status})</span>')
+
+
+@admin.register(Hold)
+class HoldAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ['reader', 'book', 'status', 'display_position', 'created_at', 'expires_at']
+    list_filter = ['status']
+    list_select_related = ['reader', 'book']
+    search_fields = ['reader__card_id', 'reader__full_name', 'book__code', 'book__title']
+    search_index = {'reader': 'reader', 'book': 'book'}
+    autocomplete_fields = ['reader', 'book']
+    actions = ['cancel_holds']
+    
+    def get_queryset(self, request):
+        # Head of each book's queue as a correlated seek on hold_queue_idx, so positions cost no extra queries
+        head = Hold.objects.filter(book=OuterRef('book'), status='waiting').order_by('ticket').values('ticket')[:1]
+        return super().get_queryset(request).annotate(head=Subquery(head))
+    
+    def get_readonly_fields(self, request, obj=None):
+        # Moving a hold to another book or reader would skip the queue
+        return ['reader', 'book'] if obj else []
+    
+    @admin.display(description='Vị trí trong hàng chờ', ordering='ticket')
+    def display_position(self, obj):
+        return obj.ticket - obj.head + 1 if obj.status == 'waiting' else '-'
+    
+    @admin.action(description='Hủy các lượt đặt trước đã chọn', permissions=['change'])
+    def cancel_holds(self, request, queryset):
+        cancelled = sum(hold.cancel() for hold in queryset.filter(status__in=['waiting', 'ready']))
+        self.message_user(request, f'Đã hủy {cancelled} lượt đặt trước.')
+
+
+@admin.register(DailyCategoryStat)
+class ReportAdmin(admin.ModelAdmin):
+    # The changelist is the dashboard; it reads the rollup tables only, never Loan or Damage
+    periods = [7, 30, 90, 365]
+    max_period = 3660
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = min(max(int(request.GET.get('days', 30)), 1), self.max_period)
+        except ValueError:
+            days = 30
+        end = DailyCategoryStat.objects.filter(category=None).aggregate(m=Max('day'))['m']
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Báo cáo thống kê',
+            'periods': self.periods,
+            'period': days,
+            'end': end,
+        }
+        if end:
+            context['start'] = end - timedelta(days=days - 1)
+            context.update(dashboard(context['start'], end))
+        return TemplateResponse(request, 'admin/core/dailycategorystat/dashboard.html', context)
+
+
+@admin.register(Reminder)
+class ReminderAdmin(admin.ModelAdmin):
+    list_display = ['reader', 'day', 'overdue_loans', 'due_soon_loans', 'fine', 'status', 'sent_at']
+    list_filter = ['status', 'day']
+    list_select_related = ['reader']
+    readonly_fields = [f.name for f in Reminder._meta.fields]
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedDamageInline(admin.TabularInline):
+    model = ArchivedDamage
+    fields = readonly_fields = ['damage_type', 'reported_date', 'compensation_fee', 'notes']
+    extra = 0
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivedLoan)
+class ArchivedLoanAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'reader', 'book', 'borrow_date', 'due_date', 'return_date']
+    list_select_related = ['reader', 'book']
+    search_fields = ['=id', '=reader__card_id', '=book__code']
+    readonly_fields = [f.name for f in ArchivedLoan._meta.fields]
+    inlines = [ArchivedDamageInline]
+    # Counting millions of archived rows on every page is not worth it
+    show_full_result_count = False
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        # Book.loan_count includes archived loans
+        return False
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'task', 'status', 'display_progress', 'attempts', 'created_by', 'created_at',
+                    'finished_at', 'display_result']
+    list_filter = ['status', 'task']
+    readonly_fields = [f.name for f in Job._meta.fields]
+    actions = ['retry']
+    # Tasks without parameters that can be queued from the job list
+    manual_tasks = [('rebuild_counters', 'Tính lại bộ đếm'), ('rollup', 'Tổng hợp báo cáo'),
+                    ('rebuild_search_index', 'Dựng lại chỉ mục tìm kiếm'), ('send_reminders', 'Gửi nhắc trả sách'),
+                    ('archive_loans', 'Lưu trữ phiếu mượn cũ'), ('expire_holds', 'Hủy đặt trước quá hạn nhận')]
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_retry_permission(self, request):
+        # The change form stays read-only; requeueing is its own right
+        return request.user.has_perm('core.change_job')
+    
+    def get_urls(self):
+        return [
+            path('status/', self.admin_site.admin_view(self.status_view), name='core_job_status'),
+            path('enqueue/<str:task>/', self.admin_site.admin_view(self.enqueue_view), name='core_job_enqueue'),
+            path('<path:object_id>/download/', self.admin_site.admin_view(self.download_view),
+                 name='core_job_download'),
+        ] + super().get_urls()
+    
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['manual_tasks'] = [(reverse('admin:core_job_enqueue', args=[name]), label)
+                                         for name, label in self.manual_tasks]
+        extra_context['status_url'] = reverse('admin:core_job_status')
+        return super().changelist_view(request, extra_context)
+    
+    def status_view(self, request):
+        # Polled by the job list while jobs are queued or running
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        ids = [pk for pk in request.GET.get('ids', '').split(',') if pk.isdigit()][:100]
+        jobs = Job.objects.filter(pk__in=ids).values('pk', 'status', 'progress', 'total', 'message')
+        return JsonResponse({'jobs': {job.pop('pk'): job for job in jobs}})
+    
+    def enqueue_view(self, request, task):
+        if request.method != 'POST' or task not in dict(self.manual_tasks):
+            raise Http404
+        if not request.user.has_perm('core.add_job'):
+            raise PermissionDenied
+        job = enqueue(task, user=request.user)
+        self.message_user(request, job_message('Đã xếp hàng', job))
+        return redirect('admin:core_job_changelist')
+    
+    def download_view(self, request, object_id):
+        job = self.get_object(request, unquote(object_id))
+        if job is None or not self.has_view_permission(request, job) or not (job.result or {}).get('file'):
+            raise Http404
+        target = output_dir() / job.result['file']
+        if not target.is_file():
+            raise Http404
+        return FileResponse(open(target, 'rb'), as_attachment=True, filename=target.name)
+    
+    @admin.action(description='Chạy lại các tác vụ lỗi', permissions=['retry'])
+    def retry(self, request, queryset):
+        requeued = queryset.filter(status='failed').update(status='queued', attempts=0, error='', worker='',
+                                                           run_after=timezone.now(), finished_at=None)
+        self.message_user(request, f'Đã xếp hàng lại {requeued} tác vụ.')
+    
+    @admin.display(description='Tiến độ')
+    def display_progress(self, obj):
+        text = f'{obj.progress:,}/{obj.total:,}' if obj.total is not None else ''
+        if obj.message:
+            text = f'{text} {obj.message}'.strip()
+        return format_html('<span class="job-progress" data-job="{}" data-status="{}">{}</span>',
+                           obj.pk, obj.status, text or '-')
+    
+    @admin.display(description='Kết quả')
+    def display_result(self, obj):
+        if obj.status == 'failed':
+            return obj.error.strip().splitlines()[-1] if obj.error else '-'
+        if (obj.result or {}).get('file'):
+            return format_html('<a href="{}">Tải {}</a>', reverse('admin:core_job_download', args=[obj.pk]),
+                               obj.result['file'])
+        return '-' if obj.result is None else str(obj.result)[:200]
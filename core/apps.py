@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+    
+    def ready(self):
+        from . import cache, search
+        from .models import Category, Book, Reader, Loan
+        
+        connection_created.connect(search.register_fold_function)
+        post_migrate.connect(search.create_search_tables, sender=self)
+        for model in (Book, Reader):
+            post_save.connect(search.index_object, sender=model)
+            post_delete.connect(search.remove_object, sender=model)
+        for model in (Category, Book, Reader, Loan):
+            post_save.connect(cache.forget_object, sender=model)
+            post_delete.connect(cache.forget_object, sender=model)
@@ -0,0 +1,93 @@
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+TIMEOUT = 6 * 3600
+
+# Display fields cached per model; counters such as Book.available change
+# through F() UPDATEs that bypass save(), so they are never cached.
+FIELDS = {
+    'category': ['name'],
+    'book': ['code', 'title', 'category_id', 'price', 'is_active'],
+    'reader': ['card_id', 'full_name'],
+    'loan': ['reader_id', 'book_id'],
+}
+
+# Hit/miss counts of this process, e.g. {'book.hit': 12, 'book.miss': 1}
+metrics = Counter()
+
+
+def _cache():
+    return caches[getattr(settings, 'LIBRARY_CACHE', 'default')]
+
+
+def _version(kind):
+    # Bumping the version drops a whole namespace at once (bulk loads); a
+    # missing version starts a fresh one so evicted versions never resurrect old entries.
+    key = f'catalog:{kind}:version'
+    version = _cache().get(key)
+    if version is None:
+        _cache().add(key, time.time_ns(), None)
+        version = _cache().get(key)
+    return version
+
+
+def _key(kind, pk):
+    return f'catalog:{kind}:{_version(kind)}:{pk}'
+
+
+def _load(kind, pk):
+    row = apps.get_model('core', kind)._base_manager.filter(pk=pk).values(*FIELDS[kind]).first()
+    return SimpleNamespace(pk=pk, **row) if row else None
+
+
+def get(kind, pk):
+    """Cached display data of one object, as attributes (``get('book', 1).title``); None if it does not exist."""
+    key = _key(kind, pk)
+    value = _cache().get(key)
+    if value is not None:
+        metrics[f'{kind}.hit'] += 1
+        return value
+    metrics[f'{kind}.miss'] += 1
+    value = _load(kind, pk)
+    if value is not None:
+        _cache().set(key, value, TIMEOUT)
+    return value
+
+
+def related(instance, path):
+    """Follow an FK path such as ``'loan.book'``, using objects already loaded by select_related
+    and the cache for the rest, so ``__str__`` never issues a lazy query per hop."""
+    value = instance
+    for name in path.split('.'):
+        if isinstance(value, SimpleNamespace):
+            value = get(name, getattr(value, f'{name}_id'))
+        elif getattr(type(value), name).is_cached(value):
+            value = getattr(value, name)
+        else:
+            value = get(name, getattr(value, f'{name}_id'))
+    return value
+
+
+def forget(kind, pk=None):
+    """Drop one cached object, or the whole namespace when ``pk`` is None."""
+    if pk is None:
+        _cache().set(f'catalog:{kind}:version', time.time_ns(), None)
+    else:
+        _cache().delete(_key(kind, pk))
+
+
+def forget_all():
+    for kind in FIELDS:
+        forget(kind)
+
+
+def forget_object(sender, instance, using=None, **kwargs):
+    # Only once the write is committed: forgotten before, a concurrent read would cache the old row again
+    kind, pk = sender._meta.model_name, instance.pk
+    transaction.on_commit(lambda: forget(kind, pk), using=using)
@@ -0,0 +1,158 @@
+import csv
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import FileResponse, StreamingHttpResponse
+
+from .models import Book, Reader, Loan, Damage
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX export is optional
+    Workbook = None
+
+CHUNK_SIZE = 2000
+XLSX_MAX_ROWS = 1048575  # one sheet, after the header row
+LOAN_STATUS = dict(Loan.STATUS_CHOICES)
+DAMAGE_TYPE = dict(Damage.DAMAGE_TYPE_CHOICES)
+
+
+def _yes_no(value):
+    return 'Có' if value else 'Không'
+
+
+# kind: (default queryset, [(header, values_list path, formatter or None)])
+EXPORTS = {
+    'loan': (lambda: Loan.objects.with_fines(), [
+        ('ID', 'pk', None),
+        ('Mã thẻ', 'reader__card_id', None),
+        ('Bạn đọc', 'reader__full_name', None),
+        ('Mã sách', 'book__code', None),
+        ('Tên sách', 'book__title', None),
+        ('Ngày mượn', 'borrow_date', None),
+        ('Hạn trả', 'due_date', None),
+        ('Ngày trả thực tế', 'return_date', None),
+        ('Trạng thái', 'status', LOAN_STATUS.get),
+        ('Số ngày quá hạn', 'days_overdue', None),
+        ('Tiền phạt', 'fine_amount', None),
+    ]),
+    'damage': (lambda: Damage.objects.all(), [
+        ('ID', 'pk', None),
+        ('Phiếu mượn', 'loan_id', None),
+        ('Mã thẻ', 'loan__reader__card_id', None),
+        ('Bạn đọc', 'loan__reader__full_name', None),
+        ('Mã sách', 'loan__book__code', None),
+        ('Tên sách', 'loan__book__title', None),
+        ('Loại hư hỏng', 'damage_type', DAMAGE_TYPE.get),
+        ('Ngày phát hiện', 'reported_date', None),
+        ('Phí bồi thường', 'compensation_fee', None),
+        ('Đã thanh toán', 'is_paid', _yes_no),
+        ('Ghi chú', 'notes', None),
+    ]),
+    'book': (lambda: Book.all_objects.all(), [
+        ('Mã sách', 'code', None),
+        ('Tên sách', 'title', None),
+        ('Thể loại', 'category__name', None),
+        ('Tác giả', 'author', None),
+        ('Nhà xuất bản', 'publisher', None),
+        ('Giá bìa', 'price', None),
+        ('Tổng số lượng', 'total_quantity', None),
+        ('Số lượng hiện có', 'available', None),
+        ('Đang cho mượn', 'active_loans', None),
+        ('Số lần mượn', 'loan_count', None),
+        ('Đang sử dụng', 'is_active', _yes_no),
+    ]),
+    'reader': (lambda: Reader.objects.with_debt(), [
+        ('Mã thẻ', 'card_id', None),
+        ('Họ tên', 'full_name', None),
+        ('Số điện thoại', 'phone', None),
+        ('Ngày cấp thẻ', 'created_at', None),
+        ('Đang mượn', 'active_loans', None),
+        ('Hư hỏng chưa trả', 'unpaid_damages', None),
+        ('Tiền bồi thường chưa trả', 'unpaid_total', None),
+        ('Phạt quá hạn', 'overdue_fine', None),
+    ]),
+}
+FORMATS = ['csv', 'xlsx'] if Workbook else ['csv']
+
+
+def export_rows(kind, queryset=None, chunk_size=CHUNK_SIZE):
+    """Header row, then one tuple per object streamed from the database in chunks."""
+    default, columns = EXPORTS[kind]
+    queryset = default() if queryset is None else queryset
+    yield [header for header, _, _ in columns]
+    formatters = [(i, fmt) for i, (_, _, fmt) in enumerate(columns) if fmt]
+    for row in queryset.values_list(*[path for _, path, _ in columns]).iterator(chunk_size=chunk_size):
+        if formatters:
+            row = list(row)
+            for i, fmt in formatters:
+                row[i] = fmt(row[i])
+        yield row
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield '﻿'  # BOM so Excel reads the Vietnamese text as UTF-8
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(rows, target):
+    if Workbook is None:
+        raise ImportError('Cần cài openpyxl để xuất XLSX')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for n, row in enumerate(rows):
+        if n > XLSX_MAX_ROWS:
+            raise ValueError(f'XLSX chỉ chứa được {XLSX_MAX_ROWS:,} dòng, hãy xuất CSV')
+        sheet.append(list(row))
+    workbook.save(target)
+
+
+def export_response(kind, queryset, fmt='csv'):
+    filename = f'{kind}s'
+    if fmt == 'xlsx':
+        # The workbook is only sent once complete: callers keep this to small querysets
+        # (see LIBRARY_EXPORT_XLSX_SYNC_ROWS); the write-only workbook spools to disk
+        target = tempfile.TemporaryFile()
+        write_xlsx(export_rows(kind, queryset), target)
+        target.seek(0)
+        return FileResponse(target, as_attachment=True, filename=f'{filename}.xlsx')
+    response = StreamingHttpResponse(csv_lines(export_rows(kind, queryset)), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+class ExportCommand(BaseCommand):
+    kind = None
+
+    @property
+    def help(self):
+        return f'Export every {self.kind} as CSV (stdout by default) or XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+        parser.add_argument('--output', help='File to write; required for xlsx')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, format, output, chunk_size, **options):
+        rows = export_rows(self.kind, chunk_size=chunk_size)
+        if format == 'xlsx':
+            if not output:
+                raise CommandError('--output là bắt buộc khi xuất xlsx')
+            try:
+                write_xlsx(rows, output)
+            except ImportError as e:
+                raise CommandError(str(e))
+            return
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as f:
+                f.writelines(csv_lines(rows))
+        else:
+            for line in csv_lines(rows):
+                self.stdout.write(line, ending='')
@@ -0,0 +1,22 @@
+from django.db.models import Func, IntegerField
+
+
+class DaysBetween(Func):
+    """Whole days from ``start`` to ``end`` for DateField expressions."""
+
+    output_field = IntegerField()
+
+    def __init__(self, end, start, **extra):
+        super().__init__(end, start, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='(%(expressions)s)', arg_joiner=' - ',
+                              **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection,
+                              template='CAST(julianday(%(expressions)s) AS INTEGER)',
+                              arg_joiner=') - julianday(', **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function='DATEDIFF', **extra_context)
@@ -0,0 +1,32 @@
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Hold
+
+BATCH_SIZE = 500
+
+
+def expire_holds(now=None, batch_size=BATCH_SIZE):
+    """Close ready holds not picked up by their deadline and pass each copy on; returns how many expired.
+
+    Each batch is one transaction: the expired holds, the next readers in the
+    queue getting the copies and the books for copies going back on the shelf.
+    The holds are locked as they are read, so a reader picking up the book in
+    between keeps the copy; only the holds actually expired pass theirs on.
+    """
+    now = now or timezone.now()
+    due = Hold.objects.filter(status='ready', expires_at__lt=now).order_by('expires_at')
+    expired = 0
+    while True:
+        with transaction.atomic():
+            rows = dict(due.select_for_update(skip_locked=True).values_list('pk', 'book_id')[:batch_size])
+            if not rows:
+                return expired
+            if Hold.objects.filter(pk__in=rows, status='ready').update(status='expired', closed_at=now) != len(rows):
+                # Without row locks (SQLite) a hold can be claimed or cancelled after the SELECT
+                rows = dict(Hold.objects.filter(pk__in=rows, status='expired', closed_at=now)
+                            .values_list('pk', 'book_id'))
+            Hold.objects.pass_on(Counter(rows.values()), now)
+        expired += len(rows)
@@ -0,0 +1,234 @@
+import csv
+import json
+import os
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import cache as catalog_cache
+from .models import Category, Book, BookStock, Reader, move_stock
+from .search import search_backend
+from .services import chunked
+
+MAX_REPORTED_ERRORS = 1000
+BOOLEAN_WORDS = {'có': True, 'không': False}
+
+
+def read_records(file, fmt):
+    """Yield (line number, {column: value}) from a CSV, JSON Lines or JSON array file.
+
+    ``file`` is a text stream. CSV and JSON Lines are read row by row; a JSON
+    array has to be loaded whole.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_num, line in enumerate(file, 1):
+            if line.strip():
+                yield line_num, json.loads(line)
+    elif fmt == 'json':
+        for line_num, row in enumerate(json.load(file), 1):
+            yield line_num, row
+    else:
+        raise ValueError(f'Định dạng không hỗ trợ: {fmt}')
+
+
+def guess_format(filename):
+    ext = os.path.splitext(filename)[1].lower().lstrip('.')
+    return ext if ext in ('csv', 'json', 'jsonl') else 'csv'
+
+
+class ImportResult:
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.created = self.updated = self.failed = 0
+        self.new_categories = set()
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def __str__(self):
+        prefix = '[Chạy thử] ' if self.dry_run else ''
+        return (f'{prefix}Thêm mới {self.created:,}, cập nhật {self.updated:,}, lỗi {self.failed:,}'
+                + (f', thể loại mới {len(self.new_categories):,}' if self.new_categories else ''))
+
+
+class CatalogImporter:
+    """Batched upsert of books or readers keyed on code / card_id.
+
+    Each batch costs a handful of queries: one to lock the existing rows, one
+    bulk INSERT .. ON CONFLICT UPDATE, plus one per category seen for the
+    first time. Invalid rows are reported and skipped; the rest of the batch
+    is still written.
+    """
+
+    model = key = None
+    fields = required = update_fields = []
+    batch_size = 2000
+
+    def __init__(self, batch_size=None, dry_run=False):
+        self.batch_size = batch_size or self.batch_size
+        self.dry_run = dry_run
+        # Accept field names as well as the verbose names written by the exports
+        self.aliases = {}
+        for name in self.fields:
+            field = self.model._meta.get_field(name)
+            self.aliases[name] = self.aliases[str(field.verbose_name)] = name
+
+    def run(self, records):
+        result = ImportResult(self.dry_run)
+        for batch in chunked(records, self.batch_size):
+            try:
+                with transaction.atomic():
+                    self.import_batch(batch, result)
+            except Exception:
+                self.rolled_back()
+                raise
+        if result.created + result.updated and not self.dry_run:
+            catalog_cache.forget(self.model._meta.model_name)
+            catalog_cache.forget('category')
+        return result
+
+    def parse(self, row):
+        values = {}
+        for column, value in row.items():
+            name = self.aliases.get((column or '').strip())
+            if name is None:
+                continue
+            field = self.model._meta.get_field(name)
+            if isinstance(value, str):
+                value = value.strip()
+                if field.get_internal_type() == 'BooleanField':
+                    value = BOOLEAN_WORDS.get(value.lower(), value)
+            if value in ('', None) and name not in self.required:
+                continue
+            values[name] = str(value) if field.is_relation else field.clean(value, None)
+        missing = [name for name in self.required if name not in values]
+        if missing:
+            raise ValidationError(f'Thiếu cột: {", ".join(missing)}')
+        return values
+
+    def import_batch(self, batch, result):
+        parsed = {}
+        for line, row in batch:
+            try:
+                values = self.parse(row)
+            except ValidationError as e:
+                result.error(line, '; '.join(e.messages))
+                continue
+            key = values[self.key]
+            if key in parsed:
+                result.error(parsed[key][0], f'Trùng mã "{key}" với dòng {line}, dùng dòng sau')
+            parsed[key] = (line, values)
+
+        existing = self.model._base_manager.filter(**{f'{self.key}__in': parsed})
+        existing = self.existing(existing if self.dry_run else existing.select_for_update())
+
+        objs, updated = [], 0
+        for key, (line, values) in parsed.items():
+            try:
+                obj = self.build(values, existing, result)
+                obj.clean()
+            except ValidationError as e:
+                result.error(line, '; '.join(e.messages))
+                continue
+            objs.append(obj)
+            updated += key in existing
+        if objs and not self.dry_run:
+            self.model._base_manager.bulk_create(objs, update_conflicts=True, unique_fields=[self.key],
+                                                 update_fields=self.update_fields)
+            self.written(objs)
+        result.updated += updated
+        result.created += len(objs) - updated
+
+    def written(self, objs):
+        """Hook run in the batch's transaction after its rows are written."""
+        # bulk_create sends no post_save: reindex the rows of the batch for search
+        keys = [getattr(obj, self.key) for obj in objs]
+        pks = self.model._base_manager.filter(**{f'{self.key}__in': keys}).values_list('pk', flat=True)
+        search_backend().rebuild(self.model._meta.model_name, list(pks))
+
+    def rolled_back(self):
+        """Hook run when a batch's transaction was rolled back: forget what it cached."""
+
+    def existing(self, queryset):
+        """{key: state needed by build()} for the rows of the batch already in the database."""
+        return dict.fromkeys(queryset.values_list(self.key, flat=True))
+
+    def build(self, values, existing, result):
+        return self.model(**values)
+
+
+class BookImporter(CatalogImporter):
+    model, key = Book, 'code'
+    fields = ['code', 'title', 'category', 'author', 'publisher', 'price', 'total_quantity', 'available',
+              'is_active']
+    required = ['code', 'title', 'category', 'author', 'publisher', 'price', 'total_quantity']
+    update_fields = ['title', 'category', 'author', 'publisher', 'price', 'total_quantity', 'available',
+                     'is_active', 'modified_at', 'version']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = None
+
+    def category_id(self, name, result):
+        if self.categories is None:
+            self.categories = {}
+            for pk, existing in Category.objects.order_by('pk').values_list('pk', 'name'):
+                self.categories.setdefault(existing, pk)
+        if name not in self.categories:
+            Category._meta.get_field('name').clean(name, None)
+            result.new_categories.add(name)
+            self.categories[name] = None if self.dry_run else Category.objects.create(name=name).pk
+        return self.categories[name]
+
+    def rolled_back(self):
+        # Categories created by the batch are gone with it
+        self.categories = None
+
+    def written(self, objs):
+        super().written(objs)
+        # bulk_create bypasses Book.save(): move the snapshots from the locked rows to the written ones.
+        # The upsert leaves the loan and hold counters alone.
+        move_stock([self.before[book.code] for book in objs if book.code in self.before], [
+            book.stock()._replace(active_loans=self.before[book.code].active_loans,
+                                  reserved=self.before[book.code].reserved) if book.code in self.before
+            else book.stock()
+            for book in objs
+        ])
+
+    def existing(self, queryset):
+        rows = list(queryset.values_list('code', 'version', *BookStock._fields))
+        self.before = {code: BookStock(*state) for code, _, *state in rows}
+        return {code: (state.active_loans + state.reserved, version, state.is_active)
+                for (code, version, *_), state in zip(rows, self.before.values())}
+
+    def build(self, values, existing, result):
+        total = values['total_quantity']
+        if values['code'] in existing:
+            # Copies out on loan or held for a reader stay off the shelf: only the shelf count follows the new total
+            taken, version, is_active = existing[values['code']]
+            if total < taken:
+                raise ValidationError(f'Tổng số lượng nhỏ hơn số đang cho mượn và giữ chỗ ({taken})')
+            values['available'] = total - taken
+            # The rows are locked, so the next version is known; a desk editing the book must reload
+            values['version'] = version + 1
+            # The upsert writes every update field: a file without the column keeps the book as it is
+            values.setdefault('is_active', is_active)
+        values.setdefault('available', total)
+        values['category_id'] = self.category_id(values.pop('category'), result)
+        return Book(**values)
+
+
+class ReaderImporter(CatalogImporter):
+    model, key = Reader, 'card_id'
+    fields = required = ['card_id', 'full_name', 'phone']
+    update_fields = ['full_name', 'phone']
+
+
+IMPORTERS = {'book': BookImporter, 'reader': ReaderImporter}
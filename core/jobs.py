@@ -0,0 +1,193 @@
+import os
+import traceback
+from datetime import date, timedelta
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .archive import archive_loans as archive
+from .exports import csv_lines, export_rows, write_xlsx
+from .holds import expire_holds
+from .models import Job
+from .reports import build_rollups
+from .services import LoanService, chunked
+
+# name: callable(job, **params) returning a JSON-serializable result
+TASKS = {}
+
+
+def task(name):
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def output_dir():
+    path = Path(getattr(settings, 'LIBRARY_JOB_OUTPUT_DIR', Path(settings.BASE_DIR) / 'job_output'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def enqueue(name, user=None, max_attempts=None, **params):
+    """Queue ``name`` with JSON ``params`` for the workers and return the Job."""
+    if name not in TASKS:
+        raise ValueError(f'Tác vụ không tồn tại: {name}')
+    return Job.objects.create(task=name, params=params, created_by=user,
+                              max_attempts=max_attempts or getattr(settings, 'LIBRARY_JOB_MAX_ATTEMPTS', 3))
+
+
+def claim(worker, limit=1):
+    """Take up to ``limit`` due jobs for ``worker``, oldest first.
+
+    Each job is taken with an UPDATE guarded on status='queued', so two
+    workers polling the same table never run the same job.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status='queued', run_after__lte=now).order_by('run_after', 'id')
+    claimed = []
+    for pk in due.values_list('pk', flat=True)[:limit * 2]:
+        if Job.objects.filter(pk=pk, status='queued').update(
+                status='running', worker=worker, attempts=F('attempts') + 1, started_at=now, heartbeat=now):
+            claimed.append(pk)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def beat(pks):
+    if pks:
+        Job.objects.filter(pk__in=pks, status='running').update(heartbeat=timezone.now())
+
+
+def release(worker, pks):
+    """Give jobs ``worker`` claimed but never started back to the queue, along with their attempt."""
+    if pks:
+        Job.objects.filter(pk__in=pks, status='running', worker=worker).update(
+            status='queued', worker='', attempts=F('attempts') - 1, started_at=None, run_after=timezone.now())
+
+
+def requeue_stale(after=None):
+    """Give jobs of workers that stopped beating back to the queue, or fail them when out of attempts."""
+    after = after or timedelta(seconds=getattr(settings, 'LIBRARY_JOB_STALE_AFTER', 600))
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', heartbeat__lt=now - after)
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='failed', error='Worker ngừng phản hồi', worker='', finished_at=now)
+    return failed + stale.update(status='queued', worker='', run_after=now)
+
+
+def run_job(pk):
+    """Run one claimed job and record its result; failures are retried with a doubling delay."""
+    job = Job.objects.get(pk=pk)
+    # Written only while this run still owns the job: if it was requeued as stale meanwhile, the
+    # run that claimed it again (another worker, or a later attempt) records the outcome instead
+    running = job.owned()
+    try:
+        func = TASKS[job.task]
+    except KeyError:
+        running.update(status='failed', error=f'Tác vụ không tồn tại: {job.task}', finished_at=timezone.now())
+        return
+    try:
+        result = func(job, **job.params)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            delay = getattr(settings, 'LIBRARY_JOB_RETRY_DELAY', 30) * 2 ** (job.attempts - 1)
+            running.update(status='queued', error=error, worker='',
+                           run_after=timezone.now() + timedelta(seconds=delay))
+        else:
+            running.update(status='failed', error=error, finished_at=timezone.now())
+    else:
+        running.update(status='done', result=result, error='', finished_at=timezone.now())
+
+
+def work(pk):
+    # Pool entry point: each thread or process keeps its own connection, dropped when stale
+    close_old_connections()
+    try:
+        run_job(pk)
+    finally:
+        close_old_connections()
+
+
+@task('bulk_return')
+def bulk_return(job, loan_ids, return_date=None):
+    return_date = date.fromisoformat(return_date) if return_date else None
+    returned = 0
+    for i, batch in enumerate(chunked(loan_ids, LoanService.batch_size)):
+        returned += LoanService.bulk_return(batch, return_date)
+        job.report(min((i + 1) * LoanService.batch_size, len(loan_ids)), len(loan_ids),
+                   f'Đã trả {returned:,} phiếu mượn')
+    return {'returned': returned}
+
+
+@task('rebuild_counters')
+def rebuild_counters(job):
+    # Also reconciles the unpaid damage totals of every reader
+    out = StringIO()
+    call_command('rebuild_counters', stdout=out)
+    return {'output': out.getvalue()}
+
+
+@task('rollup')
+def rollup(job, until=None, rebuild=False):
+    return {'days': build_rollups(date.fromisoformat(until) if until else None, rebuild=rebuild)}
+
+
+@task('rebuild_search_index')
+def rebuild_search_index(job):
+    call_command('rebuild_search_index', stdout=StringIO())
+
+
+@task('send_reminders')
+def send_reminders(job):
+    out = StringIO()
+    call_command('send_reminders', stdout=out)
+    return {'output': out.getvalue()}
+
+
+@task('archive_loans')
+def archive_loans(job, before=None):
+    def progress(loans, damages):
+        job.report(loans, message=f'Đã lưu trữ {loans:,} phiếu mượn, {damages:,} hư hỏng')
+
+    loans, damages = archive(date.fromisoformat(before) if before else None, progress=progress)
+    return {'loans': loans, 'damages': damages}
+
+
+@task('expire_holds')
+def expire(job):
+    return {'expired': expire_holds()}
+
+
+@task('export')
+def export(job, kind, fmt='csv', query='', user_id=None):
+    """Write an admin changelist export (same filters and search as ``query``) to LIBRARY_JOB_OUTPUT_DIR."""
+    from .admin import export_queryset
+    queryset = export_queryset(kind, query, user_id)
+    total = queryset.count()
+    job.report(0, total)
+
+    def counted(rows, every=2000):
+        yield next(rows)  # header
+        for n, row in enumerate(rows, 1):
+            yield row
+            if n % every == 0:
+                job.report(n, message=f'Đã ghi {n:,} dòng')
+
+    filename = f'{kind}s-{job.pk}.{fmt}'
+    target = output_dir() / filename
+    rows = counted(export_rows(kind, queryset))
+    if fmt == 'xlsx':
+        write_xlsx(rows, target)
+    else:
+        with open(target, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(csv_lines(rows))
+    job.report(total)
+    return {'file': filename, 'rows': total, 'size': os.path.getsize(target)}
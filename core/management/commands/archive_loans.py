@@ -0,0 +1,25 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.archive import BATCH_SIZE, archive_loans, horizon
+
+
+class Command(BaseCommand):
+    help = 'Move returned loans older than LIBRARY_ARCHIVE_AFTER_DAYS and their paid damages to the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive loans returned more than this many days ago')
+        parser.add_argument('--before', type=date.fromisoformat, help='Archive loans returned before this day')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Loans moved per transaction')
+
+    def handle(self, *args, days, before, batch_size, **options):
+        if before is None:
+            before = date.today() - timedelta(days=days) if days is not None else horizon()
+
+        def progress(loans, damages):
+            self.stdout.write(f'  {loans:,} phiếu mượn, {damages:,} hư hỏng')
+
+        loans, damages = archive_loans(before, batch_size, progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Đã lưu trữ {loans:,} phiếu mượn trả trước {before:%d/%m/%Y} và {damages:,} hư hỏng'))
@@ -0,0 +1,210 @@
+import json
+import statistics
+import time
+from collections import Counter
+from contextlib import nullcontext
+from datetime import date, datetime
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+
+from core import cache as catalog_cache
+from core.admin import LoanAdmin
+from core.models import Book, Reader, Loan, Damage
+
+
+def sort_by(model_admin, column, descending=False):
+    """The changelist ``o`` parameter sorting by ``column``, counting the action_checkbox column in front."""
+    index = model_admin.list_display.index(column) + (model_admin.actions is not None)
+    return f'o={"-" if descending else ""}{index}'
+
+
+def admin_cases():
+    """(name, url) for the changelists, searches, filters and change views of the core admins."""
+    reader = Reader.objects.order_by('-active_loans', 'pk').first()
+    book = Book.all_objects.order_by('-loan_count', 'pk').first()
+    loan = Loan.objects.order_by('-pk').first()
+    damage = Damage.objects.order_by('-pk').first()
+    cases = []
+    for model in ('book', 'reader', 'loan', 'damage'):
+        cases.append((f'{model}_changelist', reverse(f'admin:core_{model}_changelist')))
+    cases += [
+        ('book_search', reverse('admin:core_book_changelist') + '?q=Dế+Mèn'),
+        ('reader_search', reverse('admin:core_reader_changelist') + '?q=Nguyễn'),
+        ('loan_search', reverse('admin:core_loan_changelist') + '?q=Nguyễn'),
+        ('damage_search', reverse('admin:core_damage_changelist') + '?q=Số+Đỏ'),
+        ('book_filter_category', reverse('admin:core_book_changelist') + f'?category__id__exact={book.category_id}'
+         if book else None),
+        ('reader_filter_debt', reverse('admin:core_reader_changelist') + '?debt=damages'),
+        ('loan_filter_status', reverse('admin:core_loan_changelist') + '?status__exact=borrowing'),
+        ('loan_sort_fine', reverse('admin:core_loan_changelist') + '?' + sort_by(LoanAdmin, 'display_fine')),
+        ('damage_filter_unpaid', reverse('admin:core_damage_changelist') + '?is_paid__exact=0'),
+    ]
+    for name, obj in (('book', book), ('reader', reader), ('loan', loan), ('damage', damage)):
+        if obj:
+            cases.append((f'{name}_change', reverse(f'admin:core_{name}_change', args=[obj.pk])))
+    return [(name, url) for name, url in cases if url]
+
+
+def write_cases():
+    """(name, callable) exercising Loan.save() and Damage.save(); each run is rolled back."""
+    reader = Reader.objects.order_by('pk').first()
+    book = Book.objects.filter(available__gt=0).order_by('pk').first()
+    if not (reader and book):
+        return []
+
+    def checkout():
+        Loan.objects.create(reader=reader, book=book)
+
+    def checkout_and_return():
+        loan = Loan.objects.create(reader=reader, book=book)
+        loan.status, loan.return_date = 'returned', date.today()
+        loan.save()
+
+    def report_damage():
+        loan = Loan.objects.create(reader=reader, book=book)
+        Damage.objects.create(loan=loan, damage_type='minor')
+
+    return [('loan_checkout', checkout), ('loan_return', checkout_and_return), ('damage_report', report_damage)]
+
+
+class QueryCounter:
+    # An execute wrapper instead of CaptureQueriesContext: its log is capped at 9000 queries
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Time and query-count the admin pages and circulation write paths, writing the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='',
+                            help='Comma-separated loan counts; each builds a scratch database with generate_library. '
+                                 'Without it the current database is measured.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', help='Write results to this JSON file')
+        parser.add_argument('--thresholds',
+                            help='JSON file of {"case": {"max_ms": .., "max_queries": ..}}; "*" applies to all cases')
+        parser.add_argument('--baseline', help='Earlier --output file to compare against')
+        parser.add_argument('--max-regression', type=float, default=1.5,
+                            help='Fail when a case is this many times slower than the baseline')
+
+    def handle(self, *args, sizes, seed, repeat, output, thresholds, baseline, max_regression, **options):
+        self.repeat = repeat
+        results = {}
+        if sizes:
+            for size in [int(s) for s in sizes.split(',')]:
+                results[str(size)] = self.run_scratch(size, seed)
+        else:
+            results['current'] = self.run_cases()
+
+        report = {'created': datetime.now().isoformat(timespec='seconds'), 'django': django.get_version(),
+                  'repeat': repeat, 'results': results}
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+        failures = []
+        if thresholds:
+            with open(thresholds, encoding='utf-8') as f:
+                failures += self.check_thresholds(results, json.load(f))
+        if baseline:
+            with open(baseline, encoding='utf-8') as f:
+                failures += self.check_baseline(results, json.load(f)['results'], max_regression)
+        if failures:
+            raise CommandError('Benchmark vượt ngưỡng:\n' + '\n'.join(failures))
+
+    def run_scratch(self, loans, seed):
+        self.stdout.write(f'\n== {loans:,} phiếu mượn ==')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            call_command('generate_library', books=max(loans // 20, 1), readers=max(loans // 40, 1), loans=loans,
+                         seed=seed, stdout=self.stdout)
+            return self.run_cases()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run_cases(self):
+        user = User.objects.filter(is_superuser=True).first()
+        temp_user = user is None
+        if temp_user:
+            user = User.objects.create_superuser('bench', 'bench@example.com', None)
+        client = Client(SERVER_NAME='localhost')
+        client.force_login(user)
+        try:
+            results = {}
+            for name, url in admin_cases():
+                results[name] = self.measure(lambda: self.get(client, url))
+                self.report(name, results[name])
+            for name, func in write_cases():
+                results[name] = self.measure(func, rollback=True)
+                self.report(name, results[name])
+            return results
+        finally:
+            client.logout()
+            if temp_user:
+                user.delete()
+
+    @staticmethod
+    def get(client, url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError(f'{url} trả về {response.status_code}')
+
+    def measure(self, func, rollback=False):
+        timings, queries = [], 0
+        for _ in range(self.repeat):
+            counter, cached = QueryCounter(), Counter(catalog_cache.metrics)
+            with connection.execute_wrapper(counter), transaction.atomic() if rollback else nullcontext():
+                start = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - start) * 1000)
+                if rollback:
+                    transaction.set_rollback(True)
+            queries = counter.count
+        # Cache lookups of the last (warm) run
+        cached = catalog_cache.metrics - cached
+        return {'ms': round(statistics.median(timings), 2), 'min_ms': round(min(timings), 2), 'queries': queries,
+                'cache_hits': sum(n for key, n in cached.items() if key.endswith('.hit')),
+                'cache_misses': sum(n for key, n in cached.items() if key.endswith('.miss'))}
+
+    def report(self, name, result):
+        self.stdout.write(f'{name:<24}{result["ms"]:>10.2f} ms{result["queries"]:>6} queries'
+                          f'{result["cache_hits"]:>7} hits{result["cache_misses"]:>5} misses')
+
+    @staticmethod
+    def check_thresholds(results, thresholds):
+        failures = []
+        for size, cases in results.items():
+            for name, result in cases.items():
+                limits = {**thresholds.get('*', {}), **thresholds.get(name, {})}
+                if 'max_ms' in limits and result['ms'] > limits['max_ms']:
+                    failures.append(f'[{size}] {name}: {result["ms"]} ms > {limits["max_ms"]} ms')
+                if 'max_queries' in limits and result['queries'] > limits['max_queries']:
+                    failures.append(f'[{size}] {name}: {result["queries"]} queries > {limits["max_queries"]}')
+        return failures
+
+    @staticmethod
+    def check_baseline(results, baseline, max_regression):
+        failures = []
+        for size, cases in results.items():
+            for name, result in cases.items():
+                before = baseline.get(size, {}).get(name)
+                if not before:
+                    continue
+                if result['queries'] > before['queries']:
+                    failures.append(f'[{size}] {name}: {before["queries"]} -> {result["queries"]} queries')
+                if before['ms'] and result['ms'] > before['ms'] * max_regression:
+                    failures.append(f'[{size}] {name}: {before["ms"]} -> {result["ms"]} ms')
+        return failures
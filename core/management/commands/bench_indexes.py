@@ -0,0 +1,73 @@
+import statistics
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from core.management.utils import dropped_indexes
+from core.models import Book, Reader, Loan, Damage
+
+
+def circulation_queries():
+    """The filters LoanAdmin, DamageAdmin, the reader history and the book dropdown run."""
+    today = date.today()
+    reader_id = (Reader.objects.order_by('-active_loans').values_list('pk', flat=True).first() or 0)
+    category_id = (Book.objects.values('category').annotate(n=Count('pk')).order_by('-n')
+                   .values_list('category', flat=True).first() or 0)
+    return {
+        'loan_overdue': Loan.objects.filter(status='borrowing', due_date__lt=today).order_by('due_date')[:100],
+        'loan_status': Loan.objects.filter(status='returned').order_by('-borrow_date')[:100],
+        'loan_borrow_month': Loan.objects.filter(borrow_date__gte=today - timedelta(days=30))[:100],
+        'loan_due_week': Loan.objects.filter(due_date__range=(today, today + timedelta(days=7)))[:100],
+        'reader_history': Loan.objects.filter(reader_id=reader_id).history()[:50],
+        'book_active_loans': Loan.objects.filter(book_id__in=Book.objects.values('pk')[:20], status='borrowing'),
+        'damage_unpaid': Damage.objects.filter(is_paid=False).values('loan').order_by()[:100],
+        'damage_paid_recent': Damage.objects.filter(is_paid=True)[:100],
+        'damage_lost': Damage.objects.filter(damage_type='lost')[:100],
+        'book_dropdown': Book.objects.filter(category_id=category_id).order_by('title')[:100],
+    }
+
+
+def time_query(queryset, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(queryset.all())
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = 'Show query plans and timings of the circulation queries, optionally without the designed indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--compare', action='store_true',
+                            help='Drop the Meta.indexes first, measure, recreate them and measure again')
+        parser.add_argument('--plans', action='store_true', help='Print EXPLAIN output for each query')
+
+    def handle(self, *args, repeat, compare, plans, **options):
+        self.stdout.write(f'Loans: {Loan.objects.count():,}  Damages: {Damage.objects.count():,}  '
+                          f'Books: {Book.all_objects.count():,}  Readers: {Reader.objects.count():,}')
+        before = None
+        if compare:
+            with dropped_indexes(Book, Loan, Damage):
+                before = self.measure(repeat, plans, 'không index')
+        after = self.measure(repeat, plans, 'có index')
+
+        self.stdout.write(f'\n{"query":<22}{"trước (ms)":>14}{"sau (ms)":>12}{"x":>8}')
+        for name, ms in after.items():
+            if before:
+                speedup = before[name] / ms if ms else 0
+                self.stdout.write(f'{name:<22}{before[name]:>14.2f}{ms:>12.2f}{speedup:>8.1f}')
+            else:
+                self.stdout.write(f'{name:<22}{"-":>14}{ms:>12.2f}{"-":>8}')
+
+    def measure(self, repeat, plans, label):
+        results = {}
+        for name, queryset in circulation_queries().items():
+            if plans:
+                self.stdout.write(f'\n[{label}] {name}\n{queryset.explain()}')
+            results[name] = time_query(queryset, repeat)
+        return results
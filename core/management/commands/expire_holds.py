@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.holds import BATCH_SIZE, expire_holds
+
+
+class Command(BaseCommand):
+    help = 'Expire holds whose copy was not picked up in time and give the copies to the next readers in the queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Holds expired per transaction')
+
+    def handle(self, *args, batch_size, **options):
+        expired = expire_holds(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Đã hủy {expired:,} lượt đặt trước quá hạn nhận sách'))
@@ -0,0 +1,5 @@
+from core.exports import ExportCommand
+
+
+class Command(ExportCommand):
+    kind = 'damage'
@@ -0,0 +1,226 @@
+import random
+import time
+from contextlib import nullcontext
+from array import array
+from datetime import date, timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from core import cache as catalog_cache
+from core.management.utils import dropped_indexes
+from core.models import (Category, Book, Reader, Loan, Damage, Hold, ArchivedLoan, ArchivedDamage, DailyBookStat,
+                         DailyCategoryStat, Reminder, LOAN_PERIOD, refresh_stock)
+from core.services import chunked
+
+CATEGORIES = ['Văn học', 'Khoa học tự nhiên', 'Thiếu nhi', 'Lịch sử', 'Kinh tế', 'Tin học',
+              'Ngoại ngữ', 'Triết học', 'Y học', 'Nghệ thuật']
+TITLE_HEADS = ['Dế Mèn', 'Tuổi Thơ', 'Đất Rừng', 'Những Ngày', 'Bến Quê', 'Mùa Lá Rụng', 'Số Đỏ',
+               'Giáo Trình', 'Nhập Môn', 'Cơ Sở', 'Lược Sử', 'Hành Trình', 'Chuyện Kể', 'Nỗi Buồn']
+TITLE_TAILS = ['Phiêu Lưu Ký', 'Dữ Dội', 'Phương Nam', 'Thơ Ấu', 'Trong Vườn', 'Chiến Tranh', 'Việt Nam',
+               'Đại Cương', 'Lập Trình', 'Kinh Tế Học', 'Vật Lý', 'Hà Nội', 'Sài Gòn', 'Miền Tây']
+SURNAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ']
+MIDDLE_NAMES = ['Văn', 'Thị', 'Hữu', 'Minh', 'Thanh', 'Ngọc', 'Đức', 'Thu', 'Quốc', 'Hoài']
+GIVEN_NAMES = ['An', 'Bình', 'Chi', 'Dũng', 'Hà', 'Hải', 'Hoa', 'Hùng', 'Lan', 'Linh', 'Mai', 'Nam',
+               'Phúc', 'Quân', 'Tâm', 'Thảo', 'Trang', 'Tuấn', 'Vy', 'Yến']
+PUBLISHERS = ['NXB Kim Đồng', 'NXB Văn học', 'NXB Giáo dục', 'NXB Trẻ', 'NXB Hội Nhà văn',
+              'NXB Tổng hợp TP.HCM', 'NXB Khoa học và Kỹ thuật', 'NXB Chính trị Quốc gia']
+DAMAGE_TYPES = ['lost', 'torn', 'water_damaged', 'minor']
+DAMAGE_WEIGHTS = [1, 2, 2, 5]
+
+
+def insert_rows(cursor, model, fields, rows):
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(model._meta.get_field(name).column) for name in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    cursor.executemany(f'INSERT INTO {qn(model._meta.db_table)} ({columns}) VALUES ({placeholders})', rows)
+
+
+def person_name(rng):
+    return f'{rng.choice(SURNAMES)} {rng.choice(MIDDLE_NAMES)} {rng.choice(GIVEN_NAMES)}'
+
+
+def iter_books(seed, count):
+    """Book field values; re-running with the same seed yields the same catalog."""
+    rng = random.Random(f'{seed}-books')
+    for i in range(count):
+        yield {
+            'title': f'{rng.choice(TITLE_HEADS)} {rng.choice(TITLE_TAILS)}' + (f' Tập {i % 7 + 1}' if i % 3 == 0 else ''),
+            'category': rng.randrange(len(CATEGORIES)),
+            'author': person_name(rng),
+            'publisher': rng.choice(PUBLISHERS),
+            'price': rng.randrange(20, 400) * 1000,
+            'total_quantity': rng.randint(1, 20),
+        }
+
+
+class LoanHistory:
+    """Replays a seeded loan/damage history while tracking the per-book and per-reader counters.
+
+    Memory is bounded by the catalog and roster size, never by the number of
+    loans: iterating twice with the same seed yields identical rows, so the
+    counters of a first pass can be written with the books before the second
+    pass streams the loans in.
+    """
+
+    def __init__(self, seed, prices, totals, readers, loans, years, damage_rate, today):
+        self.seed, self.prices, self.loans = seed, prices, loans
+        self.readers, self.years, self.damage_rate, self.today = readers, years, damage_rate, today
+        self.total = array('q', totals)
+        self.loan_count, self.active = array('q', [0]) * len(totals), array('q', [0]) * len(totals)
+        self.reader_active = array('q', [0]) * readers
+        self.unpaid_damages = array('q', [0]) * readers
+        self.unpaid_total = array('q', [0]) * readers
+
+    def __iter__(self):
+        """Yield (book, reader, borrow_date, due_date, return_date, status, damage-or-None)."""
+        rng = random.Random(f'{self.seed}-loans')
+        books, span = len(self.total), self.years * 365
+        for _ in range(self.loans):
+            b, r = rng.randrange(books), rng.randrange(self.readers)
+            borrow_date = self.today - timedelta(days=rng.randrange(span))
+            due_date = borrow_date + LOAN_PERIOD
+            age = (self.today - borrow_date).days
+            p_open = 0.7 if age <= 28 else 0.05 if age <= 120 else 0
+            return_date = min(borrow_date + timedelta(days=rng.randint(1, 21)), self.today)
+            self.loan_count[b] += 1
+
+            if rng.random() < p_open and self.active[b] < self.total[b]:
+                self.active[b] += 1
+                self.reader_active[r] += 1
+                yield b, r, borrow_date, due_date, None, 'borrowing', None
+                continue
+
+            damage = None
+            if rng.random() < self.damage_rate:
+                damage_type = rng.choices(DAMAGE_TYPES, DAMAGE_WEIGHTS)[0]
+                if damage_type == 'lost':
+                    if self.total[b] > self.active[b]:
+                        self.total[b] -= 1
+                    else:
+                        damage_type = 'torn'
+                fee = Damage.default_fee(damage_type, self.prices[b])
+                is_paid = rng.random() < 0.8
+                if not is_paid:
+                    self.unpaid_damages[r] += 1
+                    self.unpaid_total[r] += fee
+                damage = (damage_type, fee, is_paid)
+            yield b, r, borrow_date, due_date, return_date, 'returned', damage
+
+
+class Command(BaseCommand):
+    help = 'Generate a large, reproducible Vietnamese library dataset for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--readers', type=int, default=500)
+        parser.add_argument('--loans', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--years', type=int, default=3, help='Length of the loan history')
+        parser.add_argument('--damage-rate', type=float, default=0.02)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--clear', action='store_true', help='Delete all library data first')
+        parser.add_argument('--keep-indexes', action='store_true',
+                            help='Maintain the Loan/Damage indexes row by row instead of rebuilding them after the load')
+
+    def handle(self, *args, books, readers, loans, seed, years, damage_rate, batch_size, clear, keep_indexes,
+               **options):
+        if loans and not (books and readers):
+            raise CommandError('Cần ít nhất một sách và một bạn đọc để tạo phiếu mượn')
+        self.batch_size = batch_size
+        started = time.perf_counter()
+        if clear:
+            self.clear()
+
+        categories = [Category.objects.get_or_create(name=name)[0].pk for name in CATEGORIES]
+        book_base = self.next_pk(Book.all_objects)
+        reader_base = self.next_pk(Reader.objects)
+        loan_base = self.next_pk(Loan.objects, ArchivedLoan.objects)
+
+        # First pass: catalog attributes and the counters the history will produce
+        prices, totals = array('q'), array('q')
+        for row in iter_books(seed, books):
+            prices.append(row['price'])
+            totals.append(row['total_quantity'])
+        history = LoanHistory(seed, prices, totals, readers, loans, years, damage_rate, date.today())
+        for _ in history:
+            pass
+
+        self.insert(Book, (
+            Book(pk=book_base + i, code=f'S{book_base + i:08d}', title=row['title'],
+                 category_id=categories[row['category']], author=row['author'], publisher=row['publisher'],
+                 price=row['price'], total_quantity=history.total[i],
+                 available=history.total[i] - history.active[i], loan_count=history.loan_count[i],
+                 active_loans=history.active[i])
+            for i, row in enumerate(iter_books(seed, books))
+        ))
+        reader_rng = random.Random(f'{seed}-readers')
+        self.insert(Reader, (
+            Reader(pk=reader_base + i, card_id=f'R{reader_base + i:08d}', full_name=person_name(reader_rng),
+                   phone=f'09{reader_rng.randrange(10 ** 8):08d}', active_loans=history.reader_active[i],
+                   unpaid_damages=history.unpaid_damages[i], unpaid_total=history.unpaid_total[i])
+            for i in range(readers)
+        ))
+
+        # Second pass: same seed, same rows, streamed straight into the loan and damage tables
+        history = LoanHistory(seed, prices, totals, readers, loans, years, damage_rate, date.today())
+        with nullcontext() if keep_indexes else dropped_indexes(Loan, Damage):
+            damages = self.insert_history(history, book_base, reader_base, loan_base)
+
+        self.reset_sequences()
+        refresh_stock()
+        call_command('rebuild_search_index', stdout=self.stdout)
+        catalog_cache.forget_all()
+        self.stdout.write(self.style.SUCCESS(
+            f'Đã tạo {books:,} sách, {readers:,} bạn đọc, {loans:,} phiếu mượn, {damages:,} hư hỏng '
+            f'trong {time.perf_counter() - started:.1f}s'))
+
+    def insert_history(self, history, book_base, reader_base, loan_base):
+        # executemany skips the per-object model/compiler work that dominates bulk_create at this volume
+        adapt = connection.ops.adapt_datefield_value
+        damages = 0
+        for batch in chunked(enumerate(history), self.batch_size):
+            with transaction.atomic(), connection.cursor() as cursor:
+                insert_rows(cursor, Loan, ['id', 'book', 'reader', 'borrow_date', 'due_date', 'return_date', 'status'], [
+                    (loan_base + j, book_base + b, reader_base + r, adapt(borrowed), adapt(due), adapt(returned), status)
+                    for j, (b, r, borrowed, due, returned, status, _) in batch
+                ])
+                rows = [(loan_base + j, damage[0], damage[1], damage[2], adapt(returned), '')
+                        for j, (_, _, _, _, returned, _, damage) in batch if damage]
+                insert_rows(cursor, Damage, ['loan', 'damage_type', 'compensation_fee', 'is_paid', 'reported_date',
+                                             'notes'], rows)
+                damages += len(rows)
+        return damages
+
+    def insert(self, model, objs):
+        for batch in chunked(objs, self.batch_size):
+            with transaction.atomic():
+                model._base_manager.bulk_create(batch)
+
+    @staticmethod
+    def next_pk(*managers):
+        # Archived loans keep their ids, so loan ids continue after both tables
+        return max(manager.aggregate(m=Max('pk'))['m'] or 0 for manager in managers) + 1
+
+    @staticmethod
+    def clear():
+        # Raw DELETEs: the ORM would collect millions of rows to check PROTECT relations.
+        # The rollups describe the deleted history; left behind, the next rollup would start after them.
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (Hold, ArchivedDamage, ArchivedLoan, Damage, Loan, DailyBookStat, DailyCategoryStat, Reminder,
+                          Book, Reader):
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
+
+    @staticmethod
+    def reset_sequences():
+        statements = connection.ops.sequence_reset_sql(no_style(), [Book, Reader, Loan])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+            # The reset follows the live table only (SQLite resets nothing: its AUTOINCREMENT counter never goes back)
+            if connection.vendor == 'postgresql' and ArchivedLoan.objects.exists():
+                last = Command.next_pk(Loan.objects, ArchivedLoan.objects) - 1
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [Loan._meta.db_table, last])
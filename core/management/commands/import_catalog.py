@@ -0,0 +1,29 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.imports import IMPORTERS, guess_format, read_records
+
+
+class Command(BaseCommand):
+    help = 'Import or update books (keyed on code) or readers (keyed on card_id) from CSV, JSON or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORTERS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'json', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--dry-run', action='store_true', help='Validate and report without writing')
+
+    def handle(self, *args, kind, path, format, batch_size, dry_run, **options):
+        importer = IMPORTERS[kind](batch_size=batch_size, dry_run=dry_run)
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as f:
+                result = importer.run(read_records(f, format or guess_format(path)))
+        except (OSError, ValueError, csv.Error) as e:
+            raise CommandError(str(e))
+        for line, message in result.errors:
+            self.stderr.write(f'Dòng {line}: {message}')
+        if result.failed > len(result.errors):
+            self.stderr.write(f'... và {result.failed - len(result.errors):,} lỗi khác')
+        self.stdout.write(self.style.SUCCESS(str(result)))
@@ -0,0 +1,89 @@
+import json
+import math
+import sqlite3
+from collections import Counter, defaultdict
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def read_sqlite(path, since):
+    with closing(sqlite3.connect(path)) as db:
+        db.row_factory = sqlite3.Row
+        try:
+            rows = db.execute('SELECT * FROM perf_request WHERE ts >= ?', [since])
+        except sqlite3.OperationalError as e:
+            raise CommandError(f'{path}: {e}')
+        for row in rows:
+            yield {**dict(row), 'duplicates': json.loads(row['duplicates'])}
+
+
+def read_log(path, since):
+    # One JSON record per line, possibly behind a logging prefix
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            start = line.find('{')
+            if start < 0:
+                continue
+            try:
+                record = json.loads(line[start:])
+            except ValueError:
+                continue
+            if record.get('ts', '') >= since:
+                yield record
+
+
+class Command(BaseCommand):
+    help = 'Summarize the request records of PerfMiddleware: p50/p95/p99 latency and queries per view'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sink', help='SQLite sink to read (default: LIBRARY_PERF_SINK)')
+        parser.add_argument('--log', help='Read a core.perf log file instead of the SQLite sink')
+        parser.add_argument('--hours', type=float, help='Only requests of the last N hours')
+        parser.add_argument('--top', type=int, default=5, help='Repeated statements to list')
+
+    def handle(self, *args, sink, log, hours, top, **options):
+        since = (datetime.now() - timedelta(hours=hours)).isoformat(timespec='seconds') if hours else ''
+        if log:
+            records = read_log(log, since)
+        else:
+            sink = sink or str(getattr(settings, 'LIBRARY_PERF_SINK', ''))
+            if not sink or sink == 'log':
+                raise CommandError('Cần --sink hoặc --log')
+            records = read_sqlite(sink, since)
+
+        per_view = defaultdict(lambda: {'ms': [], 'queries': [], 'sql_ms': [], 'n_plus_one': 0})
+        repeated = Counter()
+        for record in records:
+            view = per_view[record['view'] or record['path']]
+            view['ms'].append(record['ms'])
+            view['queries'].append(record['queries'])
+            view['sql_ms'].append(record['sql_ms'])
+            if record['duplicates']:
+                view['n_plus_one'] += 1
+                for n, sql in record['duplicates']:
+                    repeated[record['view'] or record['path'], sql] += n
+        if not per_view:
+            self.stdout.write('Chưa có số liệu.')
+            return
+
+        self.stdout.write(f'{"view":<44}{"n":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+                          f'{"p50 q":>7}{"p95 q":>7}{"p99 q":>7}{"N+1":>6}')
+        for name, view in sorted(per_view.items(), key=lambda item: -percentile(sorted(item[1]['ms']), 95)):
+            ms, queries = sorted(view['ms']), sorted(view['queries'])
+            self.stdout.write(
+                f'{name[:43]:<44}{len(ms):>7}'
+                + ''.join(f'{percentile(ms, p):>10.1f}' for p in (50, 95, 99))
+                + ''.join(f'{percentile(queries, p):>7}' for p in (50, 95, 99))
+                + f'{view["n_plus_one"]:>6}')
+        if repeated:
+            self.stdout.write('\nCâu lệnh lặp lại nhiều nhất (nghi N+1):')
+            for (name, sql), n in repeated.most_common(top):
+                self.stdout.write(f'{n:>7}  {name}: {sql[:200]}')
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Sum
+from django.utils import timezone
+
+from core.models import (Category, Book, Reader, Loan, Damage, ArchivedLoan, Hold, VersionedModel,
+                         correlated_aggregate, expected_stock, next_version)
+
+
+def expected_counters():
+    """(manager, {field: expression recomputing it from the source tables})."""
+    loans = Loan.objects.filter(book=OuterRef('pk'))
+    archived = ArchivedLoan.objects.filter(book=OuterRef('pk'))
+    ready = Hold.objects.filter(book=OuterRef('pk'), status='ready')
+    reader_loans = Loan.objects.filter(reader=OuterRef('pk'), status='borrowing')
+    unpaid = Damage.objects.filter(loan__reader=OuterRef('pk'), is_paid=False)
+    return [
+        (Book.all_objects, {
+            # Lifetime count: archived loans still count
+            'loan_count': (correlated_aggregate(loans, 'book', Count('pk'))
+                           + correlated_aggregate(archived, 'book', Count('pk'))),
+            'active_loans': correlated_aggregate(loans.filter(status='borrowing'), 'book', Count('pk')),
+            'reserved': correlated_aggregate(ready, 'book', Count('pk')),
+        }),
+        (Reader.objects, {
+            'active_loans': correlated_aggregate(reader_loans, 'reader', Count('pk')),
+            'unpaid_damages': correlated_aggregate(unpaid, 'loan__reader', Count('pk')),
+            'unpaid_total': correlated_aggregate(unpaid, 'loan__reader', Sum('compensation_fee')),
+        }),
+        # After Book: the availability snapshot sums the book counters rebuilt above
+        (Category.objects, expected_stock()),
+    ]
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the stored loan/debt counters on Book and Reader and the availability snapshot on Category, '
+            'or verify them with --check')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drift and exit with an error if any is found')
+
+    def handle(self, *args, check=False, **options):
+        drifted = 0
+        for manager, expected in expected_counters():
+            name = manager.model._meta.verbose_name
+            annotated = manager.annotate(**{f'expected_{field}': expr for field, expr in expected.items()})
+            for field in expected:
+                stale = annotated.filter(~Q(**{field: F(f'expected_{field}')})).count()
+                drifted += stale
+                if stale:
+                    self.stdout.write(self.style.WARNING(f'{name}.{field}: {stale} dòng lệch'))
+            if not check:
+                changes = dict(expected)
+                if issubclass(manager.model, VersionedModel):
+                    changes['version'] = next_version()
+                if manager.model is Category:
+                    changes['stock_changed_at'] = timezone.now()
+                with transaction.atomic():
+                    manager.update(**changes)
+
+        if check and drifted:
+            raise CommandError(f'Phát hiện {drifted} bộ đếm bị lệch')
+        self.stdout.write(self.style.SUCCESS('Đã kiểm tra bộ đếm' if check else 'Đã tính lại bộ đếm'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.search import INDEXED_FIELDS, search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the book/reader search index from the live tables (needed after bulk loads)'
+
+    def handle(self, *args, **options):
+        backend = search_backend()
+        backend.ensure_tables()
+        for kind in INDEXED_FIELDS:
+            backend.rebuild(kind)
+        self.stdout.write(self.style.SUCCESS(f'Đã dựng lại chỉ mục tìm kiếm ({type(backend).__name__})'))
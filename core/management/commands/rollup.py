@@ -0,0 +1,18 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from core.reports import build_rollups
+
+
+class Command(BaseCommand):
+    help = 'Roll up loans, returns, overdue loans, fines and damages per day, book and category (new days only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', type=date.fromisoformat, help='Last day to roll up (default: yesterday)')
+        parser.add_argument('--batch-days', type=int, default=7, help='Days written per transaction')
+        parser.add_argument('--rebuild', action='store_true', help='Drop the rollups and rebuild from the first loan')
+
+    def handle(self, *args, until, batch_days, rebuild, **options):
+        days = build_rollups(until=until, batch_days=batch_days, rebuild=rebuild)
+        self.stdout.write(self.style.SUCCESS(f'Đã tổng hợp {days:,} ngày'))
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (core.models.Job) on a pool of threads or processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Jobs run at the same time')
+        parser.add_argument('--processes', action='store_true',
+                            help='Run jobs in worker processes instead of threads (CPU-bound work)')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between queue polls when idle')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, workers, processes, poll, once, **options):
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        pool = self.make_pool(workers, processes)
+        self.stdout.write(f'{name}: {workers} {"tiến trình" if processes else "luồng"}, chờ tác vụ...')
+
+        running, finished = {}, 0
+        try:
+            while True:
+                claimed = []
+                try:
+                    for future in [f for f in running if f.done()]:
+                        del running[future]
+                        future.result()
+                        finished += 1
+                    # The supervisor beats for its jobs, so a dead worker's jobs go back to the queue
+                    jobs.beat(list(running.values()))
+                    jobs.requeue_stale()
+                    claimed = jobs.claim(name, workers - len(running)) if len(running) < workers else []
+                    submitted = bool(claimed)
+                    while claimed:
+                        # Off the list only once the pool took it
+                        future = pool.submit(jobs.work, claimed[0])
+                        running[future] = claimed.pop(0)
+                    if submitted:
+                        continue
+                    if once and not running:
+                        break
+                    if running:
+                        wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                    else:
+                        time.sleep(poll)
+                except BrokenExecutor:
+                    # A worker process died and the pool takes no more work. The jobs it held are no
+                    # longer beaten and go back to the queue as stale; the ones not handed over yet go now.
+                    self.stderr.write(traceback.format_exc())
+                    jobs.release(name, claimed)
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self.make_pool(workers, processes)
+                except Exception:
+                    # A lost connection or a crashed job must not stop the supervisor of the others
+                    self.stderr.write(traceback.format_exc())
+                    time.sleep(poll)
+        except KeyboardInterrupt:
+            self.stdout.write('Dừng nhận tác vụ, chờ các tác vụ đang chạy...')
+        finally:
+            pool.shutdown()
+        self.stdout.write(self.style.SUCCESS(f'Đã chạy {finished} tác vụ'))
+
+    @staticmethod
+    def make_pool(workers, processes):
+        if processes:
+            # Spawned children open their own connections instead of inheriting this one
+            connections.close_all()
+            return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=django.setup)
+        return ThreadPoolExecutor(workers, thread_name_prefix='job')
@@ -0,0 +1,36 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from core.reminders import CHUNK_SIZE, ConsoleSender, FileSender, get_sender, send_reminders
+
+
+class Command(BaseCommand):
+    help = 'Send one notice per reader listing their overdue and due-soon loans with the fines so far'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-before', type=int, default=2, help='Remind loans due within N days')
+        parser.add_argument('--date', type=date.fromisoformat, help='Run as of this day (default: today)')
+        parser.add_argument('--sender', help='Sender class path (default: LIBRARY_REMINDER_SENDER)')
+        parser.add_argument('--output', help='Write the notices to this file (FileSender)')
+        parser.add_argument('--console', action='store_true', help='Print the notices (ConsoleSender)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the notices to send')
+
+    def handle(self, *args, days_before, date, sender, output, console, chunk_size, dry_run, **options):
+        if output:
+            sender = FileSender(output)
+        elif console:
+            sender = ConsoleSender(self.stdout)
+        else:
+            sender = get_sender(sender)
+        started = time.perf_counter()
+        try:
+            stats = send_reminders(sender, date, days_before, chunk_size, dry_run)
+        finally:
+            sender.close()
+        self.stdout.write(self.style.SUCCESS(
+            f'{"[Chạy thử] " if dry_run else ""}{stats["readers"]:,} bạn đọc, {stats["loans"]:,} phiếu mượn: '
+            f'gửi {stats["sent"]:,}, đã gửi trước đó {stats["skipped"]:,}, lỗi {stats["failed"]:,} '
+            f'trong {time.perf_counter() - started:.1f}s'))
@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def dropped_indexes(*models):
+    """Drop the Meta.indexes of ``models`` for the duration of the block and recreate them after."""
+    indexes = [(model, index) for model in models for index in model._meta.indexes]
+    with connection.schema_editor() as editor:
+        for model, index in indexes:
+            editor.remove_index(model, index)
+    try:
+        yield indexes
+    finally:
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.add_index(model, index)
@@ -0,0 +1,124 @@
+import json
+import logging
+import random
+import sqlite3
+import time
+from collections import Counter
+from contextlib import ExitStack, closing, contextmanager
+from datetime import datetime
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('core.perf')
+
+SINK_SCHEMA = '''CREATE TABLE IF NOT EXISTS perf_request (
+    ts TEXT, method TEXT, path TEXT, view TEXT, status INTEGER, ms REAL, queries INTEGER, sql_ms REAL,
+    slowest TEXT, duplicates TEXT)'''
+
+
+class QueryRecorder:
+    """Execute wrapper timing every statement of a request, on any database alias."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append((sql, (time.perf_counter() - start) * 1000))
+
+
+def write_sqlite(path, record):
+    with closing(sqlite3.connect(path, timeout=5)) as db, db:
+        db.execute(SINK_SCHEMA)
+        db.execute('INSERT INTO perf_request VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            record['ts'], record['method'], record['path'], record['view'], record['status'], record['ms'],
+            record['queries'], record['sql_ms'], json.dumps(record['slowest'], ensure_ascii=False),
+            json.dumps(record['duplicates'], ensure_ascii=False)])
+
+
+class PerfMiddleware:
+    """Record query count, SQL time, the slowest statements and repeated statements (likely N+1) per request.
+
+    Settings: LIBRARY_PERF_SAMPLE_RATE (0..1, 0 disables), LIBRARY_PERF_SINK ('log' for the
+    core.perf logger or a SQLite file path), LIBRARY_PERF_SLOWEST and LIBRARY_PERF_DUPLICATES
+    (how often one statement must repeat to be reported).
+    """
+
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        # Async-capable so async views (the kiosk API) keep running on the event loop under ASGI
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        if not self.sampled():
+            return self.get_response(request)
+        with self.recording(request) as recorder:
+            recorder.response = self.get_response(request)
+        return recorder.response
+
+    async def acall(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        with self.recording(request) as recorder:
+            recorder.response = await self.get_response(request)
+        return recorder.response
+
+    @staticmethod
+    def sampled():
+        rate = getattr(settings, 'LIBRARY_PERF_SAMPLE_RATE', 0)
+        return rate and random.random() < rate
+
+    @contextmanager
+    def recording(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            yield recorder
+        ms = (time.perf_counter() - start) * 1000
+
+        match = request.resolver_match
+        self.emit({
+            'ts': datetime.now().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else '',
+            'status': recorder.response.status_code,
+            'ms': round(ms, 2),
+            **self.summarize(recorder.statements),
+        })
+
+    @staticmethod
+    def summarize(statements):
+        slowest = getattr(settings, 'LIBRARY_PERF_SLOWEST', 3)
+        threshold = getattr(settings, 'LIBRARY_PERF_DUPLICATES', 3)
+        # The SQL text keeps its placeholders, so the same statement with other params counts as a repeat
+        repeated = Counter(sql for sql, _ in statements)
+        return {
+            'queries': len(statements),
+            'sql_ms': round(sum(ms for _, ms in statements), 2),
+            'slowest': [[round(ms, 2), sql[:500]] for sql, ms in sorted(statements, key=lambda s: -s[1])[:slowest]],
+            'duplicates': [[n, sql[:500]] for sql, n in repeated.most_common() if n >= threshold],
+        }
+
+    @staticmethod
+    def emit(record):
+        sink = str(getattr(settings, 'LIBRARY_PERF_SINK', 'log'))
+        if sink == 'log':
+            logger.info(json.dumps(record, ensure_ascii=False))
+            return
+        try:
+            write_sqlite(sink, record)
+        except sqlite3.Error:
+            logger.exception('Không ghi được số liệu hiệu năng vào %s', sink)
@@ -1,16 +1,123 @@
-from django.db import models
+from collections import Counter, defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q, Count, Exists, OuterRef, Subquery, Sum, Max, Min, Value, IntegerField, Case, When
+from django.db.models.functions import Least, Greatest, Coalesce
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from datetime import timedelta, date
+from . import cache as catalog_cache
+from .functions import DaysBetween
+
+LOAN_PERIOD = timedelta(days=14)
+FINE_PER_DAY = 1000
+
+
+class EditConflict(ValidationError):
+    """A save found the row changed since it was loaded."""
+    
+    def __init__(self, message='Bản ghi đã được người khác thay đổi, vui lòng tải lại trang và thử lại'):
+        super().__init__(message)
+
+
+class VersionedModel(models.Model):
+    """Optimistic locking: a save only writes the row while its ``version`` is still the one loaded.
+
+    Every write moves ``version`` on, so two desks editing the same row cannot
+    overwrite each other; the loser gets EditConflict. ``tracked_fields`` keep
+    their loaded values so ``save`` can detect transitions without reading the
+    row again.
+    """
+    tracked_fields = ()
+    
+    # db_default covers the raw INSERTs of generate_library
+    version = models.PositiveIntegerField(default=0, db_default=0, editable=False, verbose_name="Phiên bản")
+    
+    class Meta:
+        abstract = True
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember()
+        return instance
+    
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        self.remember(fields)
+    
+    def remember(self, fields=None):
+        loaded = self.__dict__.setdefault('_loaded', {})
+        for name in self.tracked_fields:
+            if name in self.__dict__ and (fields is None or name in fields):
+                loaded[name] = self.__dict__[name]
+    
+    def loaded(self, *names):
+        """Values of tracked fields as loaded, or None without a row; read again only when they were deferred."""
+        known = self.__dict__.get('_loaded', {})
+        if all(name in known for name in names):
+            values = [known[name] for name in names]
+        else:
+            values = type(self)._base_manager.filter(pk=self.pk).values_list(*names).first()
+            if values is None:
+                return None
+        return values[0] if len(names) == 1 else tuple(values)
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.__dict__.pop('_loaded', None)
+        self.remember()
+    
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update, *args, **kwargs):
+        version_field = self._meta.get_field('version')
+        values = [row for row in values if row[0] is not version_field] + [(version_field, None, self.version + 1)]
+        updated = super()._do_update(base_qs.filter(version=self.version), using, pk_val, values, update_fields,
+                                     forced_update, *args, **kwargs)
+        if updated:
+            self.version += 1
+        elif base_qs.filter(pk=pk_val).exists():
+            raise EditConflict()
+        return updated
+
+
+def next_version():
+    # For UPDATEs that bypass save(): a desk holding the old version must reload before saving
+    return F('version') + 1
 
 
 class Category(models.Model):
+    """A category with a snapshot of the availability of its active books.
+
+    The counters are moved by the same transactions as the books (see
+    ``shift_stock`` and ``move_stock``), so catalog browsing reads one row
+    per category; ``manage.py rebuild_counters --check`` compares them with
+    the books. They stamp ``stock_changed_at``, not ``modified_at``, which the
+    pages of the category's books are versioned by.
+    """
     name = models.CharField(max_length=100, verbose_name="Tên thể loại")
+    modified_at = models.DateTimeField(auto_now=True, verbose_name="Cập nhật lúc")
+    stock_changed_at = models.DateTimeField(default=timezone.now, editable=False,
+                                            verbose_name="Tồn kho cập nhật lúc")
+    books = models.IntegerField(default=0, editable=False, verbose_name="Đầu sách")
+    books_available = models.IntegerField(default=0, editable=False, verbose_name="Đầu sách còn trên giá")
+    retired_books = models.IntegerField(default=0, editable=False, verbose_name="Đầu sách ngừng sử dụng")
+    copies = models.IntegerField(default=0, editable=False, verbose_name="Số bản")
+    copies_available = models.IntegerField(default=0, editable=False, verbose_name="Số bản trên giá")
+    copies_on_loan = models.IntegerField(default=0, editable=False, verbose_name="Số bản đang cho mượn")
+    copies_reserved = models.IntegerField(default=0, editable=False, verbose_name="Số bản đang giữ chỗ")
     
     class Meta:
         verbose_name = verbose_name_plural = "Thể loại"
     
     def __str__(self):
         return self.name
+    
+    def save(self, *args, **kwargs):
+        # The counters belong to the book write paths: an edit must not write back the values it loaded
+        if not self._state.adding and not kwargs.get('update_fields'):
+            kwargs['update_fields'] = ['name', 'modified_at']
+        super().save(*args, **kwargs)
 
 
 class ActiveBookManager(models.Manager):
@@ -18,7 +125,7 @@ class ActiveBookManager(models.Manager):
         return super().get_queryset().filter(is_active=True)
 
 
-class Book(models.Model):
+class Book(VersionedModel):
     code = models.CharField(max_length=50, unique=True, verbose_name="Mã sách")
     title = models.CharField(max_length=200, verbose_name="Tên sách")
     category = models.ForeignKey(Category, on_delete=models.PROTECT, verbose_name="Thể loại")
@@ -28,12 +135,21 @@ class Book(models.Model):
     total_quantity = models.IntegerField(verbose_name="Tổng số lượng")
     available = models.IntegerField(verbose_name="Số lượng hiện có")
     is_active = models.BooleanField(default=True, verbose_name="Đang sử dụng")
+    loan_count = models.IntegerField(default=0, editable=False, db_index=True, verbose_name="Số lần mượn")
+    active_loans = models.IntegerField(default=0, editable=False, db_index=True, verbose_name="Đang cho mượn")
+    reserved = models.IntegerField(default=0, editable=False, verbose_name="Đang giữ cho bạn đọc")
+    # Version stamp of the public catalog pages: bumped by every write, including the inventory UPDATEs
+    modified_at = models.DateTimeField(auto_now=True, verbose_name="Cập nhật lúc")
     
     objects = ActiveBookManager()
     all_objects = models.Manager()
     
     class Meta:
         verbose_name = verbose_name_plural = "Sách"
+        indexes = [
+            models.Index(fields=['category', 'is_active', 'title'], name='book_category_active_idx'),
+            models.Index(fields=['category', 'is_active', 'modified_at'], name='book_category_modified_idx'),
+        ]
     
     def __str__(self):
         return f"{self.code} - {self.title}"
@@ -41,6 +157,217 @@ class Book(models.Model):
     def clean(self):
         if self.available < 0 or self.available > self.total_quantity:
             raise ValidationError({'available': 'Số lượng không hợp lệ'})
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            # Edits set any counter at once: move the snapshots from the stored row to the saved one
+            before = [] if self._state.adding else list(stock_states([self.pk]).values())
+            super().save(*args, **kwargs)
+            after = stock_states([self.pk]).values() if kwargs.get('update_fields') else [self.stock()]
+            move_stock(before, after)
+    
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            before = stock_states([self.pk]).values()
+            result = super().delete(*args, **kwargs)
+            move_stock(before)
+        return result
+    
+    def stock(self):
+        return BookStock(*(getattr(self, name) for name in BookStock._fields))
+    
+    # Inventory changes are single guarded UPDATEs so concurrent desks never
+    # oversell and the rest of the row is never rewritten.
+    def take_copy(self, new_loan=False):
+        changes = {'available': F('available') - 1, 'active_loans': F('active_loans') + 1,
+                   'modified_at': timezone.now(), 'version': next_version()}
+        if new_loan:
+            changes['loan_count'] = F('loan_count') + 1
+        taken = Book.all_objects.filter(pk=self.pk, available__gt=0).update(**changes)
+        if taken:
+            shift_stock(self, shelf=-1, copies_available=-1, copies_on_loan=1)
+            self.available -= 1
+            self.active_loans += 1
+            self.loan_count += new_loan
+            self.version += 1
+        return bool(taken)
+    
+    def release_copy(self):
+        # The reader at the head of the hold queue gets the copy before the shelf does
+        if Hold.objects.allocate(self.pk):
+            # modified_at too: the expected return date on the book's page moves with the open loans
+            Book.all_objects.filter(pk=self.pk).update(
+                active_loans=F('active_loans') - 1, reserved=F('reserved') + 1, modified_at=timezone.now(),
+                version=next_version())
+            shift_stock(self, copies_on_loan=-1, copies_reserved=1)
+            self.active_loans -= 1
+            self.reserved += 1
+            self.version += 1
+            return
+        book = Book.all_objects.filter(pk=self.pk)
+        changes = {'active_loans': F('active_loans') - 1, 'modified_at': timezone.now(), 'version': next_version()}
+        # A lost copy coming back does not go on the shelf: the guard keeps available <= total_quantity
+        if book.filter(available__lt=F('total_quantity')).update(available=F('available') + 1, **changes):
+            shift_stock(self, shelf=1, copies_available=1, copies_on_loan=-1)
+            self.available += 1
+        else:
+            book.update(**changes)
+            shift_stock(self, copies_on_loan=-1)
+        self.active_loans -= 1
+        self.version += 1
+    
+    def take_reserved_copy(self, new_loan=False):
+        changes = {'reserved': F('reserved') - 1, 'active_loans': F('active_loans') + 1,
+                   'modified_at': timezone.now(), 'version': next_version()}
+        if new_loan:
+            changes['loan_count'] = F('loan_count') + 1
+        Book.all_objects.filter(pk=self.pk).update(**changes)
+        shift_stock(self, copies_reserved=-1, copies_on_loan=1)
+        self.reserved -= 1
+        self.active_loans += 1
+        self.loan_count += new_loan
+        self.version += 1
+    
+    def remove_copy(self):
+        book = Book.all_objects.filter(pk=self.pk)
+        changes = {'total_quantity': F('total_quantity') - 1, 'modified_at': timezone.now(), 'version': next_version()}
+        # Only a book with every copy on the shelf loses a shelf copy; otherwise the lost one was out
+        if book.filter(available__gte=F('total_quantity')).update(available=F('available') - 1, **changes):
+            shift_stock(self, shelf=-1, copies=-1, copies_available=-1)
+            self.available -= 1
+        else:
+            book.update(**changes)
+            shift_stock(self, copies=-1)
+        self.total_quantity -= 1
+        self.version += 1
+
+
+def shift_stock(book, shelf=0, **deltas):
+    """Move the snapshot of ``book``'s category by the deltas of a single-book write, after its Book UPDATE.
+
+    ``shelf`` is -1 / +1 when the book's shelf count just moved by one: it then
+    took its last copy off the shelf / put its first one back exactly when
+    available is now 0 / 1. Retired books are not in the snapshot, so nothing
+    moves for them.
+    """
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if shelf:
+        edge = Exists(Book.all_objects.filter(pk=book.pk, available=0 if shelf < 0 else 1))
+        changes['books_available'] = F('books_available') + Case(When(edge, then=Value(shelf)), default=Value(0))
+    Category.objects.filter(Exists(Book.all_objects.filter(pk=book.pk, is_active=True)), pk=book.category_id).update(
+        stock_changed_at=timezone.now(), **changes)
+
+
+# The columns of a book its category's snapshot counts
+BookStock = namedtuple('BookStock', ['category_id', 'is_active', 'total_quantity', 'available', 'active_loans',
+                                     'reserved'])
+
+
+def stock_states(book_ids):
+    """{book_id: BookStock} of these books, locked until the transaction ends so the write after it is known."""
+    rows = Book.all_objects.select_for_update().filter(pk__in=book_ids).values_list('pk', *BookStock._fields)
+    return {pk: BookStock(*state) for pk, *state in rows}
+
+
+def stock_counts(state):
+    if not state.is_active:
+        return {'retired_books': 1}
+    return {'books': 1, 'books_available': int(state.available > 0), 'copies': state.total_quantity,
+            'copies_available': state.available, 'copies_on_loan': state.active_loans,
+            'copies_reserved': state.reserved}
+
+
+def move_stock(before=(), after=()):
+    """Move the snapshots from the ``before`` to the ``after`` BookStock of the books of a write, in one UPDATE.
+
+    The cost follows the batch, not the size of the categories it touches.
+    """
+    deltas = defaultdict(Counter)
+    for sign, states in ((-1, before), (1, after)):
+        for state in states:
+            for field, n in stock_counts(state).items():
+                deltas[state.category_id][field] += sign * n
+    deltas = {category_id: {field: n for field, n in counts.items() if n} for category_id, counts in deltas.items()}
+    deltas = {category_id: counts for category_id, counts in deltas.items() if counts}
+    if not deltas:
+        return
+    changes = {}
+    for field in {field for counts in deltas.values() for field in counts}:
+        per_category = [When(pk=pk, then=Value(counts[field])) for pk, counts in deltas.items() if field in counts]
+        changes[field] = F(field) + Case(*per_category, default=Value(0))
+    Category.objects.filter(pk__in=deltas).update(stock_changed_at=timezone.now(), **changes)
+
+
+def expected_stock():
+    """{Category field: expression recomputing it from the books}."""
+    books = Book.all_objects.filter(category=OuterRef('pk'), is_active=True)
+    return {
+        'books': correlated_aggregate(books, 'category', Count('pk')),
+        'books_available': correlated_aggregate(books.filter(available__gt=0), 'category', Count('pk')),
+        'retired_books': correlated_aggregate(Book.all_objects.filter(category=OuterRef('pk'), is_active=False),
+                                              'category', Count('pk')),
+        'copies': correlated_aggregate(books, 'category', Sum('total_quantity')),
+        'copies_available': correlated_aggregate(books, 'category', Sum('available')),
+        'copies_on_loan': correlated_aggregate(books, 'category', Sum('active_loans')),
+        'copies_reserved': correlated_aggregate(books, 'category', Sum('reserved')),
+    }
+
+
+def refresh_stock(category_ids=None):
+    """Recount the snapshot of these categories (all when None) from their books; for repairs and full loads."""
+    categories = Category.objects.all() if category_ids is None else Category.objects.filter(pk__in=category_ids)
+    categories.update(stock_changed_at=timezone.now(), **expected_stock())
+
+
+def increment(model, pk, **deltas):
+    """Add deltas to counter columns with a single UPDATE, skipping zero deltas."""
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if changes:
+        if issubclass(model, VersionedModel):
+            changes['version'] = next_version()
+        model._base_manager.filter(pk=pk).update(**changes)
+
+
+def correlated_aggregate(queryset, group_by, aggregate):
+    # Correlated aggregate so the annotation never multiplies the outer query's joins
+    subquery = queryset.order_by().values(group_by).annotate(v=aggregate).values('v')
+    return Coalesce(Subquery(subquery, output_field=IntegerField()), Value(0))
+
+
+class ReaderQuerySet(models.QuerySet):
+    def with_debt(self, as_of=None):
+        as_of = as_of or date.today()
+        overdue = Loan.objects.overdue(as_of).filter(reader=OuterRef('pk'))
+        return self.annotate(
+            overdue_fine=correlated_aggregate(overdue, 'reader', Sum(fine_amount(as_of))),
+        )
+
+
+def days_overdue(as_of):
+    # Returned loans stop at return_date, open loans keep accruing until as_of
+    end = Case(When(status='borrowing', then=Value(as_of)), default=F('return_date'))
+    return Coalesce(Greatest(DaysBetween(end, F('due_date')), Value(0)), Value(0))
+
+
+def fine_amount(as_of):
+    return days_overdue(as_of) * FINE_PER_DAY
+
+
+class LoanQuerySet(models.QuerySet):
+    def with_fines(self, as_of=None):
+        as_of = as_of or date.today()
+        return self.annotate(days_overdue=days_overdue(as_of), fine_amount=fine_amount(as_of))
+    
+    def overdue(self, as_of=None):
+        return self.filter(status='borrowing', due_date__lt=as_of or date.today())
+    
+    def history(self, after=None):
+        """Returned loans newest first; ``after`` is the (borrow_date, id) of the last row already shown."""
+        qs = self.filter(status='returned').order_by('-borrow_date', '-id')
+        if after:
+            borrow_date, pk = after
+            qs = qs.filter(Q(borrow_date__lt=borrow_date) | Q(borrow_date=borrow_date, pk__lt=pk))
+        return qs
 
 
 class Reader(models.Model):
@@ -48,15 +375,26 @@ class Reader(models.Model):
     full_name = models.CharField(max_length=200, verbose_name="Họ tên")
     phone = models.CharField(max_length=20, verbose_name="Số điện thoại")
     created_at = models.DateField(auto_now_add=True, verbose_name="Ngày cấp thẻ")
+    active_loans = models.IntegerField(default=0, editable=False, db_index=True, verbose_name="Đang mượn")
+    unpaid_damages = models.IntegerField(default=0, editable=False, db_index=True, verbose_name="Hư hỏng chưa trả")
+    unpaid_total = models.IntegerField(default=0, editable=False, db_index=True, verbose_name="Tiền bồi thường chưa trả")
+    
+    objects = ReaderQuerySet.as_manager()
     
     class Meta:
         verbose_name = verbose_name_plural = "Bạn đọc"
     
     def __str__(self):
         return f"{self.card_id} - {self.full_name}"
+    
+    def save(self, *args, **kwargs):
+        # The counters belong to the loan and damage write paths: an edit must not write back the values it loaded
+        if not self._state.adding and not kwargs.get('update_fields'):
+            kwargs['update_fields'] = ['card_id', 'full_name', 'phone']
+        super().save(*args, **kwargs)
 
 
-class Loan(models.Model):
+class Loan(VersionedModel):
     STATUS_CHOICES = [('borrowing', 'Đang mượn'), ('returned', 'Đã trả')]
     
     reader = models.ForeignKey(Reader, on_delete=models.PROTECT, verbose_name="Bạn đọc")
@@ -66,43 +404,78 @@ class Loan(models.Model):
     return_date = models.DateField(null=True, blank=True, verbose_name="Ngày trả thực tế")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='borrowing', verbose_name="Trạng thái")
     
+    objects = LoanQuerySet.as_manager()
+    tracked_fields = ['status', 'reader_id', 'book_id']
+    
     class Meta:
         verbose_name = verbose_name_plural = "Phiếu mượn"
+        indexes = [
+            models.Index(fields=['due_date'], condition=Q(status='borrowing'), name='loan_open_due_idx'),
+            models.Index(fields=['status', '-borrow_date'], name='loan_status_borrow_idx'),
+            models.Index(fields=['borrow_date'], name='loan_borrow_date_idx'),
+            models.Index(fields=['due_date'], name='loan_due_date_idx'),
+            models.Index(fields=['return_date'], name='loan_return_date_idx'),
+            models.Index(fields=['reader', 'status', '-borrow_date', '-id'], name='loan_reader_history_idx'),
+            models.Index(fields=['book', 'status'], name='loan_book_status_idx'),
+            models.Index(fields=['reader', 'due_date'], condition=Q(status='borrowing'), name='loan_open_reader_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.reader.full_name} - {self.book.title}"
+        return f"{catalog_cache.related(self, 'reader').full_name} - {catalog_cache.related(self, 'book').title}"
     
     @property
     def fine(self):
         if self.return_date and self.return_date > self.due_date:
-            return (self.return_date - self.due_date).days * 1000
+            return (self.return_date - self.due_date).days * FINE_PER_DAY
         return 0
     
     def save(self, *args, **kwargs):
         if not self.due_date:
-            self.due_date = self.borrow_date + timedelta(days=14)
+            self.due_date = self.borrow_date + LOAN_PERIOD
         
         is_new = self.pk is None
-        old_status = None if is_new else Loan.objects.filter(pk=self.pk).values_list('status', flat=True).first()
-        
-        if (is_new or old_status == 'returned') and self.status == 'borrowing' and self.book.available <= 0:
-            raise ValidationError(f'Sách "{self.book.title}" đã hết')
-        
-        super().save(*args, **kwargs)
         
-        if is_new and self.status == 'borrowing':
-            self.book.available -= 1
-            self.book.save()
-        elif not is_new and old_status != self.status:
-            if old_status == 'borrowing' and self.status == 'returned':
-                self.book.available += 1
-                self.book.save()
-            elif old_status == 'returned' and self.status == 'borrowing':
-                self.book.available -= 1
-                self.book.save()
-
-
-class Damage(models.Model):
+        with transaction.atomic():
+            old = None if is_new else self.loaded('status', 'reader_id', 'book_id')
+            old_status = old and old[0]
+            if old and old[1:] != (self.reader_id, self.book_id):
+                # The counters were moved for the reader and book of the loan; delete and lend again instead
+                raise ValidationError('Không thể đổi bạn đọc hoặc sách của phiếu mượn đã tạo')
+            
+            active_delta = 0
+            if (is_new or old_status == 'returned') and self.status == 'borrowing':
+                # A reader picking up a held copy takes it from the reserved ones, not the shelf
+                if self.book.reserved and Hold.objects.claim(self.reader_id, self.book_id):
+                    self.book.take_reserved_copy(new_loan=is_new)
+                elif not self.book.take_copy(new_loan=is_new):
+                    raise ValidationError(f'Sách "{self.book.title}" đã hết')
+                active_delta = 1
+            elif old_status == 'borrowing' and self.status == 'returned':
+                self.book.release_copy()
+                active_delta = -1
+            elif is_new:
+                increment(Book, self.book_id, loan_count=1)
+            else:
+                # Due dates show on the catalog page of the book
+                Book.all_objects.filter(pk=self.book_id).update(modified_at=timezone.now())
+            
+            super().save(*args, **kwargs)
+            increment(Reader, self.reader_id, active_loans=active_delta)
+    
+    def delete(self, *args, **kwargs):
+        # Undo what save() counted: an open loan gives its copy back, and the book counts one loan less
+        with transaction.atomic():
+            status = Loan._base_manager.filter(pk=self.pk).values_list('status', flat=True).first()
+            result = super().delete(*args, **kwargs)
+            if status == 'borrowing':
+                self.book.release_copy()
+                increment(Reader, self.reader_id, active_loans=-1)
+            if status is not None:
+                increment(Book, self.book_id, loan_count=-1)
+        return result
+
+
+class Damage(VersionedModel):
     DAMAGE_TYPE_CHOICES = [('lost', 'Mất sách'), ('torn', 'Rách/Hư hỏng nặng'), 
                            ('water_damaged', 'Ướt/Hư do nước'), ('minor', 'Hư hỏng nhẹ')]
     
@@ -113,9 +486,17 @@ class Damage(models.Model):
     is_paid = models.BooleanField(default=False, verbose_name="Đã thanh toán")
     notes = models.TextField(blank=True, verbose_name="Ghi chú")
     
+    tracked_fields = ['is_paid', 'compensation_fee', 'loan_id', 'damage_type']
+    
     class Meta:
         verbose_name = verbose_name_plural = "Hư hỏng sách"
         ordering = ['-reported_date']
+        indexes = [
+            models.Index(fields=['loan'], condition=Q(is_paid=False), name='damage_unpaid_idx'),
+            models.Index(fields=['-reported_date'], name='damage_reported_idx'),
+            models.Index(fields=['is_paid', '-reported_date'], name='damage_paid_reported_idx'),
+            models.Index(fields=['damage_type', '-reported_date'], name='damage_type_reported_idx'),
+        ]
     
     @property
     def book(self):
@@ -126,19 +507,351 @@ class Damage(models.Model):
         return self.loan.reader
     
     def __str__(self):
-        return f"{self.book.title} - {self.get_damage_type_display()} ({self.reader.full_name})"
+        book, reader = catalog_cache.related(self, 'loan.book'), catalog_cache.related(self, 'loan.reader')
+        return f"{book.title} - {self.get_damage_type_display()} ({reader.full_name})"
     
     def save(self, *args, **kwargs):
         if not self.compensation_fee:
-            fees = {'lost': self.book.price * 2, 'torn': self.book.price, 
-                    'water_damaged': self.book.price, 'minor': int(self.book.price * 0.3)}
-            self.compensation_fee = fees.get(self.damage_type, 0)
+            self.compensation_fee = self.default_fee(self.damage_type, self.book.price)
         
         is_new = self.pk is None
-        super().save(*args, **kwargs)
-        
-        if is_new and self.damage_type == 'lost':
-            self.book.total_quantity -= 1
-            if self.book.available > self.book.total_quantity:
-                self.book.available = self.book.total_quantity
-            self.book.save()
+        with transaction.atomic():
+            old = None if is_new else self.loaded('is_paid', 'compensation_fee', 'loan_id', 'damage_type')
+            if old and old[2:] != (self.loan_id, self.damage_type):
+                # The debt and a lost copy were counted for this loan and type
+                raise ValidationError('Không thể đổi phiếu mượn hoặc loại hư hỏng của báo cáo đã tạo')
+            old = old and old[:2]
+            super().save(*args, **kwargs)
+            if is_new and self.damage_type == 'lost':
+                self.book.remove_copy()
+            
+            old_debt = self.unpaid_debt(*old) if old else (0, 0)
+            new_debt = self.unpaid_debt(self.is_paid, self.compensation_fee)
+            increment(Reader, self.loan.reader_id, unpaid_damages=new_debt[0] - old_debt[0],
+                      unpaid_total=new_debt[1] - old_debt[1])
+    
+    def delete(self, *args, **kwargs):
+        if self.damage_type == 'lost':
+            raise ValidationError('Không thể xóa báo mất sách: bản sách đã bị trừ khỏi kho')
+        with transaction.atomic():
+            stored = Damage._base_manager.filter(pk=self.pk).values_list('is_paid', 'compensation_fee').first()
+            result = super().delete(*args, **kwargs)
+            if stored:
+                unpaid, total = self.unpaid_debt(*stored)
+                increment(Reader, self.loan.reader_id, unpaid_damages=-unpaid, unpaid_total=-total)
+        return result
+    
+    @staticmethod
+    def default_fee(damage_type, price):
+        fees = {'lost': price * 2, 'torn': price, 'water_damaged': price, 'minor': int(price * 0.3)}
+        return fees.get(damage_type, 0)
+    
+    @staticmethod
+    def unpaid_debt(is_paid, compensation_fee):
+        return (0, 0) if is_paid else (1, compensation_fee)
+
+
+def pickup_deadline(now):
+    return now + timedelta(days=getattr(settings, 'LIBRARY_HOLD_PICKUP_DAYS', 3))
+
+
+class HoldQuerySet(models.QuerySet):
+    def allocate(self, book_id, copies=1, now=None):
+        """Give up to ``copies`` copies of a book to the head of its queue; returns how many were taken.
+
+        The caller moves the copies into Book.reserved in the same transaction.
+        """
+        now = now or timezone.now()
+        heads = self.filter(book=book_id, status='waiting').order_by('ticket').values('pk')[:copies]
+        return self.filter(pk__in=Subquery(heads), status='waiting').update(
+            status='ready', ready_at=now, expires_at=pickup_deadline(now))
+    
+    def claim(self, reader_id, book_id):
+        return self.filter(reader=reader_id, book=book_id, status='ready').update(
+            status='fulfilled', closed_at=timezone.now())
+    
+    def pass_on(self, per_book, now=None):
+        """Copies freed from ready holds, {book_id: n}: to the next readers waiting, the rest to the shelf."""
+        before, after = stock_states(per_book), {}
+        for book_id, n in per_book.items():
+            shelved = n - self.allocate(book_id, n, now)
+            if shelved:
+                Book.all_objects.filter(pk=book_id).update(
+                    reserved=F('reserved') - shelved, available=Least(F('available') + shelved, F('total_quantity')),
+                    modified_at=timezone.now(), version=next_version())
+                state = before[book_id]
+                after[book_id] = state._replace(available=min(state.available + shelved, state.total_quantity),
+                                                reserved=state.reserved - shelved)
+        move_stock([before[book_id] for book_id in after], after.values())
+
+
+class Hold(models.Model):
+    """A reader's place in the FIFO queue of a book that has no copy on the shelf.
+
+    Waiting holds of a book have consecutive tickets: a new one takes the next
+    ticket, a copy coming back goes to the lowest and a cancellation closes
+    the gap. The position in the queue is therefore the distance to the lowest
+    ticket, two seeks on hold_queue_idx however long the queue is.
+    """
+    STATUS_CHOICES = [('waiting', 'Đang chờ'), ('ready', 'Chờ nhận sách'), ('fulfilled', 'Đã nhận sách'),
+                      ('expired', 'Quá hạn nhận'), ('cancelled', 'Đã hủy')]
+    
+    reader = models.ForeignKey(Reader, on_delete=models.PROTECT, related_name='holds', verbose_name="Bạn đọc")
+    book = models.ForeignKey(Book, on_delete=models.PROTECT, related_name='holds', verbose_name="Sách")
+    ticket = models.IntegerField(default=0, editable=False, verbose_name="Số thứ tự")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='waiting', editable=False,
+                              verbose_name="Trạng thái")
+    created_at = models.DateTimeField(default=timezone.now, editable=False, verbose_name="Đặt lúc")
+    ready_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Có sách lúc")
+    expires_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Hạn nhận sách")
+    closed_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Kết thúc lúc")
+    
+    objects = HoldQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Đặt trước"
+        constraints = [
+            models.UniqueConstraint(fields=['reader', 'book'], condition=Q(status__in=['waiting', 'ready']),
+                                    name='hold_open_unique',
+                                    violation_error_message='Bạn đọc đã đặt trước sách này'),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'ticket'], condition=Q(status='waiting'), name='hold_queue_idx'),
+            models.Index(fields=['expires_at'], condition=Q(status='ready'), name='hold_ready_expiry_idx'),
+            models.Index(fields=['reader', '-created_at'], name='hold_reader_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{catalog_cache.related(self, 'reader').full_name} - {catalog_cache.related(self, 'book').title}"
+    
+    def clean(self):
+        if self.pk is None and self.book_id and Book.all_objects.filter(pk=self.book_id, available__gt=0).exists():
+            raise ValidationError({'book': 'Sách còn trên giá, bạn đọc có thể mượn ngay'})
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.pk is None:
+                # Lock the book so two readers joining at once never draw the same ticket
+                Book.all_objects.select_for_update().filter(pk=self.book_id).exists()
+                last = Hold.objects.filter(book=self.book_id, status='waiting').aggregate(m=Max('ticket'))['m']
+                self.ticket = (last or 0) + 1
+            super().save(*args, **kwargs)
+    
+    def position(self):
+        """1 for the next reader to get a copy; None once the hold left the queue."""
+        if self.status != 'waiting':
+            return None
+        head = Hold.objects.filter(book=self.book_id, status='waiting').aggregate(m=Min('ticket'))['m']
+        return self.ticket - head + 1
+    
+    def cancel(self):
+        status = self.status
+        if status not in ('waiting', 'ready'):
+            return False
+        with transaction.atomic():
+            # The same lock as save(): a reader joining meanwhile must not draw a ticket from before the shift
+            Book.all_objects.select_for_update().filter(pk=self.book_id).exists()
+            if not Hold.objects.filter(pk=self.pk, status=status).update(status='cancelled',
+                                                                         closed_at=timezone.now()):
+                return False
+            if status == 'waiting':
+                Hold.objects.filter(book=self.book_id, status='waiting', ticket__gt=self.ticket).update(
+                    ticket=F('ticket') - 1)
+            elif status == 'ready':
+                Hold.objects.pass_on({self.book_id: 1})
+            self.status = 'cancelled'
+            return True
+
+
+class ArchivedLoanQuerySet(models.QuerySet):
+    def with_fines(self, as_of=None):
+        # Archived loans are all returned, so the fine stops at return_date
+        days = Greatest(DaysBetween(F('return_date'), F('due_date')), Value(0))
+        return self.annotate(days_overdue=days, fine_amount=days * FINE_PER_DAY)
+    
+    def history(self, after=None):
+        """Same order and ``after`` cursor as ``LoanQuerySet.history``."""
+        qs = self.order_by('-borrow_date', '-id')
+        if after:
+            borrow_date, pk = after
+            qs = qs.filter(Q(borrow_date__lt=borrow_date) | Q(borrow_date=borrow_date, pk__lt=pk))
+        return qs
+
+
+class ArchivedLoan(models.Model):
+    """A returned loan moved out of Loan by ``manage.py archive_loans``; it keeps its original id."""
+    status = 'returned'
+    archived = True
+    
+    id = models.IntegerField(primary_key=True)
+    reader = models.ForeignKey(Reader, on_delete=models.PROTECT, db_index=False, related_name='archived_loans',
+                               verbose_name="Bạn đọc")
+    book = models.ForeignKey(Book, on_delete=models.PROTECT, related_name='archived_loans', verbose_name="Sách")
+    borrow_date = models.DateField(verbose_name="Ngày mượn")
+    due_date = models.DateField(verbose_name="Hạn trả")
+    return_date = models.DateField(verbose_name="Ngày trả thực tế")
+    
+    objects = ArchivedLoanQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Phiếu mượn đã lưu trữ"
+        indexes = [
+            models.Index(fields=['reader', '-borrow_date', '-id'], name='archived_loan_history_idx'),
+            models.Index(fields=['borrow_date'], name='archived_loan_borrow_idx'),
+            models.Index(fields=['due_date'], name='archived_loan_due_idx'),
+            models.Index(fields=['return_date'], name='archived_loan_return_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.reader.full_name} - {self.book.title}"
+    
+    fine = Loan.fine
+    
+    def get_status_display(self):
+        return dict(Loan.STATUS_CHOICES)[self.status]
+
+
+class ArchivedDamage(models.Model):
+    """A paid Damage archived together with its loan."""
+    id = models.IntegerField(primary_key=True)
+    loan = models.ForeignKey(ArchivedLoan, on_delete=models.PROTECT, related_name='damages',
+                             verbose_name="Phiếu mượn")
+    damage_type = models.CharField(max_length=20, choices=Damage.DAMAGE_TYPE_CHOICES, verbose_name="Loại hư hỏng")
+    reported_date = models.DateField(verbose_name="Ngày phát hiện")
+    compensation_fee = models.IntegerField(verbose_name="Phí bồi thường")
+    notes = models.TextField(blank=True, verbose_name="Ghi chú")
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Hư hỏng đã lưu trữ"
+        indexes = [
+            models.Index(fields=['reported_date'], name='archived_damage_reported_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_damage_type_display()} ({self.compensation_fee:,})"
+
+
+class DailyBookStat(models.Model):
+    """Circulation events of one book on one day, written by ``manage.py rollup``."""
+    day = models.DateField(verbose_name="Ngày")
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name="Sách")
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name="Thể loại")
+    loans = models.IntegerField(default=0, verbose_name="Lượt mượn")
+    returns = models.IntegerField(default=0, verbose_name="Lượt trả")
+    late_returns = models.IntegerField(default=0, verbose_name="Trả muộn")
+    new_overdue = models.IntegerField(default=0, verbose_name="Bắt đầu quá hạn")
+    fines = models.IntegerField(default=0, verbose_name="Tiền phạt")
+    damages = models.IntegerField(default=0, verbose_name="Hư hỏng")
+    damage_cost = models.IntegerField(default=0, verbose_name="Phí bồi thường")
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Thống kê sách theo ngày"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'book'], name='daily_book_stat_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'day'], name='daily_book_stat_book_idx'),
+        ]
+
+
+class DailyCategoryStat(models.Model):
+    """Per-category totals of a day plus the open/overdue loans at its end; category NULL is the whole library.
+
+    One library row is written for every processed day, so the latest one marks
+    where the next ``manage.py rollup`` run starts.
+    """
+    day = models.DateField(verbose_name="Ngày")
+    category = models.ForeignKey(Category, null=True, on_delete=models.CASCADE, verbose_name="Thể loại")
+    loans = models.IntegerField(default=0, verbose_name="Lượt mượn")
+    returns = models.IntegerField(default=0, verbose_name="Lượt trả")
+    late_returns = models.IntegerField(default=0, verbose_name="Trả muộn")
+    new_overdue = models.IntegerField(default=0, verbose_name="Bắt đầu quá hạn")
+    fines = models.IntegerField(default=0, verbose_name="Tiền phạt")
+    damages = models.IntegerField(default=0, verbose_name="Hư hỏng")
+    damage_cost = models.IntegerField(default=0, verbose_name="Phí bồi thường")
+    open_loans = models.IntegerField(default=0, verbose_name="Đang mượn cuối ngày")
+    overdue = models.IntegerField(default=0, verbose_name="Quá hạn cuối ngày")
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Báo cáo thống kê"
+        indexes = [
+            models.Index(fields=['category', 'day'], name='daily_category_stat_idx'),
+            models.Index(fields=['day'], name='daily_category_stat_day_idx'),
+        ]
+
+
+class Reminder(models.Model):
+    """The consolidated notice of one reader on one day, written by ``manage.py send_reminders``.
+
+    Reruns skip readers whose notice of the day is already sent and retry the pending or failed ones.
+    """
+    STATUS_CHOICES = [('pending', 'Đang gửi'), ('sent', 'Đã gửi'), ('failed', 'Lỗi')]
+    
+    reader = models.ForeignKey(Reader, on_delete=models.CASCADE, verbose_name="Bạn đọc")
+    day = models.DateField(verbose_name="Ngày")
+    overdue_loans = models.IntegerField(default=0, verbose_name="Phiếu quá hạn")
+    due_soon_loans = models.IntegerField(default=0, verbose_name="Phiếu sắp đến hạn")
+    fine = models.IntegerField(default=0, verbose_name="Tiền phạt")
+    message = models.TextField(verbose_name="Nội dung")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="Trạng thái")
+    error = models.TextField(blank=True, verbose_name="Lỗi")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Gửi lúc")
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Nhắc trả sách"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'reader'], name='reminder_day_reader_unique'),
+        ]
+    
+    def __str__(self):
+        return f"{catalog_cache.related(self, 'reader').full_name} - {self.day}"
+
+
+class Job(models.Model):
+    """Background work run by ``manage.py run_workers``; see core/jobs.py for the tasks."""
+    STATUS_CHOICES = [('queued', 'Đang chờ'), ('running', 'Đang chạy'), ('done', 'Hoàn thành'), ('failed', 'Lỗi')]
+    
+    task = models.CharField(max_length=100, verbose_name="Tác vụ")
+    params = models.JSONField(default=dict, blank=True, verbose_name="Tham số")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', verbose_name="Trạng thái")
+    progress = models.IntegerField(default=0, verbose_name="Đã xử lý")
+    total = models.IntegerField(null=True, blank=True, verbose_name="Tổng")
+    message = models.CharField(max_length=500, blank=True, verbose_name="Thông báo")
+    result = models.JSONField(null=True, blank=True, verbose_name="Kết quả")
+    error = models.TextField(blank=True, verbose_name="Lỗi")
+    attempts = models.IntegerField(default=0, verbose_name="Số lần chạy")
+    max_attempts = models.IntegerField(default=3, verbose_name="Số lần chạy tối đa")
+    run_after = models.DateTimeField(default=timezone.now, verbose_name="Chạy từ")
+    worker = models.CharField(max_length=100, blank=True, verbose_name="Worker")
+    heartbeat = models.DateTimeField(null=True, blank=True, verbose_name="Lần báo gần nhất")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                   verbose_name="Người tạo")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Ngày tạo")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Bắt đầu")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Kết thúc")
+    
+    class Meta:
+        verbose_name = verbose_name_plural = "Tác vụ nền"
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['run_after', 'id'], condition=Q(status='queued'), name='job_queued_idx'),
+            models.Index(fields=['heartbeat'], condition=Q(status='running'), name='job_running_idx'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.task} ({self.get_status_display()})"
+    
+    def owned(self):
+        """This job while still running under the claim it was loaded with (same worker and attempt)."""
+        return Job.objects.filter(pk=self.pk, status='running', worker=self.worker, attempts=self.attempts)
+    
+    def report(self, progress, total=None, message=None):
+        """Record progress from inside a running task with a single UPDATE."""
+        changes = {'progress': progress}
+        if total is not None:
+            changes['total'] = total
+        if message is not None:
+            changes['message'] = message[:500]
+        self.owned().update(**changes)
+        for field, value in changes.items():
+            setattr(self, field, value)
@@ -0,0 +1,160 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+
+from .models import Loan, Damage, ArchivedLoan, ArchivedDamage, DailyBookStat, DailyCategoryStat
+
+EVENTS = ['loans', 'returns', 'late_returns', 'new_overdue', 'fines', 'damages', 'damage_cost']
+ONE_DAY = timedelta(days=1)
+
+# Loan tables with the condition of a loan still out: archived loans are all returned, so a rebuild
+# after ``manage.py archive_loans`` gives the same figures as before it
+LOAN_TABLES = [(Loan.objects, Q(status='borrowing')), (ArchivedLoan.objects, Q(pk__in=[]))]
+DAMAGE_TABLES = [Damage.objects, ArchivedDamage.objects]
+
+
+def day_events(start, end):
+    """{(day, book_id): [category_id, *EVENTS]} for start..end, from the indexed date columns."""
+    stats = defaultdict(lambda: [None] + [0] * len(EVENTS))
+
+    def add(day, book_id, category_id, **values):
+        row = stats[day, book_id]
+        row[0] = category_id
+        for name, value in values.items():
+            row[EVENTS.index(name) + 1] += value or 0
+
+    for table, out in LOAN_TABLES:
+        loans = table.filter(borrow_date__range=(start, end)).order_by()
+        for row in loans.values('borrow_date', 'book', 'book__category').annotate(n=Count('pk')):
+            add(row['borrow_date'], row['book'], row['book__category'], loans=row['n'])
+
+        returns = table.filter(return_date__range=(start, end)).with_fines(end).order_by()
+        for row in returns.values('return_date', 'book', 'book__category').annotate(
+                n=Count('pk'), late=Count('pk', filter=Q(return_date__gt=F('due_date'))), fines=Sum('fine_amount')):
+            add(row['return_date'], row['book'], row['book__category'], returns=row['n'], late_returns=row['late'],
+                fines=row['fines'])
+
+        # A loan turns overdue the day after its due date unless it was back by then
+        turned = table.filter(due_date__range=(start - ONE_DAY, end - ONE_DAY)).filter(
+            out | Q(return_date__gt=F('due_date'))).order_by()
+        for row in turned.values('due_date', 'book', 'book__category').annotate(n=Count('pk')):
+            add(row['due_date'] + ONE_DAY, row['book'], row['book__category'], new_overdue=row['n'])
+
+    for table in DAMAGE_TABLES:
+        damages = table.filter(reported_date__range=(start, end)).order_by()
+        for row in damages.values('reported_date', 'loan__book', 'loan__book__category').annotate(
+                n=Count('pk'), cost=Sum('compensation_fee')):
+            add(row['reported_date'], row['loan__book'], row['loan__book__category'], damages=row['n'],
+                damage_cost=row['cost'])
+    return stats
+
+
+def open_loans_at(day):
+    """{category_id: [open loans, overdue loans]} at the end of ``day``, straight from the loan tables."""
+    snapshot = defaultdict(lambda: [0, 0])
+    for table, out in LOAN_TABLES:
+        rows = (table.filter(out | Q(return_date__gt=day), borrow_date__lte=day).order_by().values('book__category')
+                .annotate(open=Count('pk'), overdue=Count('pk', filter=Q(due_date__lt=day))))
+        for row in rows:
+            counts = snapshot[row['book__category']]
+            counts[0] += row['open']
+            counts[1] += row['overdue']
+    return snapshot
+
+
+def next_rollup_day():
+    last = DailyCategoryStat.objects.filter(category=None).aggregate(m=Max('day'))['m']
+    if last:
+        return last + ONE_DAY
+    firsts = [day for table, _ in LOAN_TABLES if (day := table.aggregate(m=Min('borrow_date'))['m'])]
+    return min(firsts, default=None)
+
+
+def build_rollups(until=None, batch_days=7, rebuild=False):
+    """Roll up every day after the last processed one through ``until`` (default yesterday).
+
+    Only closed days are processed; each batch of days is written in one
+    transaction, so an interrupted run resumes where it stopped. Returns the
+    number of days rolled up.
+    """
+    until = until or date.today() - ONE_DAY
+    if rebuild:
+        DailyBookStat.objects.all().delete()
+        DailyCategoryStat.objects.all().delete()
+    start = next_rollup_day()
+    if start is None or start > until:
+        return 0
+
+    # Open/overdue snapshots are carried forward day by day from one baseline
+    snapshot = open_loans_at(start - ONE_DAY)
+    days = 0
+    while start <= until:
+        end = min(start + timedelta(days=batch_days - 1), until)
+        with transaction.atomic():
+            write_batch(start, end, day_events(start, end), snapshot)
+        days += (end - start).days + 1
+        start = end + ONE_DAY
+    return days
+
+
+def write_batch(start, end, stats, snapshot):
+    per_day = defaultdict(lambda: defaultdict(lambda: [0] * len(EVENTS)))
+    books = []
+    for (day, book_id), (category_id, *values) in stats.items():
+        books.append(DailyBookStat(day=day, book_id=book_id, category_id=category_id,
+                                   **dict(zip(EVENTS, values))))
+        totals = per_day[day][category_id]
+        for i, value in enumerate(values):
+            totals[i] += value
+
+    categories = []
+    day = start
+    while day <= end:
+        library = [0] * len(EVENTS)
+        for category_id, values in per_day[day].items():
+            for i, value in enumerate(values):
+                library[i] += value
+        for category_id in set(per_day[day]) | {c for c, s in snapshot.items() if any(s)}:
+            values = dict(zip(EVENTS, per_day[day].get(category_id, [0] * len(EVENTS))))
+            current = snapshot[category_id]
+            current[0] += values['loans'] - values['returns']
+            current[1] += values['new_overdue'] - values['late_returns']
+            categories.append(DailyCategoryStat(day=day, category_id=category_id, open_loans=current[0],
+                                                overdue=current[1], **values))
+        categories.append(DailyCategoryStat(day=day, category=None, **dict(zip(EVENTS, library)),
+                                            open_loans=sum(s[0] for s in snapshot.values()),
+                                            overdue=sum(s[1] for s in snapshot.values())))
+        day += ONE_DAY
+
+    DailyBookStat.objects.filter(day__range=(start, end)).delete()
+    DailyCategoryStat.objects.filter(day__range=(start, end)).delete()
+    DailyBookStat.objects.bulk_create(books, batch_size=2000)
+    DailyCategoryStat.objects.bulk_create(categories, batch_size=2000)
+
+
+def dashboard(start, end, top=10):
+    """Report figures for start..end read from the rollup tables only."""
+    summary = DailyCategoryStat.objects.filter(category=None, day__range=(start, end))
+    sums = {name: Sum(name) for name in EVENTS}
+    last_day = summary.aggregate(m=Max('day'))['m']
+    categories = list(
+        DailyCategoryStat.objects.filter(category__isnull=False, day__range=(start, end))
+        .values('category', 'category__name').annotate(**sums).order_by('-loans'))
+    closing = {category: (open_loans, overdue) for category, open_loans, overdue
+               in DailyCategoryStat.objects.filter(category__isnull=False, day=last_day)
+               .values_list('category', 'open_loans', 'overdue')}
+    for row in categories:
+        row['open_loans'], row['overdue'] = closing.get(row['category'], (0, 0))
+        row['overdue_rate'] = row['overdue'] / row['open_loans'] if row['open_loans'] else 0
+    return {
+        'totals': summary.aggregate(**sums),
+        'last_day': summary.filter(day=last_day).first(),
+        'days': list(summary.order_by('-day')),
+        'categories': categories,
+        'top_books': list(DailyBookStat.objects.filter(day__range=(start, end))
+                          .values('book', 'book__code', 'book__title')
+                          .annotate(loans=Sum('loans'), damage_cost=Sum('damage_cost'))
+                          .order_by('-loans', 'book')[:top]),
+    }
@@ -0,0 +1,125 @@
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Book, Reader
+from .services import chunked
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def fold(text):
+    """Lower-case and strip Vietnamese diacritics: "Dế Mèn" -> "de men", "Đỗ" -> "do"."""
+    text = unicodedata.normalize('NFD', text or '').replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def words(term):
+    return TOKEN_RE.findall(fold(term))
+
+
+# Fields folded into each index, in the order they are concatenated
+INDEXED_FIELDS = {
+    'book': (Book, ['code', 'title', 'author', 'publisher']),
+    'reader': (Reader, ['card_id', 'full_name', 'phone']),
+}
+
+
+class SearchBackend:
+    """No index: ``matching`` returns None and the admin keeps its icontains search."""
+
+    def ensure_tables(self):
+        return False
+
+    def index(self, kind, obj):
+        pass
+
+    def remove(self, kind, pk):
+        pass
+
+    def rebuild(self, kind, pks=None):
+        """Reindex the objects with these primary keys, or all of them when None."""
+
+    def matching(self, kind, term):
+        """An SQL expression selecting the matching primary keys, usable in ``pk__in``."""
+        return None
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """One FTS5 table per kind, keyed by the object's pk as rowid and holding folded text."""
+
+    def table(self, kind):
+        return f'core_{kind}_fts'
+
+    def ensure_tables(self):
+        created = False
+        with connection.cursor() as cursor:
+            for kind in INDEXED_FIELDS:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [self.table(kind)])
+                if cursor.fetchone() is None:
+                    cursor.execute(f"CREATE VIRTUAL TABLE {self.table(kind)} USING fts5(body, prefix='2 3')")
+                    created = True
+        return created
+
+    def index(self, kind, obj):
+        body = fold(' '.join(str(getattr(obj, field)) for field in INDEXED_FIELDS[kind][1]))
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT OR REPLACE INTO {self.table(kind)} (rowid, body) VALUES (%s, %s)', [obj.pk, body])
+
+    def remove(self, kind, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table(kind)} WHERE rowid = %s', [pk])
+
+    def rebuild(self, kind, pks=None):
+        model, fields = INDEXED_FIELDS[kind]
+        qn = connection.ops.quote_name
+        body = " || ' ' || ".join(f'COALESCE({qn(model._meta.get_field(f).column)}, \'\')' for f in fields)
+        insert = (f'INSERT INTO {self.table(kind)} (rowid, body) '
+                  f'SELECT id, library_fold({body}) FROM {qn(model._meta.db_table)}')
+        with connection.cursor() as cursor:
+            if pks is None:
+                cursor.execute(f'DELETE FROM {self.table(kind)}')
+                cursor.execute(insert)
+                return
+            for batch in chunked(pks, 500):
+                placeholders = ', '.join(['%s'] * len(batch))
+                cursor.execute(f'DELETE FROM {self.table(kind)} WHERE rowid IN ({placeholders})', batch)
+                cursor.execute(f'{insert} WHERE id IN ({placeholders})', batch)
+
+    def matching(self, kind, term):
+        tokens = words(term)
+        if not tokens:
+            return None
+        query = ' '.join(f'"{token}"*' for token in tokens)
+        return RawSQL(f'SELECT rowid FROM {self.table(kind)} WHERE {self.table(kind)} MATCH %s', [query])
+
+
+def search_backend():
+    path = getattr(settings, 'LIBRARY_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return SQLiteFTSBackend() if connection.vendor == 'sqlite' else SearchBackend()
+
+
+def register_fold_function(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('library_fold', 1, fold, deterministic=True)
+
+
+def create_search_tables(sender, **kwargs):
+    backend = search_backend()
+    if backend.ensure_tables():
+        for kind in INDEXED_FIELDS:
+            backend.rebuild(kind)
+
+
+def index_object(sender, instance, **kwargs):
+    search_backend().index(sender._meta.model_name, instance)
+
+
+def remove_object(sender, instance, **kwargs):
+    search_backend().remove(sender._meta.model_name, instance.pk)
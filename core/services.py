@@ -0,0 +1,186 @@
+from collections import Counter
+from datetime import date
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import Least
+from django.utils import timezone
+
+from .models import Book, BookStock, Reader, Loan, Hold, LOAN_PERIOD, move_stock, next_version, stock_states
+
+
+def chunked(iterable, size):
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+def _per_pk(deltas):
+    return Case(*[When(pk=pk, then=Value(n)) for pk, n in deltas.items()], default=Value(0))
+
+
+def adjust_inventory(deltas, new_loans=False):
+    """Apply {book_id: delta} to Book.available and the loan counters in one guarded UPDATE.
+
+    Negative deltas only apply while enough copies are left and positive ones
+    are capped at total_quantity; active_loans moves the opposite way and
+    loan_count grows with checkouts of new loans. Returns the number of books updated.
+    """
+    deltas = {book_id: n for book_id, n in deltas.items() if n}
+    if not deltas:
+        return 0
+    guard = Q()
+    for book_id, n in deltas.items():
+        guard |= Q(pk=book_id, available__gte=-n) if n < 0 else Q(pk=book_id)
+    changes = {'available': Least(F('available') + _per_pk(deltas), F('total_quantity')),
+               'active_loans': F('active_loans') - _per_pk(deltas), 'modified_at': timezone.now(),
+               'version': next_version()}
+    if new_loans:
+        changes['loan_count'] = F('loan_count') - _per_pk(deltas)
+    return Book.all_objects.filter(guard).update(**changes)
+
+
+def hand_to_holds(per_book):
+    """Give returned copies, {book_id: n}, to the waiting holds first; returns what is left for the shelf."""
+    waiting = Hold.objects.filter(book__in=per_book, status='waiting').values_list('book', flat=True).distinct()
+    for book_id in set(waiting):
+        allocated = Hold.objects.allocate(book_id, per_book[book_id])
+        if allocated:
+            Book.all_objects.filter(pk=book_id).update(
+                active_loans=F('active_loans') - allocated, reserved=F('reserved') + allocated,
+                modified_at=timezone.now(), version=next_version())
+        per_book[book_id] -= allocated
+    return per_book
+
+
+def claim_holds(pairs, book_ids):
+    """Fulfil the ready holds of the (reader_id, book_id) pairs on these books; returns {book_id: n} claimed."""
+    if not book_ids:
+        return Counter()
+    wanted = set(pairs)
+    ready = {(reader_id, book_id): pk for pk, reader_id, book_id in Hold.objects.filter(
+        book__in=book_ids, reader__in={reader_id for reader_id, _ in wanted}, status='ready',
+    ).values_list('pk', 'reader_id', 'book_id') if (reader_id, book_id) in wanted}
+    if not ready:
+        return Counter()
+    if Hold.objects.filter(pk__in=ready.values(), status='ready').update(
+            status='fulfilled', closed_at=timezone.now()) != len(ready):
+        raise ValidationError('Lượt đặt trước đã thay đổi, vui lòng thử lại')
+    return Counter(book_id for _, book_id in ready)
+
+
+def take_reserved(per_book):
+    """Move {book_id: n} copies held for readers onto their new loans in one UPDATE."""
+    per_book = {book_id: n for book_id, n in per_book.items() if n}
+    if per_book:
+        Book.all_objects.filter(pk__in=per_book).update(
+            reserved=F('reserved') - _per_pk(per_book), active_loans=F('active_loans') + _per_pk(per_book),
+            loan_count=F('loan_count') + _per_pk(per_book), modified_at=timezone.now(), version=next_version())
+
+
+def adjust_active_loans(deltas):
+    deltas = {reader_id: n for reader_id, n in deltas.items() if n}
+    if deltas:
+        Reader.objects.filter(pk__in=deltas).update(active_loans=F('active_loans') + _per_pk(deltas))
+
+
+class LoanService:
+    """Batch circulation with the same rules as Loan.save() in a constant number of queries per batch."""
+
+    batch_size = 1000
+
+    @classmethod
+    def bulk_checkout(cls, pairs, borrow_date=None, batch_size=None):
+        """Create borrowing loans for (reader, book) pairs; accepts instances or ids.
+
+        All or nothing: the batches share one transaction, so a ValidationError
+        in any of them leaves no loan of the call behind.
+        """
+        borrow_date = borrow_date or date.today()
+        created = []
+        with transaction.atomic():
+            for batch in chunked(pairs, batch_size or cls.batch_size):
+                created += cls._checkout_batch([(_pk(r), _pk(b)) for r, b in batch], borrow_date)
+        return created
+
+    @classmethod
+    def _checkout_batch(cls, pairs, borrow_date):
+        needed = Counter(book_id for _, book_id in pairs)
+        # Locked: the category snapshots move by exactly what this batch does to the books
+        books = {pk: (title, BookStock(*state)) for pk, title, *state in Book.objects.select_for_update()
+                 .filter(pk__in=needed).values_list('pk', 'title', *BookStock._fields)}
+
+        missing = set(needed) - set(books)
+        if missing:
+            raise ValidationError(f'Không tìm thấy sách: {", ".join(map(str, sorted(missing)))}')
+
+        # As in Loan.save(), a reader whose hold is ready gets the copy kept for them
+        reserved = claim_holds(pairs, [pk for pk, (_, state) in books.items() if state.reserved])
+        shelf = needed - reserved
+        short = [title for pk, (title, state) in books.items() if state.available < shelf[pk]]
+        if short:
+            raise ValidationError([f'Sách "{title}" đã hết' for title in short])
+
+        # Someone may have borrowed in between; the guarded UPDATE is the real check.
+        if adjust_inventory({pk: -n for pk, n in shelf.items()}, new_loans=True) != len(shelf):
+            raise ValidationError('Số lượng sách đã thay đổi, vui lòng thử lại')
+        take_reserved(reserved)
+        move_stock([state for _, state in books.values()], [
+            state._replace(available=state.available - shelf[pk], active_loans=state.active_loans + needed[pk],
+                           reserved=state.reserved - reserved[pk])
+            for pk, (_, state) in books.items()
+        ])
+        adjust_active_loans(Counter(reader_id for reader_id, _ in pairs))
+
+        due_date = borrow_date + LOAN_PERIOD
+        return Loan.objects.bulk_create([
+            Loan(reader_id=reader_id, book_id=book_id, borrow_date=borrow_date, due_date=due_date,
+                 status='borrowing')
+            for reader_id, book_id in pairs
+        ])
+
+    @classmethod
+    def bulk_return(cls, loan_ids, return_date=None, batch_size=None):
+        """Mark borrowing loans as returned; loans already returned are skipped.
+
+        Each batch commits on its own, so after a failure the batches before it
+        stay returned and calling again with the same ids finishes the rest.
+        """
+        return_date = return_date or date.today()
+        returned = 0
+        for batch in chunked(loan_ids, batch_size or cls.batch_size):
+            with transaction.atomic():
+                returned += cls._return_batch([_pk(loan) for loan in batch], return_date)
+        return returned
+
+    @classmethod
+    def _return_batch(cls, loan_ids, return_date):
+        borrowing = Loan.objects.filter(pk__in=loan_ids, status='borrowing')
+        rows = borrowing.values('book_id', 'reader_id').annotate(n=Count('pk'))
+        per_book, per_reader = Counter(), Counter()
+        for book_id, reader_id, n in rows.values_list('book_id', 'reader_id', 'n'):
+            per_book[book_id] += n
+            per_reader[reader_id] -= n
+        expected = sum(per_book.values())
+        if not expected:
+            return 0
+
+        if borrowing.update(status='returned', return_date=return_date, version=next_version()) != expected:
+            raise ValidationError('Phiếu mượn đã thay đổi, vui lòng thử lại')
+        before, returned = stock_states(per_book), Counter(per_book)
+        shelved = hand_to_holds(per_book)
+        adjust_inventory(shelved)
+        move_stock(before.values(), [
+            state._replace(available=min(state.available + shelved[pk], state.total_quantity),
+                           active_loans=state.active_loans - returned[pk],
+                           reserved=state.reserved + returned[pk] - shelved[pk])
+            for pk, state in before.items()
+        ])
+        adjust_active_loans(per_reader)
+        return expected
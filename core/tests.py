@@ -1,3 +1,1241 @@
-from django.test import TestCase
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.thread import BrokenThreadPool
+from contextlib import closing
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Permission, User
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import cache as catalog_cache
+from . import jobs
+from .archive import archive_loans
+from .holds import expire_holds
+from .management.commands.bench import admin_cases, sort_by
+from .management.commands.bench_indexes import circulation_queries
+from .admin import LoanAdmin, ReaderAdmin, ReportAdmin
+from .models import (Category, Book, Reader, Loan, Damage, ArchivedLoan, DailyBookStat, DailyCategoryStat, Job,
+                     Hold, HoldQuerySet, Reminder, EditConflict)
+from .reminders import Sender, loans_by_reader, send_reminders
+from .reports import build_rollups, open_loans_at
+from .search import fold, search_backend
+from .services import LoanService
+
+
+class LibraryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Văn học")
+        cls.book = Book.objects.create(code="VH001", title="Dế Mèn Phiêu Lưu Ký", category=cls.category,
+                                       author="Tô Hoài", publisher="NXB Kim Đồng", price=50000,
+                                       total_quantity=2, available=2)
+        cls.reader = Reader.objects.create(card_id="BD001", full_name="Nguyễn Văn A", phone="0901234567")
+
+    def borrow(self, book=None, reader=None, **kwargs):
+        return Loan.objects.create(reader=reader or self.reader, book=book or self.book,
+                                   borrow_date=kwargs.pop('borrow_date', date(2026, 1, 1)), **kwargs)
+
+    def login_viewer(self, *model_names):
+        # Staff who may look at these models but change nothing
+        user = User.objects.create_user('viewer', 'viewer@example.com', 'viewer', is_staff=True)
+        user.user_permissions.set(Permission.objects.filter(
+            content_type__app_label='core', codename__in=[f'view_{name}' for name in model_names]))
+        self.client.force_login(user)
+
+
+class InventoryTests(LibraryTestCase):
+    def test_checkout_and_return_adjust_available(self):
+        loan = self.borrow()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 1)
+
+        loan.status = 'returned'
+        loan.return_date = date(2026, 1, 10)
+        loan.save()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 2)
+
+    def test_checkout_never_oversells(self):
+        # Stale in-memory copies must not allow a third checkout of two copies.
+        self.borrow(book=Book.objects.get(pk=self.book.pk))
+        self.borrow(book=Book.objects.get(pk=self.book.pk))
+        with self.assertRaises(ValidationError):
+            self.borrow(book=Book.objects.get(pk=self.book.pk))
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+        self.assertEqual(Loan.objects.count(), 2)
+
+    def test_checkout_does_not_rewrite_book_row(self):
+        stale = Book.objects.get(pk=self.book.pk)
+        Book.objects.filter(pk=self.book.pk).update(title="Dế Mèn")
+        self.borrow(book=stale)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.title, "Dế Mèn")
+
+    def test_lost_damage_removes_copy(self):
+        loan = self.borrow()
+        Damage.objects.create(loan=loan, damage_type='lost')
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.total_quantity, self.book.available), (1, 1))
+
+
+class LoanServiceTests(LibraryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = Book.objects.create(code="VH002", title="Số Đỏ", category=cls.category,
+                                        author="Vũ Trọng Phụng", publisher="NXB Văn học", price=80000,
+                                        total_quantity=3, available=3)
+
+    def test_bulk_checkout_runs_constant_queries(self):
+        pairs = [(self.reader, self.book), (self.reader, self.other), (self.reader.pk, self.other.pk)]
+        # savepoint, locked check, book update, category update, reader update, insert, release
+        with self.assertNumQueries(7):
+            loans = LoanService.bulk_checkout(pairs, borrow_date=date(2026, 1, 1))
+        self.assertEqual(len(loans), 3)
+        self.assertEqual(loans[0].due_date, date(2026, 1, 15))
+        self.assertEqual(dict(Book.objects.values_list('code', 'available')), {"VH001": 1, "VH002": 1})
+
+    def test_bulk_checkout_rejects_whole_batch_when_short(self):
+        with self.assertRaises(ValidationError):
+            LoanService.bulk_checkout([(self.reader, self.book)] * 3)
+        self.assertFalse(Loan.objects.exists())
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 2)
+
+    def test_bulk_checkout_is_all_or_nothing_across_batches(self):
+        with self.assertRaises(ValidationError):
+            LoanService.bulk_checkout([(self.reader, self.other), (self.reader, self.book)] * 2
+                                      + [(self.reader, self.book)], batch_size=2)
+        self.assertFalse(Loan.objects.exists())
+        self.assertEqual(dict(Book.objects.values_list('code', 'available')), {"VH001": 2, "VH002": 3})
+
+    def test_view_only_staff_cannot_mark_loans_returned(self):
+        loan = self.borrow()
+        self.login_viewer('loan')
+        changelist = reverse('admin:core_loan_changelist')
+        self.assertNotContains(self.client.get(changelist), 'mark_returned')
+        self.client.post(changelist, {'action': 'mark_returned', '_selected_action': [loan.pk]})
+        loan.refresh_from_db()
+        self.assertEqual(loan.status, 'borrowing')
+
+    def test_bulk_return_releases_copies_once(self):
+        loans = LoanService.bulk_checkout([(self.reader, self.book), (self.reader, self.other)])
+        ids = [loan.pk for loan in loans]
+        self.assertEqual(LoanService.bulk_return(ids, date(2026, 1, 20)), 2)
+        self.assertEqual(LoanService.bulk_return(ids, date(2026, 1, 21)), 0)
+        self.assertEqual(dict(Book.objects.values_list('code', 'available')), {"VH001": 2, "VH002": 3})
+        self.assertEqual(set(Loan.objects.values_list('return_date', flat=True)), {date(2026, 1, 20)})
+
+
+class ReaderAdminTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        Book.objects.filter(pk=self.book.pk).update(total_quantity=50, available=50)
+
+    def add_reader_with_debt(self, n):
+        reader = Reader.objects.create(card_id=f"BD1{n:02}", full_name=f"Bạn đọc {n}", phone="0900000000")
+        loan = self.borrow(reader=reader, borrow_date=date(2020, 1, 1))
+        Damage.objects.create(loan=loan, damage_type='minor', compensation_fee=10000)
+
+    def changelist_queries(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('admin:core_reader_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_changelist_queries_do_not_grow_with_readers(self):
+        self.add_reader_with_debt(1)
+        baseline = self.changelist_queries()
+        for n in range(2, 12):
+            self.add_reader_with_debt(n)
+        self.assertEqual(self.changelist_queries(), baseline)
+        self.assertEqual(self.changelist_queries(o='-5'), baseline)
+        self.assertEqual(self.changelist_queries(debt='damages'), baseline)
+
+    def test_with_debt_figures(self):
+        self.add_reader_with_debt(1)
+        reader = Reader.objects.with_debt(as_of=date(2020, 1, 20)).get(card_id="BD101")
+        self.assertEqual((reader.unpaid_damages, reader.unpaid_total, reader.overdue_fine), (1, 10000, 5000))
+        self.assertEqual(Reader.objects.with_debt().get(pk=self.reader.pk).unpaid_damages, 0)
+
+
+class CounterTests(LibraryTestCase):
+    def counters(self):
+        self.book.refresh_from_db()
+        self.reader.refresh_from_db()
+        return (self.book.loan_count, self.book.active_loans, self.reader.active_loans,
+                self.reader.unpaid_damages, self.reader.unpaid_total)
+
+    def test_write_paths_maintain_counters(self):
+        loan = self.borrow()
+        self.borrow(status='returned', return_date=date(2026, 1, 5))
+        self.assertEqual(self.counters(), (2, 1, 1, 0, 0))
+
+        damage = Damage.objects.create(loan=loan, damage_type='minor', compensation_fee=15000)
+        self.assertEqual(self.counters(), (2, 1, 1, 1, 15000))
+        damage.is_paid = True
+        damage.save()
+        self.assertEqual(self.counters(), (2, 1, 1, 0, 0))
+
+        LoanService.bulk_return([loan.pk])
+        LoanService.bulk_checkout([(self.reader, self.book)] * 2)
+        self.assertEqual(self.counters(), (4, 2, 2, 0, 0))
+
+    def test_deletes_give_back_their_counts(self):
+        loan, other = self.borrow(), self.borrow()
+        damage = Damage.objects.create(loan=loan, damage_type='minor', compensation_fee=15000)
+        lost = Damage.objects.create(loan=other, damage_type='lost')
+        with self.assertRaises(ValidationError):
+            lost.delete()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.client.post(reverse('admin:core_damage_changelist'),
+                         {'action': 'delete_selected', '_selected_action': [damage.pk], 'post': 'yes'})
+        self.assertEqual(self.counters(), (2, 2, 2, 1, 100000))
+        self.client.post(reverse('admin:core_loan_delete', args=[loan.pk]), {'post': 'yes'})
+        self.assertFalse(Loan.objects.filter(pk=loan.pk).exists())
+        self.assertEqual(self.counters(), (1, 1, 1, 1, 100000))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_loan_cannot_change_reader_or_book(self):
+        loan = self.borrow()
+        loan.reader = Reader.objects.create(card_id='BD002', full_name='B', phone='0900000000')
+        with self.assertRaises(ValidationError):
+            loan.save()
+
+    def test_reader_edit_keeps_counters_moved_meanwhile(self):
+        loaded = Reader.objects.get(pk=self.reader.pk)
+        self.borrow()
+        loaded.phone = '0911111111'
+        loaded.save()
+        self.assertEqual(self.counters()[2], 1)
+        self.assertEqual(self.reader.phone, '0911111111')
+
+    def test_rebuild_counters_repairs_drift(self):
+        loan = self.borrow()
+        Damage.objects.create(loan=loan, damage_type='minor', compensation_fee=15000)
+        Book.objects.update(loan_count=7, active_loans=0)
+        Reader.objects.update(unpaid_total=0)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_counters', check=True, stdout=StringIO())
+        call_command('rebuild_counters', stdout=StringIO())
+        self.assertEqual(self.counters(), (1, 1, 1, 1, 15000))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+
+class VersioningTests(LibraryTestCase):
+    def test_stale_save_is_refused(self):
+        loan = self.borrow()
+        first, second = Loan.objects.get(pk=loan.pk), Loan.objects.get(pk=loan.pk)
+        first.due_date = date(2026, 2, 1)
+        first.save()
+        second.status, second.return_date = 'returned', date(2026, 1, 10)
+        with self.assertRaises(EditConflict):
+            second.save()
+        loan.refresh_from_db()
+        self.book.refresh_from_db()
+        self.assertEqual((loan.status, loan.due_date, loan.version), ('borrowing', date(2026, 2, 1), 1))
+        self.assertEqual(self.book.available, 1)
+
+    def test_transitions_come_from_loaded_state(self):
+        loan = Loan.objects.select_related('book').get(pk=self.borrow().pk)
+        loan.status, loan.return_date = 'returned', date(2026, 1, 10)
+        with CaptureQueriesContext(connection) as ctx:
+            loan.save()
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'core_loan' in q['sql']])
+        loan.save()  # already returned: the copy is not released twice
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.available, self.book.active_loans), (2, 0))
+
+    def test_admin_refuses_edit_over_newer_version(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:core_book_change', args=[self.book.pk])
+        form = self.client.get(url).context['adminform'].form
+        data = {'code': 'VH001', 'title': 'Dế Mèn', 'category': self.category.pk, 'author': 'Tô Hoài',
+                'publisher': 'NXB Kim Đồng', 'price': 50000, 'total_quantity': 2, 'available': 2,
+                'is_active': 'on', 'loaded_version': form.initial['loaded_version']}
+        self.borrow()  # a checkout at another desk while the page is open
+        response = self.client.post(url, data)
+        self.assertContains(response, 'đã được người khác thay đổi')
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.title, self.book.available), ('Dế Mèn Phiêu Lưu Ký', 1))
+
+        data.update(available=1, loaded_version=self.book.version)
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.title, self.book.active_loans), ('Dế Mèn', 1))
+
+
+class IndexTests(LibraryTestCase):
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_circulation_queries_are_index_backed(self):
+        plans = {name: self.plan(queryset) for name, queryset in circulation_queries().items()}
+        for name, plan in plans.items():
+            # No step of any query reads a whole table
+            self.assertFalse([step for step in plan if step.startswith('SCAN') and 'INDEX' not in step], name)
+        for name, index in [('reader_history', 'loan_reader_history_idx'), ('book_active_loans', 'loan_book_status_idx'),
+                            ('damage_unpaid', 'damage_unpaid_idx'), ('damage_lost', 'damage_type_reported_idx')]:
+            self.assertIn(index, plans[name][0], name)
+
+
+class GenerateLibraryTests(TestCase):
+    def test_generated_counters_are_consistent(self):
+        call_command('generate_library', books=20, readers=10, loans=500, damage_rate=0.2, batch_size=64, keep_indexes=True,
+                     stdout=StringIO())
+        self.assertEqual(Loan.objects.count(), 500)
+        self.assertTrue(Damage.objects.exists())
+        self.assertFalse(Book.all_objects.filter(available__lt=0).exists())
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_clear_deletes_what_refers_to_the_catalog(self):
+        call_command('generate_library', books=5, readers=5, loans=50, keep_indexes=True, stdout=StringIO())
+        build_rollups()
+        self.assertTrue(DailyBookStat.objects.exists())
+        Reminder.objects.create(reader=Reader.objects.last(), day=date.today(), message='', status='sent')
+        call_command('generate_library', books=5, readers=5, loans=50, keep_indexes=True, clear=True,
+                     stdout=StringIO())
+        connection.check_constraints()
+        self.assertEqual(Loan.objects.count(), 50)
+        self.assertFalse(DailyBookStat.objects.exists() or DailyCategoryStat.objects.exists())
+        self.assertFalse(Reminder.objects.exists())
+
+
+class SearchTests(LibraryTestCase):
+    def test_fold_strips_vietnamese_diacritics(self):
+        self.assertEqual(fold("Dế Mèn Phiêu Lưu Ký"), "de men phieu luu ky")
+        self.assertEqual(fold("Đỗ Đức"), "do duc")
+
+    def test_admin_search_is_accent_insensitive(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.borrow()
+        for url, term in [('admin:core_book_changelist', 'de men'), ('admin:core_loan_changelist', 'nguyen van'),
+                          ('admin:core_reader_changelist', 'bd00')]:
+            response = self.client.get(reverse(url), {'q': term})
+            self.assertEqual(response.context['cl'].result_count, 1, url)
+
+    def test_admin_search_words_may_match_different_indexes(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        other = Reader.objects.create(card_id="BD002", full_name="Trần Thị B", phone="0900000000")
+        self.borrow(), self.borrow(reader=other)
+        for term, count in [('BD001 Dế Mèn', 1), ('BD001 số đỏ', 0), ('de men', 2)]:
+            response = self.client.get(reverse('admin:core_loan_changelist'), {'q': term})
+            self.assertEqual(response.context['cl'].result_count, count, term)
+
+    def test_index_follows_saves_and_deletes(self):
+        self.book.title = "Đất Rừng Phương Nam"
+        self.book.save()
+        def matches(term):
+            return list(Book.all_objects.filter(pk__in=search_backend().matching('book', term)))
+        self.assertEqual(matches("dat rung"), [self.book])
+        self.assertEqual(matches("de men"), [])
+        self.book.delete()
+        self.assertEqual(matches("dat rung"), [])
+
+
+class FineTests(LibraryTestCase):
+    def test_fines_are_annotated_in_sql(self):
+        late = self.borrow(due_date=date(2026, 1, 7), return_date=date(2026, 1, 10), status='returned')
+        on_time = self.borrow(due_date=date(2026, 1, 7), return_date=date(2026, 1, 5), status='returned')
+        still_out = self.borrow(due_date=date(2026, 1, 15))
+        loans = Loan.objects.with_fines(as_of=date(2026, 1, 20)).order_by('-fine_amount')
+        self.assertEqual([(loan.pk, loan.days_overdue, loan.fine_amount) for loan in loans],
+                         [(still_out.pk, 5, 5000), (late.pk, 3, 3000), (on_time.pk, 0, 0)])
+        self.assertEqual(late.fine, 3000)
+        self.assertEqual(list(Loan.objects.overdue(as_of=date(2026, 1, 20))), [still_out])
+        self.assertEqual(Loan.objects.overdue(as_of=date(2026, 1, 15)).count(), 0)
+
+    def test_changelist_shows_fine_totals(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.borrow(due_date=date(2026, 1, 7), return_date=date(2026, 1, 10), status='returned')
+        self.borrow(due_date=date(2026, 1, 7), return_date=date(2026, 1, 8), status='returned')
+        response = self.client.get(reverse('admin:core_loan_changelist') + '?fine=late&'
+                                   + sort_by(LoanAdmin, 'display_fine', descending=True))
+        self.assertEqual(response.context['fine_totals'], {'fine': '4,000', 'overdue': 2})
+        self.assertEqual([loan.fine_amount for loan in response.context['cl'].result_list], [3000, 1000])
+        response = self.client.get(reverse('admin:core_loan_changelist'))
+        self.assertNotIn('fine_totals', response.context)
+
+
+class BenchTests(LibraryTestCase):
+    def test_admin_cases_render_and_sort_the_named_column(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        Damage.objects.create(loan=self.borrow(), damage_type='minor')
+        cases = dict(admin_cases())
+        for name, url in cases.items():
+            self.assertEqual(self.client.get(url).status_code, 200, name)
+        cl = self.client.get(cases['loan_sort_fine']).context['cl']
+        self.assertEqual([cl.list_display[i] for i in cl.get_ordering_field_columns()], ['display_fine'])
+
+
+class ReaderHistoryTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        Book.objects.filter(pk=self.book.pk).update(total_quantity=100, available=100)
+
+    def add_returned(self, n):
+        for day in range(1, n + 1):
+            self.borrow(borrow_date=date(2025, 1, 1) + timedelta(days=day % 5),
+                        status='returned', return_date=date(2025, 2, 1))
+
+    def change_page_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('admin:core_reader_change', args=[self.reader.pk]))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response
+
+    def test_change_page_cost_is_flat(self):
+        self.add_returned(3)
+        self.change_page_queries()  # warm the content type cache
+        baseline, _ = self.change_page_queries()
+        self.add_returned(60)
+        current = self.borrow()
+        queries, response = self.change_page_queries()
+        self.assertEqual(queries, baseline)
+        self.assertEqual(response.context['current_loans'][0], current)
+        self.assertEqual(len(response.context['history']), ReaderAdmin.history_page_size)
+
+    def test_keyset_pages_cover_history_once(self):
+        self.add_returned(45)
+        seen, url = [], reverse('admin:core_reader_history', args=[self.reader.pk])
+        while url:
+            response = self.client.get(url)
+            seen += [loan.pk for loan in response.context['history']]
+            url = response.context['history_next_url']
+        expected = list(Loan.objects.history().values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), 45)
+
+
+class ExportTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def test_admin_export_applies_filters(self):
+        self.borrow(status='returned', return_date=date(2026, 1, 20))
+        self.borrow(borrow_date=date(2026, 2, 1))
+        response = self.client.get(reverse('admin:core_loan_export') + '?status__exact=returned&format=csv')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Tiền phạt', lines[0])
+        self.assertTrue(lines[1].endswith('Đã trả,5,5000'))
+
+    def test_changelist_links_to_export(self):
+        response = self.client.get(reverse('admin:core_book_changelist') + '?is_active__exact=1')
+        self.assertContains(response, reverse('admin:core_book_export') + '?format=csv&amp;is_active__exact=1')
+
+    @override_settings(LIBRARY_EXPORT_XLSX_SYNC_ROWS=1)
+    def test_large_xlsx_export_goes_to_the_workers(self):
+        self.borrow(), self.borrow()
+        with mock.patch('core.admin.FORMATS', ['csv', 'xlsx']):
+            response = self.client.get(reverse('admin:core_loan_export') + '?format=xlsx')
+        self.assertRedirects(response, reverse('admin:core_job_changelist'), fetch_redirect_response=False)
+        self.assertEqual(Job.objects.get().params['fmt'], 'xlsx')
+
+    def test_export_command(self):
+        Damage.objects.create(loan=self.borrow(), damage_type='lost')
+        out = StringIO()
+        call_command('export_damages', stdout=out)
+        lines = out.getvalue().lstrip('﻿').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Mất sách,', lines[1])
+        self.assertIn(',100000,Không,', lines[1])
+
+
+class ImportTests(LibraryTestCase):
+    BOOKS = ('code,title,category,author,publisher,price,total_quantity\n'
+             'VH001,Dế Mèn Phiêu Lưu Ký (tái bản),Văn học,Tô Hoài,NXB Kim Đồng,60000,3\n'
+             'KH001,Vũ Trụ,Khoa học,Carl Sagan,NXB Trẻ,120000,4\n'
+             'KH002,Thiếu giá,Khoa học,Ai đó,NXB Trẻ,abc,1\n')
+
+    def import_books(self, content, *args):
+        path = self.enterContext(tempfile.TemporaryDirectory()) + '/books.csv'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', 'book', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_upsert_keeps_copies_on_loan(self):
+        self.borrow()
+        out, err = self.import_books(self.BOOKS)
+        self.assertIn('Thêm mới 1, cập nhật 1, lỗi 1', out)
+        self.assertIn('Dòng 4:', err)
+        book = Book.all_objects.get(code='VH001')
+        self.assertEqual((book.title, book.price, book.total_quantity, book.available, book.active_loans),
+                         ('Dế Mèn Phiêu Lưu Ký (tái bản)', 60000, 3, 2, 1))
+        self.assertEqual(Book.all_objects.get(code='KH001').category.name, 'Khoa học')
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_missing_is_active_column_keeps_retired_books(self):
+        self.book.is_active = False
+        self.book.save()
+        self.import_books(self.BOOKS)
+        self.assertFalse(Book.all_objects.get(code='VH001').is_active)
+        self.assertEqual(Category.objects.filter(pk=self.category.pk).values_list('books', 'retired_books').get(),
+                         (0, 1))
+        self.assertEqual(list(Book.objects.filter(pk__in=search_backend().matching('book', 'vu tru'))
+                              .values_list('code', flat=True)), ['KH001'])
+
+    def test_dry_run_writes_nothing(self):
+        out, _ = self.import_books(self.BOOKS, '--dry-run')
+        self.assertIn('[Chạy thử] Thêm mới 1, cập nhật 1, lỗi 1, thể loại mới 1', out)
+        self.assertFalse(Book.all_objects.filter(code='KH001').exists())
+        self.assertFalse(Category.objects.filter(name='Khoa học').exists())
+
+    def test_admin_upload_roundtrips_reader_export(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        exported = b''.join(self.client.get(reverse('admin:core_reader_export')).streaming_content)
+        upload = SimpleUploadedFile('readers.csv', exported.replace('Nguyễn Văn A'.encode(), 'Nguyễn Văn B'.encode()))
+        response = self.client.post(reverse('admin:core_reader_import'), {'file': upload})
+        self.assertContains(response, 'Thêm mới 0, cập nhật 1, lỗi 0')
+        self.reader.refresh_from_db()
+        self.assertEqual(self.reader.full_name, 'Nguyễn Văn B')
+
+    def test_admin_upload_reports_malformed_csv(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        upload = SimpleUploadedFile('readers.csv', b'card_id,full_name,phone\nBD009,"' + b'x' * 200000 + b'",0900\n')
+        response = self.client.post(reverse('admin:core_reader_import'), {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('field limit', str(response.context['form'].errors['file']))
+        self.assertFalse(Reader.objects.filter(card_id='BD009').exists())
+
+
+class RollupTests(LibraryTestCase):
+    def setUp(self):
+        loan = self.borrow()
+        loan.status, loan.return_date = 'returned', date(2026, 1, 20)
+        loan.save()
+        Damage.objects.create(loan=loan, damage_type='minor', reported_date=date(2026, 1, 20))
+        self.borrow(borrow_date=date(2026, 1, 10))
+
+    def test_rollup_matches_loans_and_is_incremental(self):
+        self.assertEqual(build_rollups(until=date(2026, 1, 31)), 31)
+        library = {row.day: row for row in DailyCategoryStat.objects.filter(category=None)}
+        for day, row in library.items():
+            self.assertEqual([row.open_loans, row.overdue], open_loans_at(day)[self.category.pk], day)
+        returned = library[date(2026, 1, 20)]
+        self.assertEqual((returned.returns, returned.late_returns, returned.fines, returned.damage_cost),
+                         (1, 1, 5000, 15000))
+        self.assertEqual(DailyBookStat.objects.aggregate(n=Sum('loans'), o=Sum('new_overdue')), {'n': 2, 'o': 2})
+
+        self.assertEqual(build_rollups(until=date(2026, 1, 31)), 0)
+        self.assertEqual(build_rollups(until=date(2026, 2, 2)), 2)
+        self.assertEqual(DailyCategoryStat.objects.get(category=None, day=date(2026, 2, 2)).overdue, 1)
+
+    def test_dashboard_reads_rollups_only(self):
+        build_rollups(until=date(2026, 1, 31))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('admin:core_dailycategorystat_changelist') + '?days=90')
+        self.assertEqual(response.context['top_books'][0]['loans'], 2)
+        self.assertEqual(response.context['categories'][0]['overdue_rate'], 1)
+        self.assertFalse([q for q in ctx.captured_queries if 'core_loan' in q['sql'] or 'core_damage' in q['sql']])
+
+    def test_dashboard_bounds_the_period(self):
+        build_rollups(until=date(2026, 1, 31))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        for days, period in [('10' * 12, ReportAdmin.max_period), ('-5', 1), ('abc', 30)]:
+            response = self.client.get(reverse('admin:core_dailycategorystat_changelist'), {'days': days})
+            self.assertEqual((response.status_code, response.context['period']), (200, period), days)
+
+
+class CatalogCacheTests(LibraryTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_str_uses_cache_and_save_invalidates(self):
+        loan = self.borrow()
+        damage = Damage.objects.create(loan=loan, damage_type='minor')
+        str(Damage.objects.get(pk=damage.pk))
+        misses = catalog_cache.metrics['book.miss']
+        with self.assertNumQueries(1):
+            self.assertEqual(str(Damage.objects.get(pk=damage.pk)),
+                             'Dế Mèn Phiêu Lưu Ký - Hư hỏng nhẹ (Nguyễn Văn A)')
+        self.assertEqual(catalog_cache.metrics['book.miss'], misses)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.title = 'Dế Mèn'
+            self.book.save()
+            # Not before the commit: a read meanwhile would cache the old title again
+            self.assertEqual(catalog_cache.get('book', self.book.pk).title, 'Dế Mèn Phiêu Lưu Ký')
+        self.assertEqual(str(Loan.objects.get(pk=loan.pk)), 'Nguyễn Văn A - Dế Mèn')
+        self.assertEqual(catalog_cache.metrics['book.miss'], misses + 1)
+
+
+class AutocompleteTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def lookup(self, model_name, field_name, term='', page=1):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('admin:autocomplete'), {
+                'app_label': 'core', 'model_name': model_name, 'field_name': field_name, 'term': term, 'page': page})
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        return response.json()
+
+    def test_form_size_is_independent_of_table_size(self):
+        url = reverse('admin:core_loan_add')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            before = len(self.client.get(url).content)
+        Reader.objects.bulk_create([Reader(card_id=f'BD{i:03d}', full_name=f'Bạn đọc {i}', phone='0900000000')
+                                    for i in range(100, 150)])
+        with self.assertNumQueries(len(ctx)):
+            self.assertEqual(len(self.client.get(url).content), before)
+
+    def test_book_lookup_is_active_only_and_paginated(self):
+        Book.all_objects.bulk_create([
+            Book(code=f'KH{i:03d}', title=f'Khoa học {i}', category=self.category, author='A', publisher='B',
+                 price=1000, total_quantity=1, available=1, is_active=i % 2 == 0)
+            for i in range(50)
+        ])
+        data = self.lookup('loan', 'book')
+        self.assertEqual(len(data['results']), 20)
+        self.assertTrue(data['pagination']['more'])
+        last = self.lookup('loan', 'book', page=2)
+        self.assertEqual(len(last['results']), 6)
+        self.assertFalse(last['pagination']['more'])
+        codes = {Book.all_objects.get(pk=r['id']).code for r in data['results'] + last['results']}
+        self.assertEqual(codes, {'VH001'} | {f'KH{i:03d}' for i in range(0, 50, 2)})
+
+    def test_loan_lookup_skips_lost_copies(self):
+        lost, kept = self.borrow(), self.borrow()
+        Damage.objects.create(loan=lost, damage_type='lost')
+        Damage.objects.create(loan=kept, damage_type='minor')
+        data = self.lookup('damage', 'loan', term='Nguyễn')
+        self.assertEqual([r['id'] for r in data['results']], [str(kept.pk)])
+
+
+class PerfMiddlewareTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.sink = self.enterContext(tempfile.TemporaryDirectory()) + '/perf.sqlite3'
+
+    def test_records_queries_and_repeats(self):
+        for i in range(5):
+            Reader.objects.create(card_id=f'BD1{i:02d}', full_name=f'Bạn đọc {i}', phone='0900000000')
+        with self.settings(LIBRARY_PERF_SAMPLE_RATE=1, LIBRARY_PERF_SINK=self.sink, LIBRARY_PERF_DUPLICATES=3):
+            self.client.get(reverse('admin:core_reader_changelist'))
+            with mock.patch.object(ReaderAdmin, 'display_unpaid_total',
+                                   lambda admin, obj: Reader.objects.get(pk=obj.pk).unpaid_total):
+                self.client.get(reverse('admin:core_reader_changelist'))
+        with closing(sqlite3.connect(self.sink)) as db:
+            rows = db.execute('SELECT view, queries, duplicates FROM perf_request').fetchall()
+        self.assertEqual([row[0] for row in rows], ['admin:core_reader_changelist'] * 2)
+        self.assertEqual(json.loads(rows[0][2]), [])
+        self.assertEqual(rows[1][1], rows[0][1] + 6)
+        self.assertEqual(json.loads(rows[1][2])[0][0], 6)
+
+        out = StringIO()
+        call_command('perf_report', sink=self.sink, stdout=out)
+        self.assertIn('admin:core_reader_changelist', out.getvalue())
+        self.assertIn('nghi N+1', out.getvalue())
+
+    def test_sampling_disabled(self):
+        with self.settings(LIBRARY_PERF_SAMPLE_RATE=0, LIBRARY_PERF_SINK=self.sink):
+            self.client.get(reverse('admin:core_reader_changelist'))
+        self.assertFalse(os.path.exists(self.sink))
+
+
+class JobTests(LibraryTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def run_queue(self):
+        for pk in jobs.claim('test', 10):
+            jobs.run_job(pk)
+
+    def test_large_return_runs_in_background(self):
+        loans = [self.borrow(), self.borrow()]
+        with mock.patch.object(LoanService, 'batch_size', 1):
+            self.client.post(reverse('admin:core_loan_changelist'), {
+                'action': 'mark_returned', '_selected_action': [loan.pk for loan in loans]})
+            self.assertEqual(Loan.objects.filter(status='borrowing').count(), 2)
+            job = Job.objects.get()
+            self.assertEqual((job.task, job.status), ('bulk_return', 'queued'))
+            self.run_queue()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress, job.total, job.result), ('done', 2, 2, {'returned': 2}))
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.available, self.book.active_loans), (2, 0))
+
+        status = self.client.get(reverse('admin:core_job_status') + f'?ids={job.pk}').json()
+        self.assertEqual(status['jobs'][str(job.pk)]['status'], 'done')
+
+    def test_failures_are_retried_then_fail(self):
+        def boom(job):
+            raise RuntimeError('hỏng')
+
+        with mock.patch.dict(jobs.TASKS, {'boom': boom}), self.settings(LIBRARY_JOB_RETRY_DELAY=60):
+            job = jobs.enqueue('boom', max_attempts=2)
+            self.run_queue()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertIn('RuntimeError', job.error)
+            self.assertEqual(jobs.claim('test'), [])  # backing off
+
+            Job.objects.filter(pk=job.pk).update(run_after=job.created_at)
+            self.assertEqual(jobs.claim('test'), [job.pk])
+            self.assertEqual(jobs.claim('other'), [])
+            jobs.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_only_staff_who_may_change_jobs_retry_them(self):
+        job = Job.objects.create(task='rebuild_counters', status='failed', attempts=3)
+        changelist = reverse('admin:core_job_changelist')
+        self.assertContains(self.client.get(changelist), 'value="retry"')
+        self.login_viewer('job')
+        self.client.post(changelist, {'action': 'retry', '_selected_action': [job.pk]})
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+
+    def test_stale_jobs_are_requeued(self):
+        job = jobs.enqueue('rebuild_counters')
+        jobs.claim('test')
+        Job.objects.filter(pk=job.pk).update(heartbeat=job.created_at - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.claim('test'), [job.pk])
+
+    def test_requeued_run_does_not_record_its_result(self):
+        def slow(job):
+            # Taken for dead while still running, and claimed again by another worker
+            Job.objects.filter(pk=job.pk).update(heartbeat=job.created_at - timedelta(hours=1))
+            jobs.requeue_stale()
+            jobs.claim('other')
+            job.report(1, message='lần chạy cũ')
+            return {'run': 'first'}
+
+        with mock.patch.dict(jobs.TASKS, {'slow': slow}):
+            job = jobs.enqueue('slow')
+            self.run_queue()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.result, job.message), ('running', 'other', None, ''))
+
+    def test_background_export_keeps_filters(self):
+        self.borrow(status='returned', return_date=date(2026, 1, 20))
+        self.borrow(borrow_date=date(2026, 2, 1))
+        with self.settings(LIBRARY_JOB_OUTPUT_DIR=self.enterContext(tempfile.TemporaryDirectory())):
+            response = self.client.post(reverse('admin:core_loan_export') + '?status__exact=returned&format=csv')
+            self.assertRedirects(response, reverse('admin:core_job_changelist'))
+            self.run_queue()
+            job = Job.objects.get()
+            self.assertEqual((job.status, job.result['rows']), ('done', 1))
+            self.assertContains(self.client.get(reverse('admin:core_job_changelist')),
+                                reverse('admin:core_job_download', args=[job.pk]))
+            response = self.client.get(reverse('admin:core_job_download', args=[job.pk]))
+            lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('Đã trả,5,5000'))
+
+
+class HoldTests(LibraryTestCase):
+    def setUp(self):
+        self.readers = [Reader.objects.create(card_id=f'BD1{i:02d}', full_name=f'Bạn đọc {i}', phone='0900000000')
+                        for i in range(3)]
+        self.loans = [self.borrow(), self.borrow()]
+        self.holds = [Hold.objects.create(reader=reader, book=self.book) for reader in self.readers]
+
+    def counts(self):
+        self.book.refresh_from_db()
+        return self.book.available, self.book.active_loans, self.book.reserved
+
+    def status(self, i):
+        return Hold.objects.get(pk=self.holds[i].pk).status
+
+    def test_returned_copy_goes_to_the_head_of_the_queue(self):
+        self.assertEqual([hold.position() for hold in self.holds], [1, 2, 3])
+        loan = self.loans[0]
+        loan.status, loan.return_date = 'returned', date(2026, 1, 10)
+        loan.save()
+        self.assertEqual(self.status(0), 'ready')
+        self.assertEqual(Hold.objects.get(pk=self.holds[1].pk).position(), 1)
+        self.assertEqual(self.counts(), (0, 1, 1))
+        with self.assertRaises(ValidationError):
+            self.borrow(reader=self.readers[1])
+        self.borrow(reader=self.readers[0])
+        self.assertEqual(self.status(0), 'fulfilled')
+        self.assertEqual(self.counts(), (0, 2, 0))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_cancel_and_expiry_pass_the_copy_on(self):
+        self.holds[0].cancel()
+        self.assertEqual([Hold.objects.get(pk=hold.pk).position() for hold in self.holds[1:]], [1, 2])
+        LoanService.bulk_return([self.loans[0].pk], date(2026, 1, 10))
+        self.assertEqual((self.status(1), self.counts()), ('ready', (0, 1, 1)))
+
+        self.assertEqual(expire_holds(timezone.now() + timedelta(days=4)), 1)
+        self.assertEqual((self.status(1), self.status(2), self.counts()), ('expired', 'ready', (0, 1, 1)))
+        Hold.objects.get(pk=self.holds[2].pk).cancel()
+        self.assertEqual(self.counts(), (1, 1, 0))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_bulk_checkout_takes_the_copy_kept_for_the_reader(self):
+        LoanService.bulk_return([self.loans[0].pk], date(2026, 1, 10))
+        with self.assertRaises(ValidationError):
+            LoanService.bulk_checkout([(self.readers[1], self.book)])
+        LoanService.bulk_checkout([(self.readers[0], self.book)])
+        self.assertEqual((self.status(0), self.status(1), self.counts()), ('fulfilled', 'waiting', (0, 2, 0)))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_expiry_skips_a_hold_picked_up_meanwhile(self):
+        LoanService.bulk_return([self.loans[0].pk], date(2026, 1, 10))
+
+        update = HoldQuerySet.update
+
+        def pick_up_first(queryset, **kwargs):
+            # The reader borrows the book between the expiry's SELECT and its UPDATE
+            if kwargs.get('status') == 'expired':
+                self.book.refresh_from_db()
+                self.borrow(reader=self.readers[0])
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(HoldQuerySet, 'update', pick_up_first):
+            self.assertEqual(expire_holds(timezone.now() + timedelta(days=4)), 0)
+        self.assertEqual((self.status(0), self.status(1), self.counts()), ('fulfilled', 'waiting', (0, 2, 0)))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_view_only_staff_cannot_cancel_holds(self):
+        self.login_viewer('hold')
+        self.client.post(reverse('admin:core_hold_changelist'), {
+            'action': 'cancel_holds', '_selected_action': [hold.pk for hold in self.holds]})
+        self.assertEqual([self.status(i) for i in range(3)], ['waiting'] * 3)
+
+    def test_position_is_an_index_seek(self):
+        hold = Hold.objects.get(pk=self.holds[2].pk)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(hold.position(), 3)
+        self.assertEqual(len(ctx), 1)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + ctx.captured_queries[0]['sql'])
+            self.assertIn('hold_queue_idx', str(cursor.fetchall()))
+
+    @override_settings(LIBRARY_API_TOKEN='secret')
+    def test_kiosk_places_and_reads_holds(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Bearer secret'
+        data = {'card_id': 'BD001', 'book_code': 'VH001'}
+        placed = self.client.post(reverse('api:hold'), data, content_type='application/json')
+        self.assertEqual((placed.status_code, placed.json()['position']), (201, 4))
+        response = self.client.post(reverse('api:hold'), data, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.holds[0].cancel()
+        response = self.client.get(reverse('api:hold_status', args=[placed.json()['id']]))
+        self.assertEqual(response.json()['position'], 3)
+        response = self.client.get(reverse('api:hold_status', args=[placed.json()['id']]), HTTP_AUTHORIZATION='')
+        self.assertEqual(response.status_code, 401)
+
+
+class StockTests(LibraryTestCase):
+    def stock(self):
+        category = Category.objects.get(pk=self.category.pk)
+        return (category.books, category.books_available, category.copies, category.copies_available,
+                category.copies_on_loan, category.copies_reserved)
+
+    def test_single_and_batch_writes_move_the_snapshot(self):
+        self.assertEqual(self.stock(), (1, 1, 2, 2, 0, 0))
+        first, second = self.borrow(), self.borrow()
+        self.assertEqual(self.stock(), (1, 0, 2, 0, 2, 0))
+        Hold.objects.create(reader=Reader.objects.create(card_id='BD002', full_name='B', phone='0900000000'),
+                            book=self.book)
+        first.status, first.return_date = 'returned', date(2026, 1, 10)
+        first.save()
+        self.assertEqual(self.stock(), (1, 0, 2, 0, 1, 1))
+        LoanService.bulk_return([second.pk], date(2026, 1, 10))
+        self.assertEqual(self.stock(), (1, 1, 2, 1, 0, 1))
+
+        other = Book.objects.create(code='VH002', title='Số Đỏ', category=self.category,
+                                    author='Vũ Trọng Phụng', price=40000, total_quantity=1, available=1)
+        self.assertEqual(self.stock(), (2, 2, 3, 2, 0, 1))
+        loan = self.borrow(book=other)
+        Damage.objects.create(loan=loan, damage_type='lost')
+        self.assertEqual(self.stock(), (2, 1, 2, 1, 1, 1))
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_moving_and_retiring_books_recounts_both_categories(self):
+        science = Category.objects.create(name="Khoa học")
+        self.book.refresh_from_db()
+        self.book.category = science
+        self.book.save()
+        self.assertEqual(self.stock(), (0, 0, 0, 0, 0, 0))
+        self.assertEqual(Category.objects.get(pk=science.pk).copies_available, 2)
+        self.book.is_active = False
+        self.book.save()
+        self.assertEqual(Category.objects.filter(pk=science.pk).values_list('books', 'retired_books').get(), (0, 1))
+
+    def test_batch_writes_move_the_snapshot_without_recounting(self):
+        other = Book.objects.create(code='VH002', title='Số Đỏ', category=self.category,
+                                    author='Vũ Trọng Phụng', price=40000, total_quantity=1, available=1)
+        with CaptureQueriesContext(connection) as checkouts:
+            loans = LoanService.bulk_checkout([(self.reader, self.book), (self.reader, self.book), (self.reader, other)])
+        Damage.objects.create(loan=loans[2], damage_type='lost')
+        hold = Hold.objects.create(reader=Reader.objects.create(card_id='BD002', full_name='B', phone='0900000000'),
+                                   book=self.book)
+        with CaptureQueriesContext(connection) as returns:
+            LoanService.bulk_return([loan.pk for loan in loans], date(2026, 1, 10))
+            self.assertEqual(self.stock(), (2, 1, 2, 1, 0, 1))
+            Hold.objects.get(pk=hold.pk).cancel()
+            self.book.refresh_from_db()
+            self.book.total_quantity = 3
+            self.book.available = 3
+            self.book.save()
+        self.assertEqual(self.stock(), (2, 1, 3, 3, 0, 0))
+        updates = [query['sql'] for query in checkouts.captured_queries + returns.captured_queries
+                   if query['sql'].startswith('UPDATE "core_category"')]
+        self.assertEqual(len(updates), 4)
+        # Deltas of the rows written, never an aggregate over the books of the category
+        self.assertFalse([sql for sql in updates if 'core_book' in sql])
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_rebuild_counters_repairs_the_snapshot(self):
+        Category.objects.filter(pk=self.category.pk).update(books_available=7, copies=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_counters', check=True, stdout=StringIO())
+        call_command('rebuild_counters', stdout=StringIO())
+        self.assertEqual(self.stock(), (1, 1, 2, 2, 0, 0))
+
+
+@override_settings(LIBRARY_API_TOKEN='secret')
+class KioskApiTests(LibraryTestCase):
+    async def post(self, url, data=None, token='secret'):
+        return await self.async_client.post(url, data, content_type='application/json',
+                                            headers={'Authorization': f'Bearer {token}'})
+
+    async def test_search_and_availability(self):
+        response = await self.async_client.get(reverse('api:books'), {'q': 'de men'})
+        self.assertEqual([b['code'] for b in response.json()['results']], ['VH001'])
+        response = await self.async_client.get(reverse('api:availability', args=['VH001']))
+        self.assertEqual((response.json()['available'], response.json()['total_quantity']), (2, 2))
+        response = await self.async_client.get(reverse('api:availability', args=['XX999']))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_search_limit_is_clamped(self):
+        await Book.objects.acreate(code="VH002", title="Số Đỏ", category=self.category, author="Vũ Trọng Phụng",
+                                   publisher="NXB Văn học", price=80000, total_quantity=1, available=1)
+        for limit, found in [('-1', 1), ('0', 1), ('1000', 2)]:
+            response = await self.async_client.get(reverse('api:books'), {'limit': limit})
+            self.assertEqual(len(response.json()['results']), found)
+        for limit in ['abc', '', '1.5']:
+            response = await self.async_client.get(reverse('api:books'), {'limit': limit})
+            self.assertEqual(response.status_code, 400)
+
+    async def test_checkout_and_return_follow_inventory_rules(self):
+        data = {'card_id': 'BD001', 'book_code': 'VH001'}
+        loans = [await self.post(reverse('api:checkout'), data) for _ in range(3)]
+        self.assertEqual([r.status_code for r in loans], [201, 201, 409])
+        self.assertEqual(loans[0].json()['status'], 'borrowing')
+
+        response = await self.post(reverse('api:return', args=[loans[0].json()['id']]))
+        self.assertEqual(response.json()['status'], 'returned')
+        response = await self.post(reverse('api:return', args=[loans[0].json()['id']]))
+        self.assertEqual(response.status_code, 404)
+        book = await Book.objects.aget(pk=self.book.pk)
+        reader = await Reader.objects.aget(pk=self.reader.pk)
+        self.assertEqual((book.available, book.active_loans, book.loan_count, reader.active_loans), (1, 1, 2, 1))
+
+    def test_return_reports_the_accrued_fine(self):
+        loan = self.borrow(borrow_date=date.today() - timedelta(days=20))
+        response = async_to_sync(self.post)(reverse('api:return', args=[loan.pk]))
+        self.assertEqual(response.json()['fine'], 6000)
+        self.assertEqual(response.json()['fine'], Loan.objects.with_fines().get(pk=loan.pk).fine_amount)
+
+    async def test_writes_need_the_token(self):
+        data = {'card_id': 'BD001', 'book_code': 'VH001'}
+        response = await self.post(reverse('api:checkout'), data, token='wrong')
+        self.assertEqual(response.status_code, 401)
+        with self.settings(LIBRARY_API_TOKEN=''):
+            response = await self.post(reverse('api:checkout'), data, token='')
+            self.assertEqual(response.status_code, 503)
+        self.assertFalse(await Loan.objects.aexists())
+
+    async def test_body_must_be_a_json_object(self):
+        for data in [[], 1, 'BD001', None]:
+            response = await self.post(reverse('api:checkout'), json.dumps(data))
+            self.assertEqual(response.status_code, 400)
+
+
+class CatalogPageTests(LibraryTestCase):
+    def test_book_page_revalidates_until_a_loan_changes_it(self):
+        url = reverse('catalog:book', args=['VH001'])
+        response = self.client.get(url)
+        self.assertContains(response, '2/2')
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(url), '2/2')  # from the page cache
+
+        loan = self.borrow()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '1/2')
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        loan.due_date = date(2026, 2, 1)
+        loan.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_return_to_a_hold_changes_the_book_page(self):
+        loans = [self.borrow(), self.borrow()]
+        Hold.objects.create(reader=Reader.objects.create(card_id='BD002', full_name='B', phone='0900000000'),
+                            book=self.book)
+        url = reverse('catalog:book', args=['VH001'])
+        etag = self.client.get(url)['ETag']
+        loans[0].due_date = date(2026, 1, 10)
+        loans[0].save()
+        etag = self.client.get(url, HTTP_IF_NONE_MATCH=etag)['ETag']
+        LoanService.bulk_return([loans[0].pk], date(2026, 1, 10))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_page_cache_keys_on_the_page_number_only(self):
+        url = reverse('catalog:category', args=[self.category.pk])
+        self.client.get(url)
+        with self.assertNumQueries(2):  # the stamp only
+            self.client.get(url, {'x': 'anything'})
+        self.client.get(url, {'page': '99'})
+        with self.assertNumQueries(4):  # rendered again: page 99 is shown as page 1
+            self.client.get(url, {'page': '99'})
+
+    def test_loans_of_other_books_keep_the_book_page(self):
+        other = Book.objects.create(code='VH002', title='Số Đỏ', category=self.category,
+                                    author='Vũ Trọng Phụng', price=40000, total_quantity=1, available=1)
+        url = reverse('catalog:book', args=['VH001'])
+        etag = self.client.get(url)['ETag']
+        self.borrow(book=other)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get(reverse('catalog:index'))
+        self.assertContains(response, '1/2 đầu sách còn trên giá')
+
+    def test_category_page_follows_its_books(self):
+        url = reverse('catalog:category', args=[self.category.pk])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        LoanService.bulk_checkout([(self.reader, self.book)])
+        etag = self.client.get(url, HTTP_IF_NONE_MATCH=etag)['ETag']
+        self.book.refresh_from_db()  # the checkout moved the row to a new version
+        self.book.is_active = False
+        self.book.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotContains(response, 'VH001')
+        self.assertEqual(self.client.get(reverse('catalog:book', args=['VH001'])).status_code, 404)
+
+
+class ReminderTests(LibraryTestCase):
+    class Outbox(Sender):
+        def __init__(self, fail=()):
+            self.sent, self.fail = [], set(fail)
+
+        def deliver(self, notice):
+            if notice.card_id in self.fail:
+                raise OSError('gateway down')
+            self.sent.append(notice)
+
+    def setUp(self):
+        self.other = Reader.objects.create(card_id="BD002", full_name="Trần Thị B", phone="0907654321")
+        book = Book.objects.create(code="VH002", title="Số Đỏ", category=self.category, author="Vũ Trọng Phụng",
+                                   publisher="NXB Văn học", price=60000, total_quantity=5, available=5)
+        self.borrow()                                          # due 01-15: overdue 5 days on 01-20
+        self.borrow(book=book, borrow_date=date(2026, 1, 7))   # due 01-21: due soon
+        self.borrow(book=book, reader=self.other, borrow_date=date(2026, 1, 2))
+        self.borrow(book=book, reader=self.other, borrow_date=date(2026, 1, 20))  # due 02-03: not yet
+        self.today = date(2026, 1, 20)
+
+    def test_one_notice_per_reader_and_reruns_skip_sent(self):
+        outbox = self.Outbox(fail={'BD002'})
+        stats = send_reminders(outbox, self.today, days_before=2)
+        self.assertEqual((stats['readers'], stats['loans'], stats['sent'], stats['failed']), (2, 3, 1, 1))
+        notice = outbox.sent[0]
+        self.assertEqual((notice.card_id, notice.overdue, notice.due_soon, notice.fine), ('BD001', 1, 1, 5000))
+        self.assertIn('Số Đỏ', notice.message)
+        self.assertIn('phạt 5,000 đ', notice.message)
+        self.assertEqual(Reminder.objects.get(reader=self.other).status, 'failed')
+
+        outbox = self.Outbox()
+        stats = send_reminders(outbox, self.today, days_before=2)
+        self.assertEqual((stats['sent'], stats['skipped']), (1, 1))
+        self.assertEqual([n.card_id for n in outbox.sent], ['BD002'])
+        self.assertEqual(Reminder.objects.filter(status='sent').count(), 2)
+
+    def test_chunks_never_split_a_reader(self):
+        # BD001 fills a whole chunk, so it is read again on its own
+        with self.assertNumQueries(4):
+            chunks = list(loans_by_reader(self.today + timedelta(days=2), chunk_size=2))
+        self.assertEqual([[(reader, len(loans)) for reader, loans in chunk] for chunk in chunks],
+                         [[(self.reader.pk, 2)], [(self.other.pk, 1)]])
+
+    def test_command_writes_file(self):
+        path = self.enterContext(tempfile.TemporaryDirectory()) + '/sms.jsonl'
+        out = StringIO()
+        call_command('send_reminders', date=self.today, output=path, stdout=out)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['card_id'] for line in f], ['BD001', 'BD002'])
+        self.assertIn('gửi 2', out.getvalue())
+
+
+class ArchiveTests(LibraryTestCase):
+    def setUp(self):
+        self.old = self.returned(date(2024, 1, 1), date(2024, 1, 25))
+        Damage.objects.create(loan=self.old, damage_type='minor', reported_date=date(2024, 1, 25), is_paid=True)
+        self.owing = self.returned(date(2024, 3, 1), date(2024, 3, 10))
+        Damage.objects.create(loan=self.owing, damage_type='torn', reported_date=date(2024, 3, 10))
+        self.recent = self.returned(date(2025, 12, 1), date(2025, 12, 5))
+        self.current = self.borrow()
+
+    def returned(self, borrow_date, return_date):
+        loan = self.borrow(borrow_date=borrow_date)
+        loan.status, loan.return_date = 'returned', return_date
+        loan.save()
+        return loan
+
+    def figures(self):
+        return list(DailyCategoryStat.objects.order_by('day', 'category').values_list(
+            'day', 'category', 'loans', 'returns', 'late_returns', 'new_overdue', 'fines', 'damage_cost',
+            'open_loans', 'overdue'))
+
+    def test_moves_settled_loans_and_keeps_counters(self):
+        self.assertEqual(archive_loans(date(2025, 1, 1), batch_size=1), (1, 1))
+        self.assertEqual(archive_loans(date(2025, 1, 1)), (0, 0))
+        self.assertEqual(set(Loan.objects.values_list('pk', flat=True)),
+                         {self.owing.pk, self.recent.pk, self.current.pk})
+        archived = ArchivedLoan.objects.get()
+        self.assertEqual((archived.pk, archived.return_date, archived.fine), (self.old.pk, date(2024, 1, 25), 10000))
+        self.assertEqual(archived.damages.get().compensation_fee, 15000)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.loan_count, 4)
+        call_command('rebuild_counters', check=True, stdout=StringIO())
+
+    def test_generated_loans_skip_archived_ids(self):
+        last = self.returned(date(2024, 2, 1), date(2024, 2, 10))
+        archive_loans(date(2025, 1, 1))
+        self.assertTrue(ArchivedLoan.objects.filter(pk=last.pk).exists())
+        call_command('generate_library', books=2, readers=2, loans=5, keep_indexes=True, stdout=StringIO())
+        self.assertEqual(Loan.objects.filter(pk__in=ArchivedLoan.objects.values('pk')).count(), 0)
+        self.assertGreater(self.borrow().pk, last.pk + 5)
+
+    def test_rollups_are_unchanged_by_archiving(self):
+        build_rollups(until=date(2026, 1, 31))
+        before = self.figures()
+        call_command('archive_loans', before=date(2025, 1, 1), stdout=StringIO())
+        build_rollups(until=date(2026, 1, 31), rebuild=True)
+        self.assertEqual(self.figures(), before)
+
+    def test_reader_history_can_include_archive(self):
+        archive_loans(date(2025, 1, 1))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:core_reader_change', args=[self.reader.pk])
+        hot = self.client.get(url).context['history']
+        self.assertEqual([loan.pk for loan in hot], [self.recent.pk, self.owing.pk])
+        response = self.client.get(url + '?archived=1')
+        self.assertEqual([loan.pk for loan in response.context['history']],
+                         [self.recent.pk, self.owing.pk, self.old.pk])
+        self.assertContains(response, reverse('admin:core_archivedloan_change', args=[self.old.pk]))
+
+
+class WorkerTests(TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('cần CSDL dạng file hoặc PostgreSQL để mở nhiều kết nối')
+
+    def test_run_workers_drains_queue(self):
+        category = Category.objects.create(name="Văn học")
+        book = Book.objects.create(code="VH001", title="Dế Mèn Phiêu Lưu Ký", category=category, author="Tô Hoài",
+                                   publisher="NXB Kim Đồng", price=50000, total_quantity=2, available=2)
+        reader = Reader.objects.create(card_id="BD001", full_name="Nguyễn Văn A", phone="0901234567")
+        loan = Loan.objects.create(reader=reader, book=book)
+        Book.all_objects.filter(pk=book.pk).update(loan_count=0)
+        jobs.enqueue('rebuild_counters')
+        jobs.enqueue('bulk_return', loan_ids=[loan.pk])
+
+        call_command('run_workers', workers=2, once=True, poll=0.01, stdout=StringIO())
+        self.assertEqual(list(Job.objects.values_list('status', flat=True)), ['done', 'done'])
+        book.refresh_from_db()
+        self.assertEqual((book.available, book.loan_count), (2, 1))
+
+    def test_run_workers_replaces_a_broken_pool(self):
+        for _ in range(2):
+            jobs.enqueue('rebuild_counters')
+        submit = ThreadPoolExecutor.submit
+        broken = []
+
+        def submit_after_break(pool, *args):
+            # The first pool takes no work, as a process pool once one of its children died
+            if not broken:
+                broken.append(pool)
+            if pool is broken[0]:
+                raise BrokenThreadPool('worker died')
+            return submit(pool, *args)
+
+        err = StringIO()
+        with mock.patch.object(ThreadPoolExecutor, 'submit', submit_after_break):
+            call_command('run_workers', workers=2, once=True, poll=0.01, stdout=StringIO(), stderr=err)
+        self.assertIn('BrokenThreadPool: worker died', err.getvalue())
+        # Both claimed jobs went back to the queue with their attempt and ran on the new pool
+        self.assertEqual(list(Job.objects.values_list('status', 'attempts')), [('done', 1), ('done', 1)])
+
+
+class ConcurrencyTests(TransactionTestCase):
+    desks = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('cần CSDL dạng file hoặc PostgreSQL để mở nhiều kết nối')
+
+    def test_parallel_checkouts_never_oversell(self):
+        category = Category.objects.create(name="Văn học")
+        book = Book.objects.create(code="VH001", title="Dế Mèn Phiêu Lưu Ký", category=category, author="Tô Hoài",
+                                   publisher="NXB Kim Đồng", price=50000, total_quantity=5, available=5)
+        readers = [Reader.objects.create(card_id=f"BD{i:03d}", full_name=f"Bạn đọc {i}", phone="0900000000")
+                   for i in range(self.desks)]
+        barrier, errors, out_of_stock = threading.Barrier(self.desks), [], []
+
+        def desk(i):
+            try:
+                barrier.wait()
+                for _ in range(3):
+                    try:
+                        if i % 2:
+                            Loan.objects.create(reader=readers[i], book=Book.objects.get(pk=book.pk))
+                        else:
+                            LoanService.bulk_checkout([(readers[i], book)])
+                    except ValidationError:
+                        out_of_stock.append(i)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=desk, args=(i,)) for i in range(self.desks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Loan.objects.count(), 5)
+        self.assertEqual(len(out_of_stock), 3 * self.desks - 5)
+        book.refresh_from_db()
+        self.assertEqual((book.available, book.active_loans, book.loan_count), (0, 5, 5))
+        self.assertEqual(Reader.objects.aggregate(n=Sum('active_loans'))['n'], 5)
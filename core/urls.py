@@ -0,0 +1,23 @@
+from django.urls import include, path
+
+from . import views
+
+api_patterns = [
+    path('books/', views.search_books, name='books'),
+    path('books/<str:code>/', views.availability, name='availability'),
+    path('loans/', views.checkout, name='checkout'),
+    path('loans/<int:loan_id>/return/', views.return_loan, name='return'),
+    path('holds/', views.place_hold, name='hold'),
+    path('holds/<int:hold_id>/', views.hold_status, name='hold_status'),
+]
+
+catalog_patterns = [
+    path('', views.catalog_index, name='index'),
+    path('category/<int:pk>/', views.catalog_category, name='category'),
+    path('book/<str:code>/', views.catalog_book, name='book'),
+]
+
+urlpatterns = [
+    path('api/', include((api_patterns, 'api'))),
+    path('catalog/', include((catalog_patterns, 'catalog'))),
+]
@@ -1,3 +1,287 @@
-from django.shortcuts import render
+import hashlib
+import json
+from datetime import date, datetime, timezone
+from functools import wraps
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Count, Max, Min, Q
+from django.http import Http404, HttpResponse, JsonResponse
+from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST, require_safe
+
+from .models import Category, Book, Reader, Loan, Hold
+from .search import search_backend
+
+BOOK_FIELDS = ['id', 'code', 'title', 'author', 'category__name', 'available', 'total_quantity']
+MAX_RESULTS = 50
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def loan_data(loan):
+    return {
+        'id': loan.pk,
+        'card_id': loan.reader.card_id,
+        'book_code': loan.book.code,
+        'title': loan.book.title,
+        'borrow_date': loan.borrow_date,
+        'due_date': loan.due_date,
+        'return_date': loan.return_date,
+        'status': loan.status,
+        # The SQL fine of the admin and reports (LoanQuerySet.with_fines), which accrues on open loans
+        'fine': loan.fine_amount,
+    }
+
+
+def denied(request):
+    """The error response for a request without the kiosk token, or None.
+
+    Kiosks authenticate with "Authorization: Bearer <LIBRARY_API_TOKEN>". The
+    endpoints are CSRF exempt, so without a configured token they stay closed.
+    """
+    token = getattr(settings, 'LIBRARY_API_TOKEN', '')
+    if not token:
+        return error('API kiosk chưa được cấu hình (LIBRARY_API_TOKEN)', 503)
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return error('Không có quyền', 401)
+    return None
+
+
+def body(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+        # Only an object has fields; any other JSON value is answered like a missing field
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+@require_GET
+async def search_books(request):
+    """Active books matching ``q`` (accent-insensitive where the search index exists), newest first."""
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 20)), MAX_RESULTS))
+    except ValueError:
+        return error('limit không hợp lệ')
+    books = Book.objects.order_by('-pk')
+    term = request.GET.get('q', '').strip()
+    if term:
+        matches = search_backend().matching('book', term)
+        books = books.filter(pk__in=matches) if matches is not None else books.filter(
+            Q(code__icontains=term) | Q(title__icontains=term) | Q(author__icontains=term))
+    if request.GET.get('available'):
+        books = books.filter(available__gt=0)
+    return JsonResponse({'results': [row async for row in books.values(*BOOK_FIELDS)[:limit]]})
+
+
+@require_GET
+async def availability(request, code):
+    book = await Book.all_objects.filter(code=code).values(*BOOK_FIELDS, 'is_active').afirst()
+    if book is None:
+        return error('Không tìm thấy sách', 404)
+    return JsonResponse(book)
+
+
+# Writes go through Loan.save() so kiosks follow the same inventory rules as the admin; each
+# request makes a single hop to the ORM thread for all of its queries.
+
+def _checkout(card_id, book_code):
+    reader = Reader.objects.get(card_id=card_id)
+    book = Book.objects.get(code=book_code)
+    loan = Loan(reader=reader, book=book)
+    loan.save()
+    loan.fine_amount = 0  # due LOAN_PERIOD from today
+    return loan_data(loan)
+
+
+def _return(loan_id):
+    # Annotated as of today, which is also the return date: the fine is the one the loan closes with
+    loan = Loan.objects.with_fines().select_related('reader', 'book').get(pk=loan_id, status='borrowing')
+    loan.status, loan.return_date = 'returned', date.today()
+    loan.save()
+    return loan_data(loan)
+
+
+@csrf_exempt
+@require_POST
+async def checkout(request):
+    if response := denied(request):
+        return response
+    data = body(request)
+    if not data.get('card_id') or not data.get('book_code'):
+        return error('Cần card_id và book_code')
+    try:
+        return JsonResponse(await sync_to_async(_checkout)(data['card_id'], data['book_code']), status=201)
+    except Reader.DoesNotExist:
+        return error('Không tìm thấy bạn đọc', 404)
+    except Book.DoesNotExist:
+        return error('Không tìm thấy sách', 404)
+    except ValidationError as e:
+        return error('; '.join(e.messages), 409)
+
+
+def hold_data(hold):
+    return {
+        'id': hold.pk,
+        'card_id': hold.reader.card_id,
+        'book_code': hold.book.code,
+        'status': hold.status,
+        'position': hold.position(),
+        'expires_at': hold.expires_at,
+    }
+
+
+def _place_hold(card_id, book_code):
+    hold = Hold(reader=Reader.objects.get(card_id=card_id), book=Book.objects.get(code=book_code))
+    hold.full_clean()
+    hold.save()
+    return hold_data(hold)
+
+
+def _hold(hold_id):
+    return hold_data(Hold.objects.select_related('reader', 'book').get(pk=hold_id))
+
+
+@csrf_exempt
+@require_POST
+async def return_loan(request, loan_id):
+    if response := denied(request):
+        return response
+    try:
+        return JsonResponse(await sync_to_async(_return)(loan_id))
+    except Loan.DoesNotExist:
+        return error('Không tìm thấy phiếu đang mượn', 404)
+    except ValidationError as e:
+        return error('; '.join(e.messages), 409)
+
+
+@csrf_exempt
+@require_POST
+async def place_hold(request):
+    """Join the queue of a book with no copy on the shelf; the copy is kept for the reader when it comes back."""
+    if response := denied(request):
+        return response
+    data = body(request)
+    if not data.get('card_id') or not data.get('book_code'):
+        return error('Cần card_id và book_code')
+    try:
+        return JsonResponse(await sync_to_async(_place_hold)(data['card_id'], data['book_code']), status=201)
+    except Reader.DoesNotExist:
+        return error('Không tìm thấy bạn đọc', 404)
+    except Book.DoesNotExist:
+        return error('Không tìm thấy sách', 404)
+    except ValidationError as e:
+        return error('; '.join(e.messages), 409)
+
+
+@require_GET
+async def hold_status(request, hold_id):
+    # Holds name the reader's card: sequential ids must not be readable by anyone
+    if response := denied(request):
+        return response
+    try:
+        return JsonResponse(await sync_to_async(_hold)(hold_id))
+    except Hold.DoesNotExist:
+        return error('Không tìm thấy lượt đặt trước', 404)
+
+
+# Public catalog pages. Each page is versioned by the modified_at stamps of what it shows: the
+# stamp answers If-None-Match / If-Modified-Since with a 304 and keys the rendered page in the
+# cache, so a write to a book or its loans makes the next read render it again.
+
+PAGE_SIZE = 50
+PAGE_TIMEOUT = 3600
+EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+
+def versioned_page(stamp):
+    """``stamp(*view args)`` returns (tag, last modified datetime) for the page, or None for a 404."""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            version = stamp(*args, **kwargs)
+            if version is None:
+                raise Http404
+            tag, modified = version
+            etag = quote_etag(f'{tag}-{modified.timestamp():.6f}')
+            last_modified = int(modified.timestamp())
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                cache = caches[getattr(settings, 'LIBRARY_CACHE', 'default')]
+                # Only the page number changes what a catalog view renders: other query strings share
+                # the entry, and a number the view does not render as such is not cached at all
+                number = request.GET.get('page', '1')
+                path = hashlib.md5(request.path.encode(), usedforsecurity=False).hexdigest()
+                key = f'catalog:page:{etag}:{path}:{number}'
+                page = cache.get(key)
+                if page is None:
+                    rendered = view(request, *args, **kwargs).render()
+                    page = (rendered.content, rendered['Content-Type'])
+                    shown = rendered.context_data.get('page')
+                    if shown is None or str(shown.number) == number:
+                        cache.set(key, page, PAGE_TIMEOUT)
+                response = HttpResponse(page[0], content_type=page[1])
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, public=True, max_age=getattr(settings, 'LIBRARY_CATALOG_MAX_AGE', 0))
+            return response
+        return require_safe(wrapped)
+    return decorator
+
+
+def index_stamp():
+    stamp = Category.objects.aggregate(n=Count('pk'), m=Max('modified_at'), s=Max('stock_changed_at'))
+    return f'i{stamp["n"]}', max(stamp['m'] or EPOCH, stamp['s'] or EPOCH)
+
+
+def category_stamp(pk):
+    # The snapshot count catches books leaving the category, the max stamp any change to one still in it
+    row = Category.objects.filter(pk=pk).values_list('modified_at', 'stock_changed_at', 'books').first()
+    if row is None:
+        return None
+    modified = Book.objects.filter(category=pk).aggregate(m=Max('modified_at'))['m']
+    return f'c{pk}.{row[2]}', max(row[0], row[1], modified or EPOCH)
+
+
+def book_stamp(code):
+    # Only the category's name shows on a book page: its stock changes leave the page alone
+    row = Book.objects.filter(code=code).values_list('pk', 'modified_at', 'category__modified_at').first()
+    return row and (f'b{row[0]}', max(row[1], row[2]))
+
+
+@versioned_page(index_stamp)
+def catalog_index(request):
+    categories = Category.objects.order_by('name')
+    return TemplateResponse(request, 'core/catalog/index.html', {'categories': categories})
+
+
+@versioned_page(category_stamp)
+def catalog_category(request, pk):
+    category = Category.objects.get(pk=pk)
+    books = Book.objects.filter(category=category).order_by('title', 'pk').only(
+        'code', 'title', 'author', 'available', 'total_quantity')
+    paginator = Paginator(books, PAGE_SIZE)
+    paginator.count = category.books  # the snapshot saves a COUNT over the category's books
+    page = paginator.get_page(request.GET.get('page'))
+    return TemplateResponse(request, 'core/catalog/category.html', {'category': category, 'page': page})
+
+
+@versioned_page(book_stamp)
+def catalog_book(request, code):
+    book = Book.objects.select_related('category').get(code=code)
+    next_due = None
+    if not book.available:
+        next_due = book.loans.filter(status='borrowing').aggregate(m=Min('due_date'))['m']
+    return TemplateResponse(request, 'core/catalog/book.html', {'book': book, 'next_due': next_due})
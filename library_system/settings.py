@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.PerfMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -72,15 +74,141 @@ WSGI_APPLICATION = 'library_system.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
+# LIBRARY_DB_ENGINE=postgresql switches to PostgreSQL (LIBRARY_DB_NAME/USER/PASSWORD/HOST/PORT);
+# LIBRARY_DB_POOL=1 uses psycopg's connection pool instead of persistent connections.
+
+LIBRARY_DB_ENGINE = os.environ.get('LIBRARY_DB_ENGINE', 'sqlite')
+CONN_MAX_AGE = int(os.environ.get('LIBRARY_DB_CONN_MAX_AGE', 60))
+
+if LIBRARY_DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('LIBRARY_DB_NAME', 'library'),
+            'USER': os.environ.get('LIBRARY_DB_USER', ''),
+            'PASSWORD': os.environ.get('LIBRARY_DB_PASSWORD', ''),
+            'HOST': os.environ.get('LIBRARY_DB_HOST', ''),
+            'PORT': os.environ.get('LIBRARY_DB_PORT', ''),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if os.environ.get('LIBRARY_DB_POOL') == '1':
+        # The pool replaces persistent connections; Django requires CONN_MAX_AGE = 0 with it
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('LIBRARY_DB_POOL_MIN', 2)),
+            'max_size': int(os.environ.get('LIBRARY_DB_POOL_MAX', 10)),
+        }
+else:
+    # WAL lets readers run alongside the writer; IMMEDIATE transactions take the write lock up
+    # front so concurrent checkouts queue on busy_timeout instead of failing with "database is locked".
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('LIBRARY_DB_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'OPTIONS': {
+                'timeout': int(os.environ.get('LIBRARY_SQLITE_TIMEOUT', 20)),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    f'PRAGMA mmap_size={int(os.environ.get("LIBRARY_SQLITE_MMAP", 256 * 1024 * 1024))};'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+            # A file, not shared memory, so the tests run on the same WAL setup and can hold
+            # several connections (see ConcurrencyTests)
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# Catalog display data (core/cache.py) and rendered catalog pages. LocMemCache lives in one process:
+# run_workers, the kiosk server and the admin each keep their own copy and never see the others'
+# invalidations. Deploy several processes with a shared backend (Redis, Memcached, FileBasedCache).
 
-DATABASES = {
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'library',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
     }
 }
 
 
+# Request instrumentation (core/middleware.py)
+# Share of requests recorded, 0 to disable. Records go to the core.perf logger ('log') or to a
+# SQLite file summarized by `manage.py perf_report`.
+
+LIBRARY_PERF_SAMPLE_RATE = 0
+LIBRARY_PERF_SINK = BASE_DIR / 'perf.sqlite3'
+LIBRARY_PERF_SLOWEST = 3
+LIBRARY_PERF_DUPLICATES = 3
+
+
+# Kiosk API (core/views.py): checkout, return and holds require "Authorization: Bearer <token>" and
+# answer 503 while no token is set
+
+LIBRARY_API_TOKEN = os.environ.get('LIBRARY_API_TOKEN', '')
+
+
+# Public catalog pages (/catalog/) carry ETag/Last-Modified and are cached server-side per version;
+# browsers revalidate after LIBRARY_CATALOG_MAX_AGE seconds
+
+LIBRARY_CATALOG_MAX_AGE = 0
+
+
+# Reminder notices (`manage.py send_reminders`): a Sender subclass from core/reminders.py; FileSender
+# writes JSON lines to LIBRARY_REMINDER_FILE as a stand-in for an SMS gateway
+
+LIBRARY_REMINDER_SENDER = 'core.reminders.FileSender'
+LIBRARY_REMINDER_FILE = BASE_DIR / 'reminders.jsonl'
+
+
+# Holds (core.models.Hold): a returned copy is kept for the next reader in the queue for
+# LIBRARY_HOLD_PICKUP_DAYS days, then `manage.py expire_holds` passes it on
+
+LIBRARY_HOLD_PICKUP_DAYS = 3
+
+
+# Returned loans (with their paid damages) move to the archive tables this many days after their
+# return, by `manage.py archive_loans` or the archive_loans job
+
+LIBRARY_ARCHIVE_AFTER_DAYS = 730
+
+
+# Background jobs (core/jobs.py), run by `manage.py run_workers`
+# Failed jobs are retried after LIBRARY_JOB_RETRY_DELAY seconds, doubled on every attempt; running
+# jobs whose worker stopped beating for LIBRARY_JOB_STALE_AFTER seconds go back to the queue.
+
+LIBRARY_JOB_MAX_ATTEMPTS = 3
+LIBRARY_JOB_RETRY_DELAY = 30
+LIBRARY_JOB_STALE_AFTER = 600
+LIBRARY_JOB_OUTPUT_DIR = BASE_DIR / 'job_output'
+
+
+# Admin exports: CSV is streamed; an XLSX workbook is built whole, so above this many rows it is
+# made by the export job instead of the request
+
+LIBRARY_EXPORT_XLSX_SYNC_ROWS = 10000
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.perf': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
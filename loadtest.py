@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the kiosk API (core/views.py) against a running server, standard library only.
+
+    uvicorn library_system.asgi:application --port 8000      # or: daphne -p 8000 library_system.asgi:application
+    python loadtest.py --url http://127.0.0.1:8000 --clients 100 --duration 30 --cards BD001,BD002,BD003
+
+Each client keeps one HTTP connection and loops over a mix of searches, availability
+checks and checkout + return pairs, then latency percentiles per endpoint are printed.
+"""
+import argparse
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import quote, urlsplit
+
+SEARCH_TERMS = ['de men', 'so do', 'truyen', 'lich su', 'khoa hoc', 'nguyen', 'tho', 'ky']
+
+
+def percentile(values, p):
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class Client:
+    def __init__(self, url, token):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.headers = {'Content-Type': 'application/json'}
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
+
+    def request(self, method, path, data=None):
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, json.dumps(data) if data is not None else None, self.headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            payload, status = b'', 0
+        return status, payload, (time.perf_counter() - start) * 1000
+
+
+def run(args):
+    codes = [book['code'] for book in json.loads(
+        Client(args.url, args.token).request('GET', '/api/books/?limit=50')[1])['results']]
+    cards = args.cards.split(',')
+    if not codes:
+        raise SystemExit('Không có sách nào, hãy chạy populate_data.py hoặc generate_library trước')
+
+    timings, statuses, lock = defaultdict(list), defaultdict(int), threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def record(name, status, ms):
+        with lock:
+            timings[name].append(ms)
+            statuses[name, status] += 1
+
+    def client_loop(seed):
+        rng, client = random.Random(seed), Client(args.url, args.token)
+        while time.monotonic() < deadline:
+            roll = rng.random()
+            if roll < args.search:
+                status, _, ms = client.request('GET', '/api/books/?q=' + quote(rng.choice(SEARCH_TERMS)))
+                record('search', status, ms)
+            elif roll < args.search + args.availability:
+                status, _, ms = client.request('GET', f'/api/books/{quote(rng.choice(codes))}/')
+                record('availability', status, ms)
+            else:
+                status, payload, ms = client.request(
+                    'POST', '/api/loans/', {'card_id': rng.choice(cards), 'book_code': rng.choice(codes)})
+                record('checkout', status, ms)
+                if status == 201:
+                    status, _, ms = client.request('POST', f'/api/loans/{json.loads(payload)["id"]}/return/')
+                    record('return', status, ms)
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(args.clients)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    total = sum(len(values) for values in timings.values())
+    print(f'{args.clients} client, {elapsed:.1f}s, {total:,} request, {total / elapsed:,.0f} req/s')
+    print(f'{"endpoint":<14}{"n":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}  status')
+    for name, values in sorted(timings.items()):
+        values.sort()
+        codes_seen = ', '.join(f'{status}: {n}' for (op, status), n in sorted(statuses.items()) if op == name)
+        print(f'{name:<14}{len(values):>9}' + ''.join(f'{percentile(values, p):>10.1f}' for p in (50, 95, 99))
+              + f'  {codes_seen}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the kiosk API')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--clients', type=int, default=50, help='Concurrent kiosks')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds')
+    parser.add_argument('--cards', default='BD001,BD002,BD003', help='Reader card ids used for checkouts')
+    parser.add_argument('--token', default='', help='LIBRARY_API_TOKEN of the server (checkouts need it)')
+    parser.add_argument('--search', type=float, default=0.6, help='Share of searches')
+    parser.add_argument('--availability', type=float, default=0.3, help='Share of availability checks')
+    run(parser.parse_args())